@@ -0,0 +1,96 @@
+import time
+import argparse
+
+import structlog
+
+from typing import (
+    Callable,
+    Iterator
+)
+
+from config.settings import settings
+from helpers.postgres_helpers import connect_to_postgres
+from repository.robots.robots import (
+    RobotsRepo,
+    RobotInfo,
+    RobotState,
+    setup_robots_repo
+)
+
+'''
+    NOTE:
+    Compare the COPY based bulk path (bulk_load_robot_infos/bulk_load_robot_states)
+    with the unnest array upserts (register/upsert_robot_states).
+
+    The upserts are called with batch_size rows per call, since sending
+    100k rows in one parameterised statement is not something we do in production.
+
+    usage:
+        PYTHONPATH=. python benchmarks/bulk_load_benchmark.py --rows 10000 100000
+'''
+
+def _robot_infos(rows: int) -> Iterator[RobotInfo]:
+    for i in range(rows):
+        yield RobotInfo(robot_id=f"bench-smr{i:07d}", robot_name=f"{i}")
+
+def _robot_states(rows: int) -> Iterator[RobotState]:
+    for i in range(rows):
+        yield RobotState(robot_id=f"bench-smr{i:07d}",
+                         map_uuid="bench-map",
+                         position_x=float(i),
+                         position_y=float(-i),
+                         position_theta=0.0)
+
+def _batched(iterator: Iterator, batch_size: int) -> Iterator[list]:
+
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def _measure(name: str, rows: int, func: Callable[[], None]):
+
+    started_at = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started_at
+    print("{:<28} rows={:<8} elapsed={:>8.3f}s rows/s={:>12.0f}".format(name, rows, elapsed, rows / elapsed))
+
+def run(robots_repo: RobotsRepo, rows: int, batch_size: int):
+
+    def register():
+        for batch in _batched(_robot_infos(rows), batch_size):
+            robots_repo.register(batch)
+
+    def upsert_robot_states():
+        for batch in _batched(_robot_states(rows), batch_size):
+            robots_repo.upsert_robot_states(batch)
+
+    _measure("register", rows, register)
+    _measure("bulk_load_robot_infos", rows, lambda: robots_repo.bulk_load_robot_infos(_robot_infos(rows)))
+    _measure("upsert_robot_states", rows, upsert_robot_states)
+    _measure("bulk_load_robot_states", rows, lambda: robots_repo.bulk_load_robot_states(_robot_states(rows)))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    pg_engine = connect_to_postgres(
+        host=settings.host,
+        port=settings.port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password
+    )
+
+    robots_repo = setup_robots_repo(logger=structlog.get_logger(), engine=pg_engine)
+
+    for rows in args.rows:
+        run(robots_repo, rows, args.batch_size)
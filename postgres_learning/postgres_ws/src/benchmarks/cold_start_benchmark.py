@@ -0,0 +1,84 @@
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+'''
+    NOTE:
+    Cold start time of a worker process, from process start until the first query of
+    RobotsRepo + UserRepo has returned.
+
+    full: connect_to_postgres(bootstrap=True) + setup_*_repo(create_tables=True)
+    fast: connect_to_postgres(bootstrap=False) + setup_*_repo(create_tables=False)
+
+    Every run is a new interpreter, "setup" excludes the python imports.
+
+    usage:
+        PYTHONPATH=. python benchmarks/cold_start_benchmark.py --runs 20
+'''
+
+def child(mode: str, host: str):
+
+    started_at = time.perf_counter()
+
+    import structlog
+
+    from config.settings import settings
+    from helpers.postgres_helpers import connect_to_postgres
+    from repository.robots.robots import setup_robots_repo
+    from repository.user.user import setup_user_repo
+
+    imported_at = time.perf_counter()
+
+    fast = mode == "fast"
+    pg_engine = connect_to_postgres(
+        host=host or settings.host,
+        port=settings.port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password,
+        bootstrap=not fast
+    )
+
+    robots_repo = setup_robots_repo(logger=structlog.get_logger(), engine=pg_engine, create_tables=not fast)
+    user_repo = setup_user_repo(logger=structlog.get_logger(), engine=pg_engine, create_tables=not fast)
+
+    robots_repo.fetch_robot_name(["cold-start-smr01"])
+    user_repo.fetch_user_address(id=-1)
+
+    finished_at = time.perf_counter()
+    print("{} {}".format(imported_at - started_at, finished_at - imported_at))
+
+def run(mode: str, runs: int, host: str):
+
+    imports, setups, totals = [], [], []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        output = subprocess.run([sys.executable, __file__, "--child", mode] + (["--host", host] if host else []),
+                                check=True, capture_output=True, text=True).stdout
+        totals.append(time.perf_counter() - started_at)
+
+        import_time, setup_time = map(float, output.split()[-2:])
+        imports.append(import_time)
+        setups.append(setup_time)
+
+    print("mode={:<5} runs={:<4} imports p50={:>7.1f}ms setup p50={:>7.1f}ms process p50={:>7.1f}ms".format(
+        mode, runs,
+        statistics.median(imports) * 1000,
+        statistics.median(setups) * 1000,
+        statistics.median(totals) * 1000))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--child", choices=["full", "fast"], default=None)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.host)
+    else:
+        for mode in ("full", "fast"):
+            run(mode, args.runs, args.host)
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import structlog
+import sqlalchemy
+
+from datetime import (
+    datetime,
+    timezone
+)
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional
+)
+
+from sqlalchemy import text
+
+from config.settings import settings
+from helpers.postgres_helpers import connect_to_postgres
+from repository.robots.robots import (
+    RobotsRepo,
+    RobotInfo,
+    RobotState,
+    setup_robots_repo
+)
+from repository.user.user import (
+    UserRepo,
+    User,
+    Address,
+    setup_user_repo
+)
+
+'''
+    NOTE:
+    Throughput and p50/p99 latency of the repository methods at several fleet sizes.
+
+    By default a throwaway PostgreSQL is created with initdb in a temporary directory,
+    started with pg_ctl on a free port (fsync off, it is thrown away anyway) and removed
+    afterwards, so runs do not depend on the docker database or its data. initdb refuses
+    to run as root, run the benchmark as a normal user. --host uses an existing server
+    from settings instead.
+
+    Every fleet size seeds N robots (robot_infos + robot_states) and N users with two
+    addresses each, then times every operation for --iterations calls:
+
+        register               1 robot info
+        upsert_robot_states    --batch-size robot states
+        fetch_robot_states     the whole fleet
+        fetch_robot_name       10 robot ids, name cache disabled so the query is measured
+        fetch_user_address     1 user
+
+    Results are written as JSON, --baseline prints the p50/p99 change against an older run.
+
+    usage:
+        PYTHONPATH=. python benchmarks/repository_benchmark.py --fleet-sizes 100 1000 10000 --output result.json
+        PYTHONPATH=. python benchmarks/repository_benchmark.py --baseline result.json
+'''
+
+class LocalPostgres():
+
+    def __init__(self, bin_dir: Optional[str] = None):
+
+        self.bin_dir = bin_dir
+        self.data_dir: Optional[str] = None
+        self.port: Optional[int] = None
+
+    def _bin(self, name: str) -> str:
+
+        path = os.path.join(self.bin_dir, name) if self.bin_dir else shutil.which(name)
+        if path is None:
+            raise RuntimeError(f"{name} not found, put the PostgreSQL bin directory on PATH or pass --pg-bin")
+        return path
+
+    def start(self) -> "LocalPostgres":
+
+        self.data_dir = tempfile.mkdtemp(prefix="repository-benchmark-")
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+
+        subprocess.run([self._bin("initdb"), "-D", self.data_dir, "-U", settings.user, "--auth=trust"],
+                       check=True, capture_output=True)
+        subprocess.run([self._bin("pg_ctl"), "-D", self.data_dir, "-w", "-l", os.path.join(self.data_dir, "server.log"),
+                        "-o", f"-p {self.port} -k {self.data_dir} -c listen_addresses=127.0.0.1 "
+                              "-c fsync=off -c synchronous_commit=off -c full_page_writes=off",
+                        "start"],
+                       check=True, capture_output=True)
+        return self
+
+    def stop(self):
+
+        if self.data_dir is None:
+            return
+
+        subprocess.run([self._bin("pg_ctl"), "-D", self.data_dir, "-m", "fast", "stop"], capture_output=True)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+        self.data_dir = None
+
+def _percentile(sorted_samples: List[float], q: float) -> float:
+
+    index = min(len(sorted_samples) - 1, max(0, round(q * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+def measure(operation: Callable[[], object], iterations: int, warmup: int) -> Dict:
+
+    for _ in range(warmup):
+        operation()
+
+    samples = []
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        call_started_at = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - call_started_at)
+    elapsed = time.perf_counter() - started_at
+
+    samples.sort()
+    return {"iterations": iterations,
+            "ops_per_second": iterations / elapsed,
+            "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": _percentile(samples, 0.50) * 1000,
+            "p99_ms": _percentile(samples, 0.99) * 1000}
+
+def seed(robots_repo: RobotsRepo, user_repo: UserRepo, fleet_size: int):
+
+    robots_repo.bulk_load_robot_infos(RobotInfo(robot_id=f"bench-smr{i:07d}", robot_name=f"{i}")
+                                      for i in range(fleet_size))
+    robots_repo.bulk_load_robot_states(RobotState(robot_id=f"bench-smr{i:07d}",
+                                                  map_uuid="bench-map",
+                                                  position_x=float(i),
+                                                  position_y=float(-i),
+                                                  position_theta=0.0) for i in range(fleet_size))
+
+    user_repo.register_many(User(id=i, name=f"bench{i}", username=f"bench{i}") for i in range(fleet_size))
+    user_repo.upsert_addresses(Address(id=i * 2 + j, address=f"address {j}", user_id=i)
+                               for i in range(fleet_size) for j in range(2))
+
+def run(robots_repo: RobotsRepo, user_repo: UserRepo, fleet_size: int, args: argparse.Namespace) -> List[Dict]:
+
+    seed(robots_repo, user_repo, fleet_size)
+
+    rng = random.Random(fleet_size)
+
+    def robot_id() -> str:
+        return f"bench-smr{rng.randrange(fleet_size):07d}"
+
+    def robot_state() -> RobotState:
+        return RobotState(robot_id=robot_id(),
+                          map_uuid="bench-map",
+                          position_x=rng.random() * 100,
+                          position_y=rng.random() * 100,
+                          position_theta=rng.random())
+
+    def upsert_batch() -> List[RobotState]:
+        # one pose per robot, ON CONFLICT cannot update a row twice in one statement
+        return list({state.robot_id: state for state in (robot_state() for _ in range(args.batch_size))}.values())
+
+    operations = {
+        "register": lambda: robots_repo.register([RobotInfo(robot_id=robot_id(), robot_name="bench")]),
+        "upsert_robot_states": lambda: robots_repo.upsert_robot_states(upsert_batch()),
+        "fetch_robot_states": lambda: robots_repo.fetch_robot_states(),
+        "fetch_robot_name": lambda: robots_repo.fetch_robot_name([robot_id() for _ in range(10)]),
+        "fetch_user_address": lambda: user_repo.fetch_user_address(id=rng.randrange(fleet_size)),
+    }
+
+    results = []
+    for name, operation in operations.items():
+        result = {"fleet_size": fleet_size, "operation": name, **measure(operation, args.iterations, args.warmup)}
+        results.append(result)
+
+        print("fleet={:<8} {:<20} ops/s={:>10.1f} p50={:>8.2f}ms p99={:>8.2f}ms".format(
+            fleet_size, name, result["ops_per_second"], result["p50_ms"], result["p99_ms"]))
+
+    return results
+
+def compare(results: List[Dict], baseline_path: str):
+
+    with open(baseline_path) as f:
+        baseline = {(row["fleet_size"], row["operation"]): row for row in json.load(f)["results"]}
+
+    for row in results:
+        previous = baseline.get((row["fleet_size"], row["operation"]))
+        if previous is None:
+            continue
+
+        print("fleet={:<8} {:<20} p50 {:>+7.1%} p99 {:>+7.1%}".format(
+            row["fleet_size"], row["operation"],
+            row["p50_ms"] / previous["p50_ms"] - 1,
+            row["p99_ms"] / previous["p99_ms"] - 1))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fleet-sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--pg-bin", default=None, help="directory of initdb/pg_ctl, default PATH")
+    parser.add_argument("--host", action="store_true", help="use the server in settings instead of a throwaway one")
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    parser.add_argument("--baseline", default=None, help="JSON of a previous run to compare with")
+    args = parser.parse_args()
+
+    local_postgres = None if args.host else LocalPostgres(args.pg_bin).start()
+    try:
+        pg_engine = connect_to_postgres(
+            host="127.0.0.1" if local_postgres else settings.host,
+            port=local_postgres.port if local_postgres else settings.port,
+            db_name=settings.db_name,
+            user=settings.user,
+            password=settings.password
+        )
+
+        setup_robots_repo(logger=structlog.get_logger(), engine=pg_engine)
+        robots_repo = RobotsRepo(logger=structlog.get_logger(), engine=pg_engine, name_cache_size=0)
+        user_repo = setup_user_repo(logger=structlog.get_logger(), engine=pg_engine)
+
+        with pg_engine.connect() as conn:
+            server_version = conn.execute(text("SHOW server_version")).scalar()
+
+        results = []
+        for fleet_size in sorted(args.fleet_sizes):
+            results.extend(run(robots_repo, user_repo, fleet_size, args))
+
+        pg_engine.dispose()
+    finally:
+        if local_postgres is not None:
+            local_postgres.stop()
+
+    report = {"meta": {"created_at": datetime.now(timezone.utc).isoformat(),
+                       "python": sys.version.split()[0],
+                       "platform": platform.platform(),
+                       "sqlalchemy": sqlalchemy.__version__,
+                       "postgres": server_version,
+                       "throwaway_server": local_postgres is not None,
+                       "iterations": args.iterations,
+                       "batch_size": args.batch_size},
+              "results": results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        compare(results, args.baseline)
@@ -0,0 +1,74 @@
+import time
+import argparse
+
+import structlog
+
+from config.settings import settings
+from helpers.postgres_helpers import connect_to_postgres
+from repository.robots.robots import (
+    RobotsRepo,
+    RobotInfo,
+    RobotState,
+    ResultMode,
+    _convert_robot_states,
+    setup_robots_repo
+)
+
+'''
+    NOTE:
+    Rows per second of every fetch_robot_states result mode.
+
+    "convert" only measures building the output objects from already fetched rows,
+    "fetch" is the end-to-end fetch_robot_states call including the query.
+
+    usage:
+        PYTHONPATH=. python benchmarks/result_mode_benchmark.py --robots 10000 100000
+'''
+
+def seed(robots_repo: RobotsRepo, robots: int):
+
+    robots_repo.bulk_load_robot_infos(RobotInfo(robot_id=f"bench-smr{i:07d}", robot_name=f"{i}") for i in range(robots))
+    robots_repo.bulk_load_robot_states(RobotState(robot_id=f"bench-smr{i:07d}",
+                                                  map_uuid="bench-map",
+                                                  position_x=float(i),
+                                                  position_y=float(-i),
+                                                  position_theta=0.0) for i in range(robots))
+
+def run(robots_repo: RobotsRepo, robots: int, repeat: int):
+
+    rows = [tuple(row) for row in robots_repo.iter_robot_states()]
+
+    for result_mode in ResultMode:
+        started_at = time.perf_counter()
+        for _ in range(repeat):
+            _convert_robot_states(rows, result_mode)
+        convert_rows_per_second = len(rows) * repeat / (time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        for _ in range(repeat):
+            robots_repo.fetch_robot_states(result_mode=result_mode)
+        fetch_rows_per_second = len(rows) * repeat / (time.perf_counter() - started_at)
+
+        print("robots={:<8} mode={:<10} convert rows/s={:>12.0f} fetch rows/s={:>12.0f}".format(
+            len(rows), result_mode.value, convert_rows_per_second, fetch_rows_per_second))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--robots", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pg_engine = connect_to_postgres(
+        host=settings.host,
+        port=settings.port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password
+    )
+
+    robots_repo = setup_robots_repo(logger=structlog.get_logger(), engine=pg_engine)
+
+    for robots in sorted(args.robots):
+        seed(robots_repo, robots)
+        run(robots_repo, robots, args.repeat)
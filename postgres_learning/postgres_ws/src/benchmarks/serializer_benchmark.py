@@ -0,0 +1,87 @@
+import time
+import argparse
+
+from typing import (
+    Callable,
+    List
+)
+
+from pydantic import TypeAdapter
+
+from repository.robots.robots import LatestRobotState
+from repository.robots.serializer import (
+    encode,
+    decode,
+    decode_latest_robot_states
+)
+
+'''
+    NOTE:
+    Payload size and encode/decode throughput of a LatestRobotState list.
+
+        model_dump_json    "[" + ",".join(model_dump_json()) + "]", one call per model
+        type_adapter       TypeAdapter(List[LatestRobotState]).dump_json / validate_json
+        frame              repository/robots/serializer.py encode / decode (columns)
+        frame+models       encode / decode_latest_robot_states, back to LatestRobotState
+
+    No database is needed, the fleet is generated.
+
+    usage:
+        PYTHONPATH=. python benchmarks/serializer_benchmark.py --robots 1000 10000 100000
+'''
+
+_FLEET_ADAPTER = TypeAdapter(List[LatestRobotState])
+
+def fleet(robots: int) -> List[LatestRobotState]:
+
+    return [LatestRobotState(robot_id=f"bench-smr{i:07d}",
+                             robot_name=f"{i}",
+                             map_uuid=f"bench-map-{i % 8}",
+                             position_x=i * 0.5,
+                             position_y=-i * 0.25,
+                             position_theta=(i % 628) / 100) for i in range(robots)]
+
+def best_of(func: Callable[[], object], repeat: int) -> float:
+
+    best = float("inf")
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+def run(robots: int, repeat: int):
+
+    robot_states = fleet(robots)
+
+    def dump_models() -> bytes:
+        return ("[" + ",".join(robot_state.model_dump_json() for robot_state in robot_states) + "]").encode()
+
+    json_payload = dump_models()
+    frame = encode(robot_states)
+
+    cases = {
+        "model_dump_json": (dump_models, lambda: _FLEET_ADAPTER.validate_json(json_payload), len(json_payload)),
+        "type_adapter": (lambda: _FLEET_ADAPTER.dump_json(robot_states),
+                         lambda: _FLEET_ADAPTER.validate_json(json_payload),
+                         len(_FLEET_ADAPTER.dump_json(robot_states))),
+        "frame": (lambda: encode(robot_states), lambda: decode(frame), len(frame)),
+        "frame+models": (lambda: encode(robot_states), lambda: decode_latest_robot_states(frame), len(frame)),
+    }
+
+    for name, (encoder, decoder, size) in cases.items():
+        encode_seconds = best_of(encoder, repeat)
+        decode_seconds = best_of(decoder, repeat)
+
+        print("robots={:<8} {:<16} bytes={:>10} ({:>5.1f} B/robot) encode rows/s={:>12.0f} decode rows/s={:>12.0f}".format(
+            robots, name, size, size / robots, robots / encode_seconds, robots / decode_seconds))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--robots", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for robots in sorted(args.robots):
+        run(robots, args.repeat)
@@ -0,0 +1,103 @@
+import gc
+import time
+import argparse
+import tracemalloc
+
+from collections import deque
+
+from typing import (
+    Callable,
+    Dict,
+    List
+)
+
+from repository.robots.telemetry import TelemetryStore
+
+'''
+    NOTE:
+    Memory footprint and speed of TelemetryStore against a dict of deque(maxlen=window)
+    of (recorded_at, x, y, theta) tuples, the plain collections.deque approach.
+
+    Both are filled with robots * window reports (every robot reports once per round),
+    memory is what tracemalloc sees allocated after the fill. Append is timed per report,
+    window reads for the whole window of one robot, as an array for TelemetryStore and as
+    a list for the deques.
+
+    No database is needed.
+
+    usage:
+        PYTHONPATH=. python benchmarks/telemetry_benchmark.py --robots 10000 --window 600
+'''
+
+def reports(robots: int, round_index: int) -> List[Dict]:
+
+    return [{"robot_id": f"bench-smr{i:07d}",
+             "map_uuid": "bench-map",
+             "position_x": i + round_index * 0.01,
+             "position_y": -i - round_index * 0.01,
+             "position_theta": round_index * 0.001} for i in range(robots)]
+
+def fill(append_rows: Callable[[List[Dict], float], None], robots: int, window: int) -> float:
+    '''
+        seconds spent in append_rows, building the reports is not counted.
+    '''
+    seconds = 0.0
+    for round_index in range(window):
+        rows = reports(robots, round_index)
+        started_at = time.perf_counter()
+        append_rows(rows, float(round_index))
+        seconds += time.perf_counter() - started_at
+    return seconds
+
+def measure(name: str, build: Callable[[], object], append_rows_of, window_of, robots: int, window: int):
+
+    gc.collect()
+    tracemalloc.start()
+    store = build()
+    append_seconds = fill(append_rows_of(store), robots, window)
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    read = window_of(store)
+    started_at = time.perf_counter()
+    for i in range(robots):
+        read(f"bench-smr{i:07d}")
+    read_seconds = time.perf_counter() - started_at
+
+    print("{:<10} robots={} window={} memory={:>9.1f} MB ({:>6.1f} B/sample) "
+          "append={:>10.0f} reports/s window read={:>8.2f} us".format(
+              name, robots, window, allocated / 2**20, allocated / (robots * window),
+              robots * window / append_seconds, read_seconds / robots * 1e6))
+
+def _deque_append_rows(deques: Dict[str, deque], window: int):
+
+    def append_rows(rows: List[Dict], recorded_at: float):
+        for row in rows:
+            samples = deques.get(row["robot_id"])
+            if samples is None:
+                samples = deques[row["robot_id"]] = deque(maxlen=window)
+            samples.append((recorded_at, row["position_x"], row["position_y"], row["position_theta"]))
+
+    return append_rows
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--robots", type=int, default=10_000)
+    parser.add_argument("--window", type=int, default=600)
+    parser.add_argument("--skip-deque", action="store_true", help="the deque baseline needs about 900 MB at the defaults")
+    args = parser.parse_args()
+
+    measure("telemetry",
+            lambda: TelemetryStore(window=args.window, max_robots=args.robots),
+            lambda store: store.append_rows,
+            lambda store: store.window_of,
+            args.robots, args.window)
+
+    if not args.skip_deque:
+        measure("deque",
+                dict,
+                lambda deques: _deque_append_rows(deques, args.window),
+                lambda deques: lambda robot_id: list(deques[robot_id]),
+                args.robots, args.window)
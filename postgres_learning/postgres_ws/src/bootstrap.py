@@ -0,0 +1,58 @@
+import argparse
+
+import structlog
+
+from config.settings import settings
+from helpers.postgres_helpers import connect_to_postgres
+from repository.robots.robots import setup_robots_repo
+from repository.robots.history import setup_robot_state_history_repo
+from repository.robots.change_feed import install_robot_states_notify_trigger
+from repository.user.user import setup_user_repo
+
+'''
+    NOTE:
+    One-off bootstrap of the database, run it once per deployment (and after schema changes):
+
+    1. create the database and set its default timezone.
+    2. create tables, indexes and robot_state_history partitions.
+    3. optionally install the robot_states NOTIFY trigger of the change feed.
+
+    Runtime processes can then start without any DDL or catalog query:
+
+        pg_engine = connect_to_postgres(..., bootstrap=False)
+        robots_repo = setup_robots_repo(logger, pg_engine, create_tables=False)
+
+    usage:
+        PYTHONPATH=. python bootstrap.py [--history] [--change-feed]
+'''
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", action="store_true", help="create robot_state_history and its partitions")
+    parser.add_argument("--change-feed", action="store_true", help="install the robot_states NOTIFY trigger")
+    args = parser.parse_args()
+
+    LOGGER = structlog.get_logger()
+
+    pg_engine = connect_to_postgres(
+        host=settings.host,
+        port=settings.port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password,
+        bootstrap=True
+    )
+
+    setup_robots_repo(logger=LOGGER, engine=pg_engine)
+    setup_user_repo(logger=LOGGER, engine=pg_engine)
+
+    if args.history:
+        setup_robot_state_history_repo(logger=LOGGER, engine=pg_engine)
+
+    if args.change_feed:
+        install_robot_states_notify_trigger(pg_engine)
+
+    LOGGER.info("database bootstrapped", db_name=settings.db_name)
+
+    pg_engine.dispose()
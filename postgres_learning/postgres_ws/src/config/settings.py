@@ -7,5 +7,14 @@ class SETTINGS:
     db_name: str = "test_db"
     user: str = "root"
     password: str = "root"
+    timezone: str = "Asia/Taipei"
+
+    # connection pool, see helpers.postgres_helpers.connect_to_postgres
+    pool_size: int = 10
+    pool_max_overflow: int = 10
+    pool_timeout: float = 30.0
+    pool_recycle: int = 1800
+    pool_pre_ping: bool = True
+    pool_use_lifo: bool = True
 
 settings = SETTINGS()
\ No newline at end of file
@@ -0,0 +1,359 @@
+import sys
+import time
+import asyncio
+import inspect
+import functools
+import threading
+
+from collections import (
+    OrderedDict,
+    namedtuple
+)
+from dataclasses import (
+    fields,
+    is_dataclass
+)
+
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Optional
+)
+
+from pydantic import BaseModel
+
+'''
+    NOTE:
+    memoize() is functools.lru_cache for repository lookups.
+
+    1. Keys: lru_cache keys on the call as written, say(word="Hi", times=1) and
+       say(times=1, word="Hi") are two entries and unhashable arguments raise TypeError.
+       Here the call is bound to the signature with defaults applied, so every spelling
+       of the same call gives the same key, and lists, dicts, sets, dataclasses and
+       pydantic models are frozen into hashable keys.
+    2. Eviction: least recently used first, on maxsize entries and on max_bytes, the
+       summed sizeof() of the cached values. An entry older than ttl seconds is a miss.
+    3. Stampede protection: concurrent misses of one key compute it once, the other
+       callers (threads, or tasks for async functions) wait for that result. Exceptions
+       are passed to the waiters and never cached.
+
+    Like lru_cache the wrapper has cache_info() (hits, misses, maxsize, currsize),
+    cache_clear() and __wrapped__, plus cache_stats() and cache_invalidate(*args, **kwargs).
+
+    A function calling itself with the same arguments would wait for itself, don't.
+'''
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+CacheStats = namedtuple("CacheStats", ["hits",
+                                       "misses",
+                                       "maxsize",
+                                       "currsize",
+                                       "evictions",
+                                       "expirations",
+                                       "waits",
+                                       "uncacheable",
+                                       "nbytes",
+                                       "max_bytes"])
+
+_MISSING = object()
+
+def deep_sizeof(value: Any, _seen: Optional[set] = None) -> int:
+    '''
+        sys.getsizeof of value and everything it holds, objects shared inside value count once.
+    '''
+    seen = set() if _seen is None else _seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in value)
+    elif hasattr(value, "__dict__") and not isinstance(value, type):
+        size += deep_sizeof(vars(value), seen)
+    return size
+
+def freeze(value: Any) -> Hashable:
+    '''
+        hashable, equality preserving form of value, TypeError if there is none.
+    '''
+    if value is None or isinstance(value, (str, bytes, int, float, bool)):
+        return value
+    if isinstance(value, BaseModel):
+        return (type(value), freeze(value.model_dump()))
+    if isinstance(value, dict):
+        return (dict, frozenset((freeze(key), freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(freeze(item) for item in value))
+    if isinstance(value, (set, frozenset)):
+        return (frozenset, frozenset(freeze(item) for item in value))
+    if is_dataclass(value) and not isinstance(value, type):
+        return (type(value), tuple(freeze(getattr(value, field.name)) for field in fields(value)))
+
+    hash(value)
+    return value
+
+class _MemoCache():
+
+    def __init__(self,
+                 maxsize: Optional[int],
+                 ttl: Optional[float],
+                 max_bytes: Optional[int],
+                 sizeof: Callable[[Any], int],
+                 timer: Callable[[], float]):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.timer = timer
+
+        # key => (value, expires_at, nbytes)
+        self._entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.waits = 0
+        self.uncacheable = 0
+
+    def get(self, key: Hashable) -> Any:
+
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > self.timer()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return _MISSING
+
+    def put(self, key: Hashable, value: Any):
+
+        if self.maxsize == 0:
+            return
+
+        nbytes = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            # would evict everything else and still not fit
+            return
+
+        expires_at = None if self.ttl is None else self.timer() + self.ttl
+
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at, nbytes)
+            self.nbytes += nbytes
+
+            while ((self.maxsize is not None and len(self._entries) > self.maxsize)
+                   or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key: Hashable):
+        self.nbytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+
+        with self.lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = self.expirations = self.waits = self.uncacheable = 0
+
+    def info(self) -> CacheInfo:
+
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def stats(self) -> CacheStats:
+
+        with self.lock:
+            return CacheStats(self.hits, self.misses, self.maxsize, len(self._entries), self.evictions,
+                              self.expirations, self.waits, self.uncacheable, self.nbytes, self.max_bytes)
+
+class _Call():
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+def memoize(maxsize: Optional[int] = 128,
+            ttl: Optional[float] = None,
+            max_bytes: Optional[int] = None,
+            sizeof: Callable[[Any], int] = deep_sizeof,
+            timer: Callable[[], float] = time.monotonic):
+    '''
+        maxsize=None means unbounded like lru_cache, ttl in seconds, max_bytes caps the
+        summed sizeof() of the cached values. Arguments which cannot be frozen are not
+        cached, the call goes straight to the function.
+    '''
+
+    def decorator(func):
+
+        cache = _MemoCache(maxsize=maxsize, ttl=ttl, max_bytes=max_bytes, sizeof=sizeof, timer=timer)
+        signature = inspect.signature(func)
+
+        def make_key(args, kwargs) -> Optional[Hashable]:
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            try:
+                return freeze(tuple(bound.arguments.items()))
+            except TypeError:
+                with cache.lock:
+                    cache.uncacheable += 1
+                return None
+
+        if asyncio.iscoroutinefunction(func):
+
+            # key => future of the task computing it, callers must share one event loop
+            inflight: Dict[Hashable, asyncio.Future] = {}
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+
+                key = make_key(args, kwargs)
+                if key is None:
+                    return await func(*args, **kwargs)
+
+                while True:
+                    value = cache.get(key)
+                    if value is not _MISSING:
+                        return value
+
+                    future = inflight.get(key)
+                    if future is None:
+                        break
+
+                    with cache.lock:
+                        cache.waits += 1
+                    try:
+                        return await asyncio.shield(future)
+                    except asyncio.CancelledError:
+                        # the computing task was cancelled, not this one: compute it here
+                        if not future.cancelled():
+                            raise
+
+                future = inflight[key] = asyncio.get_running_loop().create_future()
+                try:
+                    value = await func(*args, **kwargs)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except BaseException as e:
+                    future.set_exception(e)
+                    # mark it retrieved, nobody might be waiting
+                    future.exception()
+                    raise
+                else:
+                    cache.put(key, value)
+                    future.set_result(value)
+                    return value
+                finally:
+                    inflight.pop(key, None)
+
+            wrapper = async_wrapper
+
+        else:
+
+            inflight_lock = threading.Lock()
+            inflight: Dict[Hashable, _Call] = {}
+
+            @functools.wraps(func)
+            def sync_wrapper(*args, **kwargs):
+
+                key = make_key(args, kwargs)
+                if key is None:
+                    return func(*args, **kwargs)
+
+                with inflight_lock:
+                    value = cache.get(key)
+                    if value is not _MISSING:
+                        return value
+
+                    call = inflight.get(key)
+                    leader = call is None
+                    if leader:
+                        call = inflight[key] = _Call()
+
+                if not leader:
+                    with cache.lock:
+                        cache.waits += 1
+                    call.done.wait()
+                    if call.error is not None:
+                        raise call.error
+                    return call.value
+
+                try:
+                    call.value = func(*args, **kwargs)
+                    cache.put(key, call.value)
+                    return call.value
+                except BaseException as e:
+                    call.error = e
+                    raise
+                finally:
+                    with inflight_lock:
+                        inflight.pop(key, None)
+                    call.done.set()
+
+            wrapper = sync_wrapper
+
+        def cache_invalidate(*args, **kwargs):
+
+            key = make_key(args, kwargs)
+            if key is not None:
+                cache.invalidate(key)
+
+        wrapper.cache_info = cache.info
+        wrapper.cache_stats = cache.stats
+        wrapper.cache_clear = cache.clear
+        wrapper.cache_invalidate = cache_invalidate
+        return wrapper
+
+    return decorator
+
+if __name__ == "__main__":
+
+    import structlog
+
+    logger = structlog.get_logger()
+
+    @memoize(maxsize=32, ttl=60.0)
+    def say(word: str, times: int = 1, end: str = "\n") -> str:
+        return (word + end) * times
+
+    # the two calls from functools-learning/lru_cache.py share one entry
+    say(word="Hi", times=1, end="\n")
+    say(word="Hi", end="\n", times=1)
+    say("Hi")
+    logger.info(say.cache_info())
+    # cache_info => CacheInfo(hits=2, misses=1, maxsize=32, currsize=1)
+
+    @memoize(max_bytes=1024)
+    def total(values: list) -> int:
+        return sum(values)
+
+    # unhashable for lru_cache, frozen here
+    total([1, 2, 3])
+    total([1, 2, 3])
+    logger.info(total.cache_stats())
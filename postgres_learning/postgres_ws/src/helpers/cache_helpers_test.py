@@ -0,0 +1,103 @@
+import time
+import asyncio
+import threading
+
+import pytest
+from assertpy import assert_that
+
+from helpers.cache_helpers import (
+    CacheInfo,
+    memoize
+)
+
+class _Clock():
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_keys_are_normalised_from_the_signature():
+
+    calls = []
+
+    @memoize(maxsize=8)
+    def say(word: str, times: int = 1, tags: list = None) -> str:
+        calls.append(word)
+        return word * times
+
+    say(word="Hi", times=1, tags=["a"])
+    say(tags=["a"], times=1, word="Hi")
+    say("Hi", 1, ["a"])
+    say("Hi", tags=["b"])
+
+    assert_that(calls).is_length(2)
+    assert_that(say.cache_info()).is_equal_to(CacheInfo(hits=2, misses=2, maxsize=8, currsize=2))
+
+def test_ttl_and_byte_cap_evict_entries():
+
+    clock = _Clock()
+
+    @memoize(maxsize=None, ttl=10.0, max_bytes=200, sizeof=lambda value: 100, timer=clock)
+    def square(n: int) -> int:
+        return n * n
+
+    square(1)
+    square(2)
+    square(3)
+
+    # 3 values * 100 bytes > 200, the least recently used one is gone
+    stats = square.cache_stats()
+    assert_that((stats.currsize, stats.nbytes, stats.evictions)).is_equal_to((2, 200, 1))
+
+    clock.now = 11.0
+    square(3)
+    assert_that(square.cache_stats().expirations).is_equal_to(1)
+
+def test_concurrent_misses_compute_once():
+
+    calls = []
+    release = threading.Event()
+
+    @memoize()
+    def slow_lookup(key: str) -> str:
+        calls.append(key)
+        release.wait()
+        return key.upper()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow_lookup("smr01"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while slow_lookup.cache_stats().waits < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert_that(calls).is_length(1)
+    assert_that(results).is_equal_to(["SMR01"] * 5)
+
+def test_async_stampede_and_errors_are_not_cached():
+
+    calls = []
+
+    @memoize()
+    async def lookup(key: str) -> str:
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        if key == "bad":
+            raise KeyError(key)
+        return key.upper()
+
+    async def main():
+        results = await asyncio.gather(*[lookup("smr01") for _ in range(5)])
+        assert_that(results).is_equal_to(["SMR01"] * 5)
+
+        for _ in range(2):
+            with pytest.raises(KeyError):
+                await lookup("bad")
+
+    asyncio.run(main())
+    assert_that(calls).is_equal_to(["smr01", "bad", "bad"])
@@ -0,0 +1,396 @@
+import re
+import time
+import bisect
+import asyncio
+import functools
+import threading
+
+import structlog
+
+from collections import namedtuple
+from contextvars import ContextVar
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union
+)
+
+from sqlalchemy import (
+    Engine,
+    event
+)
+from sqlalchemy.engine.default import (
+    CACHE_HIT,
+    CACHE_MISS
+)
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+'''
+    NOTE:
+    Repository method labels
+
+    @repository_method("RobotsRepo.register") stores the method name in a ContextVar while
+    the method runs, engine event listeners read it with current_repository_method() to
+    attribute every statement to the repository method which sent it. ContextVar is per
+    thread and per asyncio task, so concurrent callers do not mix up their labels.
+
+    Compiled cache
+
+    SQLAlchemy caches the compiled SQL of a statement by its structure. A statement whose
+    shape depends on the data, e.g. insert().values(rows) with a different number of rows,
+    misses the cache and is compiled again on every call. CompileCacheStats counts
+    hits/misses of every repository method from ExecutionContext.cache_hit.
+
+    Query timing
+
+    QueryInstrumentation times every cursor execution (before/after_cursor_execute) and
+    every call of a labelled repository method, keeps latency histograms per method and
+    per statement fingerprint, and logs queries slower than slow_query_threshold. A failed
+    statement (handle_error) is timed and counted in query_errors/errors as well.
+
+    Nothing is attached by default. While no instrumentation is attached the label
+    decorator only checks one module level list and calls the method directly.
+'''
+
+_repository_method: ContextVar[Optional[str]] = ContextVar("repository_method", default=None)
+
+def current_repository_method() -> Optional[str]:
+    return _repository_method.get()
+
+# attached CompileCacheStats/QueryInstrumentation, empty means instrumentation is off
+_observers: List = []
+
+def repository_method(name: str):
+
+    def decorator(func):
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _observers:
+                    return await func(*args, **kwargs)
+
+                token = _repository_method.set(name)
+                started_at = time.perf_counter()
+                failed = True
+                try:
+                    result = await func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    _repository_method.reset(token)
+                    _observe_method(name, time.perf_counter() - started_at, failed)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _observers:
+                return func(*args, **kwargs)
+
+            token = _repository_method.set(name)
+            started_at = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _repository_method.reset(token)
+                _observe_method(name, time.perf_counter() - started_at, failed)
+        return wrapper
+
+    return decorator
+
+def _observe_method(name: str, seconds: float, failed: bool):
+
+    for observer in _observers:
+        observer.observe_method(name, seconds, failed)
+
+CompileCacheInfo = namedtuple("CompileCacheInfo", ["hits", "misses", "uncached", "hit_rate"])
+
+class CompileCacheStats():
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+
+        # repository method => [hits, misses, uncached]
+        self._counts: Dict[str, list] = {}
+
+    def attach(self, engine: Union[Engine, AsyncEngine]) -> "CompileCacheStats":
+
+        event.listen(getattr(engine, "sync_engine", engine), "after_execute", self._after_execute)
+        _observers.append(self)
+        return self
+
+    def detach(self, engine: Union[Engine, AsyncEngine]):
+
+        event.remove(getattr(engine, "sync_engine", engine), "after_execute", self._after_execute)
+        _observers.remove(self)
+
+    def observe_method(self, name: str, seconds: float, failed: bool):
+        pass
+
+    def _after_execute(self, conn, clauseelement, multiparams, params, execution_options, result):
+
+        context = getattr(result, "context", None)
+        if context is None:
+            return
+
+        if context.cache_hit is CACHE_HIT:
+            slot = 0
+        elif context.cache_hit is CACHE_MISS:
+            slot = 1
+        else:
+            # exec_driver_sql, DDL, caching disabled
+            slot = 2
+
+        method = current_repository_method() or "-"
+        with self._lock:
+            self._counts.setdefault(method, [0, 0, 0])[slot] += 1
+
+    def info(self) -> Dict[str, CompileCacheInfo]:
+
+        with self._lock:
+            return {method: CompileCacheInfo(hits, misses, uncached,
+                                             hits / (hits + misses) if hits + misses else 0.0)
+                    for method, (hits, misses, uncached) in self._counts.items()}
+
+    def reset(self):
+
+        with self._lock:
+            self._counts.clear()
+
+# upper bounds in milliseconds, the last bucket is everything slower
+_BUCKETS_MS: Tuple[float, ...] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class LatencyHistogram():
+
+    def __init__(self):
+
+        self.counts = [0] * (len(_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+
+        milliseconds = seconds * 1000
+        self.counts[bisect.bisect_left(_BUCKETS_MS, milliseconds)] += 1
+        self.count += 1
+        self.total_ms += milliseconds
+        self.max_ms = max(self.max_ms, milliseconds)
+
+    def percentile(self, q: float) -> float:
+        '''
+            upper bound of the bucket holding the q-th sample, max_ms for the last bucket.
+        '''
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return _BUCKETS_MS[index] if index < len(_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def dump(self) -> Dict:
+
+        return {"count": self.count,
+                "total_ms": self.total_ms,
+                "mean_ms": self.total_ms / self.count if self.count else 0.0,
+                "max_ms": self.max_ms,
+                "p50_ms": self.percentile(0.50),
+                "p99_ms": self.percentile(0.99),
+                "buckets_ms": {("le_{}".format(bound) if index < len(_BUCKETS_MS) else "inf"): self.counts[index]
+                               for index, bound in enumerate(_BUCKETS_MS + (None,))}}
+
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|\$\d+|\?|\b\d+(\.\d+)?\b|'(?:[^']|'')*'")
+_PLACEHOLDER_LIST = re.compile(r"\?(\s*,\s*\?)+")
+_WHITESPACE = re.compile(r"\s+")
+
+def fingerprint(statement: str) -> str:
+    '''
+        statement with parameters, literals and IN lists collapsed to ?, e.g.
+        "SELECT a FROM t WHERE id IN (%(id_1_1)s, %(id_1_2)s)" => "SELECT a FROM t WHERE id IN (?)"
+    '''
+    statement = _PLACEHOLDER.sub("?", statement)
+    statement = _PLACEHOLDER_LIST.sub("?", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+class _MethodStats():
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.queries = 0
+        self.query_errors = 0
+        self.rows = 0
+
+class _StatementStats():
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.rows = 0
+        self.errors = 0
+        self.methods = set()
+
+class QueryInstrumentation():
+
+    def __init__(self,
+                 logger: structlog.stdlib.BoundLogger,
+                 slow_query_threshold: float = 0.1,
+                 max_fingerprints: int = 1000):
+
+        self.logger = logger
+        self.slow_query_threshold = slow_query_threshold
+        self.max_fingerprints = max_fingerprints
+
+        self._lock = threading.Lock()
+        self._methods: Dict[str, _MethodStats] = {}
+        self._statements: Dict[str, _StatementStats] = {}
+
+        # raw statement => fingerprint, the regexes only run once per distinct statement
+        self._fingerprints: Dict[str, str] = {}
+
+    def attach(self, engine: Union[Engine, AsyncEngine]) -> "QueryInstrumentation":
+
+        sync_engine = getattr(engine, "sync_engine", engine)
+        event.listen(sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(sync_engine, "handle_error", self._handle_error)
+        _observers.append(self)
+        return self
+
+    def detach(self, engine: Union[Engine, AsyncEngine]):
+
+        sync_engine = getattr(engine, "sync_engine", engine)
+        event.remove(sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        event.remove(sync_engine, "handle_error", self._handle_error)
+        _observers.remove(self)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started_at", []).append((statement, time.perf_counter()))
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+
+        started_at = conn.info.get("query_started_at")
+        if not started_at:
+            # attached while the statement was running
+            return
+
+        seconds = time.perf_counter() - started_at.pop()[1]
+        rows = max(getattr(cursor, "rowcount", -1) or 0, 0)
+        self._observe_statement(statement, seconds, rows, executemany, failed=False)
+
+    def _handle_error(self, exception_context):
+        '''
+            after_cursor_execute does not run for a failed statement, pop its start here or
+            the list of the pooled connection grows for good.
+        '''
+        conn = exception_context.connection
+        started_at = conn.info.get("query_started_at") if conn is not None else None
+
+        # errors before the cursor execution (compile, connect) have no start entry
+        if not started_at or started_at[-1][0] != exception_context.statement:
+            return
+
+        seconds = time.perf_counter() - started_at.pop()[1]
+        self._observe_statement(exception_context.statement, seconds, 0, False, failed=True)
+
+    def _observe_statement(self, statement: str, seconds: float, rows: int, executemany: bool, failed: bool):
+
+        method = current_repository_method() or "-"
+
+        statement_fingerprint = self._fingerprints.get(statement)
+        if statement_fingerprint is None:
+            statement_fingerprint = fingerprint(statement)
+            if len(self._fingerprints) < self.max_fingerprints:
+                self._fingerprints[statement] = statement_fingerprint
+
+        with self._lock:
+            method_stats = self._methods.get(method)
+            if method_stats is None:
+                method_stats = self._methods[method] = _MethodStats()
+            method_stats.queries += 1
+            method_stats.rows += rows
+            if failed:
+                method_stats.query_errors += 1
+
+            statement_stats = self._statements.get(statement_fingerprint)
+            if statement_stats is None and len(self._statements) < self.max_fingerprints:
+                statement_stats = self._statements[statement_fingerprint] = _StatementStats()
+            if statement_stats is not None:
+                statement_stats.latency.observe(seconds)
+                statement_stats.rows += rows
+                statement_stats.methods.add(method)
+                if failed:
+                    statement_stats.errors += 1
+
+        if seconds >= self.slow_query_threshold:
+            self.logger.warning("slow query",
+                                method=method,
+                                duration_ms=round(seconds * 1000, 3),
+                                rows=rows,
+                                executemany=executemany,
+                                statement=statement_fingerprint)
+
+    def observe_method(self, name: str, seconds: float, failed: bool):
+
+        with self._lock:
+            method_stats = self._methods.get(name)
+            if method_stats is None:
+                method_stats = self._methods[name] = _MethodStats()
+            method_stats.latency.observe(seconds)
+            if failed:
+                method_stats.errors += 1
+
+    def dump(self) -> Dict:
+        '''
+            snapshot of all histograms, {"methods": {...}, "statements": {...}}.
+        '''
+        with self._lock:
+            return {"methods": {name: {**stats.latency.dump(),
+                                       "errors": stats.errors,
+                                       "queries": stats.queries,
+                                       "query_errors": stats.query_errors,
+                                       "rows": stats.rows}
+                                for name, stats in self._methods.items()},
+                    "statements": {statement: {**stats.latency.dump(),
+                                               "rows": stats.rows,
+                                               "errors": stats.errors,
+                                               "methods": sorted(stats.methods)}
+                                   for statement, stats in self._statements.items()}}
+
+    def log_summary(self):
+
+        for name, stats in self.dump()["methods"].items():
+            self.logger.info("repository method latency",
+                             method=name,
+                             calls=stats["count"],
+                             errors=stats["errors"],
+                             queries=stats["queries"],
+                             query_errors=stats["query_errors"],
+                             rows=stats["rows"],
+                             p50_ms=stats["p50_ms"],
+                             p99_ms=stats["p99_ms"],
+                             max_ms=round(stats["max_ms"], 3))
+
+    def reset(self):
+
+        with self._lock:
+            self._methods.clear()
+            self._statements.clear()
+
+
+def setup_query_instrumentation(logger: structlog.stdlib.BoundLogger,
+                                engine: Union[Engine, AsyncEngine],
+                                slow_query_threshold: float = 0.1) -> QueryInstrumentation:
+
+    return QueryInstrumentation(logger=logger, slow_query_threshold=slow_query_threshold).attach(engine)
@@ -1,9 +1,39 @@
+import time
+import threading
+
+from collections import namedtuple
+
 from sqlalchemy import (
     Engine, 
+    Table,
+    TextClause,
     text,
+    event,
     create_engine, 
 )
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import (
+    QueuePool,
+    AsyncAdaptedQueuePool
+)
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    create_async_engine
+)
+
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Union
+)
+
+from config.settings import settings
 
 from sqlalchemy_utils import (
     create_database, 
@@ -29,22 +59,313 @@ def _execute(engine: Engine, sql: str, raise_error: bool = True):
             # print(">>> ", repr(e))
 
 
+'''
+    NOTE:
+    COPY FROM STDIN streams rows to the server in PostgreSQL text format:
+    one line per row, columns separated by tab and NULL written as \\N.
+    Backslash, tab and newline inside a value have to be escaped.
+
+    _CopyStream is a file-like object so that psycopg2 copy_expert can pull
+    lines lazily from an iterator, the rows never have to exist in memory at once.
+'''
+
+def _copy_value(value: Any) -> str:
+
+    if value is None:
+        return "\\N"
+
+    return (str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r"))
+
+
+class _CopyStream():
+
+    def __init__(self, lines: Iterator[str]):
+        self._lines = lines
+        self._buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line.encode()
+
+        if size < 0:
+            size = len(self._buffer)
+
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.read(size)
+
+
+def copy_rows(cursor, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]]):
+    '''
+        stream rows into table with COPY FROM STDIN through a psycopg2 cursor.
+    '''
+    lines = ("\t".join(_copy_value(value) for value in row) + "\n" for row in rows)
+
+    cursor.copy_expert(
+        "COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)),
+        _CopyStream(lines))
+
+
+'''
+    NOTE:
+    Fixed-shape upsert
+
+    insert(...).values(rows) produces different SQL for every number of rows, and the
+    PostgreSQL insert construct (ON CONFLICT) is never stored in the SQLAlchemy compiled
+    cache at all, so every upsert was compiled from scratch.
+
+    upsert_unnest_stmt binds every column as one array parameter:
+
+        INSERT INTO t (a, b) SELECT * FROM unnest(CAST(:a AS VARCHAR[]), CAST(:b AS FLOAT[]))
+        ON CONFLICT (a) DO UPDATE SET b = EXCLUDED.b
+
+    The SQL text is the same for 1 or 10000 rows, so it is compiled once per engine and
+    asyncpg can reuse its server-side prepared statement. Rows are sent in one statement
+    and one round trip.
+'''
+
+def upsert_unnest_stmt(table: Table, where: Optional[str] = None, returning: Optional[str] = None) -> TextClause:
+    '''
+        where is an optional ON CONFLICT DO UPDATE ... WHERE condition, existing rows for
+        which it is false are left untouched (no new row version, no WAL).
+        returning is an optional RETURNING list, only inserted or updated rows are returned.
+    '''
+    columns = [column.name for column in table.columns]
+    primary_keys = [column.name for column in table.primary_key]
+    arrays = ", ".join("CAST(:{} AS {}[])".format(column.name, column.type.compile(dialect=postgresql.dialect()))
+                       for column in table.columns)
+    updates = ", ".join("{0} = EXCLUDED.{0}".format(column) for column in columns if column not in primary_keys)
+
+    return text("INSERT INTO {table} ({columns}) SELECT * FROM unnest({arrays}) "
+                "ON CONFLICT ({keys}) DO UPDATE SET {updates}{where}{returning}".format(
+                    table=table.name,
+                    columns=", ".join(columns),
+                    arrays=arrays,
+                    keys=", ".join(primary_keys),
+                    updates=updates,
+                    where="" if where is None else " WHERE " + where,
+                    returning="" if returning is None else " RETURNING " + returning))
+
+def unnest_params(table: Table, rows: Sequence[Dict]) -> Dict[str, list]:
+    '''
+        column-wise parameters of upsert_unnest_stmt, rows are dicts keyed by column name.
+    '''
+    return {column.name: [row[column.name] for row in rows] for column in table.columns}
+
+
+'''
+    NOTE:
+    Connection pool
+
+    1. pool_size connections are kept open, up to max_overflow more are opened under
+       bursts and closed again on checkin.
+    2. pool_timeout is how long a checkout waits for a free connection before raising.
+    3. pool_recycle replaces connections older than it, pool_pre_ping tests a connection
+       on checkout, so connections broken by a failover are replaced instead of failing
+       the first query.
+    4. pool_use_lifo reuses the most recently returned connection, idle connections stay
+       idle and can be recycled by the server.
+
+    The pools below count checkouts and the time spent waiting for a connection, call
+    pool_stats(engine) to read them. They only wrap the public Pool.connect() and listen
+    to pool events, no private pool method is overridden. The wait is the whole
+    checkout: waiting for a free connection, opening a new one and pool_pre_ping.
+    Pool.recreate() (engine.dispose()) copies the event listeners into the new pool, the
+    listeners bound to the old pool are removed first, the new pool registers its own.
+'''
+
+PoolStats = namedtuple("PoolStats", ["size",
+                                     "checked_out",
+                                     "overflow",
+                                     "checkouts",
+                                     "connects",
+                                     "invalidations",
+                                     "timeouts",
+                                     "wait_total",
+                                     "wait_max"])
+
+class _InstrumentedPoolMixin():
+
+    def _init_metrics(self):
+
+        self._metrics_lock = threading.Lock()
+        self._checkouts = 0
+        self._connects = 0
+        self._invalidations = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        event.listen(self, "connect", self._on_connect)
+        event.listen(self, "invalidate", self._on_invalidate)
+
+    def recreate(self):
+
+        # otherwise every engine.dispose() adds another set of listeners to the new pool
+        event.remove(self, "connect", self._on_connect)
+        event.remove(self, "invalidate", self._on_invalidate)
+        return super().recreate()
+
+    def connect(self):
+
+        started_at = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            with self._metrics_lock:
+                self._timeouts += 1
+            raise
+
+        wait = time.perf_counter() - started_at
+        with self._metrics_lock:
+            self._checkouts += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        return connection
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._metrics_lock:
+            self._connects += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._metrics_lock:
+            self._invalidations += 1
+
+    def stats(self) -> PoolStats:
+
+        with self._metrics_lock:
+            return PoolStats(size=self.size(),
+                             checked_out=self.checkedout(),
+                             overflow=max(self.overflow(), 0),
+                             checkouts=self._checkouts,
+                             connects=self._connects,
+                             invalidations=self._invalidations,
+                             timeouts=self._timeouts,
+                             wait_total=self._wait_total,
+                             wait_max=self._wait_max)
+
+class InstrumentedQueuePool(_InstrumentedPoolMixin, QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._init_metrics()
+
+class InstrumentedAsyncAdaptedQueuePool(_InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._init_metrics()
+
+def pool_stats(engine: Union[Engine, AsyncEngine]) -> PoolStats:
+    '''
+        live metrics of the engine pool, they restart from zero after engine.dispose().
+    '''
+    return engine.pool.stats()
+
+def _pool_options(pool_options: Optional[Dict] = None) -> Dict:
+
+    options = {"pool_size": settings.pool_size,
+               "max_overflow": settings.pool_max_overflow,
+               "pool_timeout": settings.pool_timeout,
+               "pool_recycle": settings.pool_recycle,
+               "pool_pre_ping": settings.pool_pre_ping,
+               "pool_use_lifo": settings.pool_use_lifo}
+    options.update(pool_options or {})
+    return options
+
+
+'''
+    NOTE:
+    Fast start
+
+    bootstrap=True checks/creates the database and sets its default timezone, several
+    round trips which only have to happen once per deployment (see bootstrap.py).
+
+    bootstrap=False only builds the engine, nothing is sent to the server until the first
+    query. The session timezone is passed in the connection startup packet, so runtime
+    processes do not depend on ALTER DATABASE having been run.
+'''
+
 def connect_to_postgres(
     host: str,
     port: int,
     db_name: str = "test_db",
     user="root",
-    password="root"
+    password="root",
+    pool_options: Optional[Dict] = None,
+    bootstrap: bool = True
 ):
+    '''
+        pool is configured from settings, pool_options overrides single values e.g. {"pool_size": 20}.
+    '''
 
     engine = create_engine(
         f"postgresql://{user}:{password}@{host}:{port}/{db_name}",
-        pool_size=10
+        poolclass=InstrumentedQueuePool,
+        connect_args={"options": f"-c timezone={settings.timezone}"},
+        **_pool_options(pool_options)
     )
+
+    if not bootstrap:
+        return engine
     
     if not database_exists(engine.url):
         create_database(engine.url)
     
-    _execute(engine, f"ALTER DATABASE \"{db_name}\" SET timezone TO 'Asia/Taipei';")
+    _execute(engine, f"ALTER DATABASE \"{db_name}\" SET timezone TO '{settings.timezone}';")
     
+    return engine
+
+
+async def connect_to_postgres_async(
+    host: str,
+    port: int,
+    db_name: str = "test_db",
+    user="root",
+    password="root",
+    pool_options: Optional[Dict] = None,
+    bootstrap: bool = True
+) -> AsyncEngine:
+    '''
+        asyncio counterpart of connect_to_postgres, runs on asyncpg.
+
+        sqlalchemy_utils only works with sync engines, so the database is checked and
+        created through the "postgres" maintenance database instead.
+    '''
+
+    if bootstrap:
+        maintenance_engine = create_async_engine(
+            f"postgresql+asyncpg://{user}:{password}@{host}:{port}/postgres",
+            isolation_level="AUTOCOMMIT"
+        )
+
+        try:
+            async with maintenance_engine.connect() as conn:
+                exists = await conn.scalar(text("SELECT 1 FROM pg_database WHERE datname = :db_name"),
+                                           {"db_name": db_name})
+                if not exists:
+                    await conn.execute(text(f"CREATE DATABASE \"{db_name}\""))
+
+                await conn.execute(text(f"ALTER DATABASE \"{db_name}\" SET timezone TO '{settings.timezone}';"))
+        finally:
+            await maintenance_engine.dispose()
+
+    engine = create_async_engine(
+        f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{db_name}",
+        poolclass=InstrumentedAsyncAdaptedQueuePool,
+        connect_args={"server_settings": {"timezone": settings.timezone}},
+        **_pool_options(pool_options)
+    )
+
     return engine
\ No newline at end of file
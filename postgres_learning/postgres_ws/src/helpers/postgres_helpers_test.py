@@ -4,6 +4,8 @@ from assertpy import (
     fail
 )
 
+from sqlalchemy import exc
+
 from config.settings import settings
 from helpers import postgres_helpers
 
@@ -18,4 +20,57 @@ def test_pg_connectivity():
             password=settings.password,
         )
     except Exception as e:
-        fail(f"Error connecting to postgres: {str(e)}")
\ No newline at end of file
+        fail(f"Error connecting to postgres: {str(e)}")
+
+
+def test_pool_stats_count_checkouts_and_timeouts():
+
+    pg_engine = postgres_helpers.connect_to_postgres(
+        host=settings.host,
+        port=settings.port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password,
+        pool_options={"pool_size": 1, "max_overflow": 1, "pool_timeout": 0.1},
+    )
+
+    connections = [pg_engine.connect() for _ in range(2)]
+    stats = postgres_helpers.pool_stats(pg_engine)
+    assert_that((stats.size, stats.checked_out, stats.overflow)).is_equal_to((1, 2, 1))
+
+    with pytest.raises(exc.TimeoutError):
+        pg_engine.connect()
+
+    for connection in connections:
+        connection.close()
+
+    stats = postgres_helpers.pool_stats(pg_engine)
+    assert_that((stats.checked_out, stats.timeouts)).is_equal_to((0, 1))
+    assert_that(stats.wait_max).is_greater_than(0.0)
+
+    pg_engine.dispose()
+
+
+def test_pool_stats_listeners_do_not_pile_up_on_dispose():
+
+    pg_engine = postgres_helpers.connect_to_postgres(
+        host=settings.host,
+        port=settings.port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password,
+    )
+
+    with pg_engine.connect():
+        pass
+    listeners = (len(pg_engine.pool.dispatch.connect), len(pg_engine.pool.dispatch.invalidate))
+
+    for _ in range(3):
+        pg_engine.dispose()
+        with pg_engine.connect():
+            pass
+
+    assert_that((len(pg_engine.pool.dispatch.connect), len(pg_engine.pool.dispatch.invalidate))).is_equal_to(listeners)
+    assert_that(postgres_helpers.pool_stats(pg_engine).connects).is_equal_to(1)
+
+    pg_engine.dispose()
@@ -0,0 +1,254 @@
+import time
+import itertools
+import threading
+import structlog
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TypeVar
+)
+
+from sqlalchemy import (
+    Engine,
+    event,
+    text
+)
+from sqlalchemy.exc import (
+    DBAPIError,
+    OperationalError
+)
+from sqlalchemy.orm import (
+    Session,
+    sessionmaker
+)
+
+'''
+    NOTE:
+    ReplicaRouter sends read-only repository methods to read replicas.
+
+    1. Selection: "round_robin" cycles over the healthy replicas, "least_loaded" picks the
+       healthy replica with the fewest checked out pool connections.
+    2. Read-your-writes: after mark_write() the same caller (thread or asyncio task, it is
+       a ContextVar) reads from the primary for read_your_writes_window seconds, so it
+       never misses its own write because of replication lag.
+       Threads of a pool keep their context between tasks, wrap every task (request,
+       job) in unit_of_work() so that the pin of one task does not outlive it and route
+       unrelated tasks on the same thread to the primary.
+    3. Failover: a replica is marked unhealthy when a read on it fails with a connection
+       error (the read is retried once on the primary) or when the periodic health check
+       fails, e.g. SELECT 1 fails or replication lag is above max_replication_lag.
+       Reads go to the primary while no replica is healthy, the health check puts a
+       replica back as soon as it answers again.
+'''
+
+T = TypeVar("T")
+
+ROUND_ROBIN = "round_robin"
+LEAST_LOADED = "least_loaded"
+
+_REPLICATION_LAG_SQL = text("SELECT CASE WHEN pg_is_in_recovery() "
+                            "THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+                            "ELSE 0 END")
+
+class ReplicaRouter():
+
+    def __init__(self,
+                 logger: structlog.stdlib.BoundLogger,
+                 primary: Engine,
+                 replicas: List[Engine],
+                 strategy: str = ROUND_ROBIN,
+                 read_your_writes_window: float = 1.0,
+                 health_check_interval: float = 5.0,
+                 max_replication_lag: Optional[float] = None):
+
+        if strategy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError(f"unknown replica strategy {strategy}")
+
+        self.logger = logger
+        self.primary = primary
+        self.replicas = replicas
+        self.strategy = strategy
+        self.read_your_writes_window = read_your_writes_window
+        self.health_check_interval = health_check_interval
+        self.max_replication_lag = max_replication_lag
+
+        self._session_makers: Dict[Engine, sessionmaker] = {
+            engine: sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            for engine in [primary] + replicas}
+
+        self._lock = threading.Lock()
+        self._healthy: List[Engine] = list(replicas)
+        self._round_robin = itertools.count()
+
+        # monotonic time of the last write of the current caller
+        self._last_write_at: ContextVar[float] = ContextVar(f"replica_router_{id(self)}_last_write_at",
+                                                            default=float("-inf"))
+
+        # statistics
+        self.primary_reads = 0
+        self.replica_reads = 0
+        self.failovers = 0
+
+        for replica in replicas:
+            event.listen(replica, "handle_error", self._handle_error)
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def mark_write(self):
+        self._last_write_at.set(time.monotonic())
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator[None]:
+        '''
+            drop a read-your-writes pin set inside the block when it exits, a pin of the
+            enclosing context still applies inside.
+        '''
+        token = self._last_write_at.set(self._last_write_at.get())
+        try:
+            yield
+        finally:
+            self._last_write_at.reset(token)
+
+    def _count_read(self, engine: Engine):
+
+        with self._lock:
+            if engine is self.primary:
+                self.primary_reads += 1
+            else:
+                self.replica_reads += 1
+
+    def read_engine(self) -> Engine:
+
+        if time.monotonic() - self._last_write_at.get() < self.read_your_writes_window:
+            self._count_read(self.primary)
+            return self.primary
+
+        healthy = self._healthy
+        if not healthy:
+            self._count_read(self.primary)
+            return self.primary
+
+        if self.strategy == LEAST_LOADED:
+            engine = min(healthy, key=lambda replica: replica.pool.checkedout())
+        else:
+            engine = healthy[next(self._round_robin) % len(healthy)]
+
+        self._count_read(engine)
+        return engine
+
+    def session_maker(self, engine: Engine) -> sessionmaker:
+        return self._session_makers[engine]
+
+    def read_session_maker(self) -> sessionmaker:
+        '''
+            sessionmaker of read_engine(), for reads which cannot be retried, e.g. streaming.
+        '''
+        return self._session_makers[self.read_engine()]
+
+    def run_read(self, read: Callable[[Session], T]) -> T:
+        '''
+            run read(session) on the selected engine, retried on the primary if a replica
+            connection fails.
+        '''
+        engine = self.read_engine()
+        try:
+            with self._session_makers[engine]() as session:
+                return read(session)
+        except DBAPIError as e:
+            if engine is self.primary or not self._is_connection_error(e):
+                raise
+            self._mark_unhealthy(engine, e)
+
+        self._count_read(self.primary)
+        with self._session_makers[self.primary]() as session:
+            return read(session)
+
+    @staticmethod
+    def _is_connection_error(error: DBAPIError) -> bool:
+        # OperationalError covers failed connects, connection_invalidated broken connections
+        return isinstance(error, OperationalError) or error.connection_invalidated
+
+    def _handle_error(self, context):
+
+        # every replica statement failing because of a broken connection
+        if context.is_disconnect and context.engine is not None:
+            self._mark_unhealthy(context.engine, context.original_exception)
+
+    def _mark_unhealthy(self, engine: Engine, error: Exception):
+
+        with self._lock:
+            if engine not in self._healthy:
+                return
+            self._healthy = [replica for replica in self._healthy if replica is not engine]
+            self.failovers += 1
+
+        self.logger.error(
+            "[ReplicaRouter][failover] replica {} is unhealthy. ERROR: {}".format(engine.url.render_as_string(), error))
+
+    def check_health(self):
+        '''
+            probe every replica once, called periodically by the health check thread.
+        '''
+        healthy = []
+        for replica in self.replicas:
+            try:
+                with replica.connect() as conn:
+                    lag = conn.execute(_REPLICATION_LAG_SQL).scalar()
+                if self.max_replication_lag is not None and lag > self.max_replication_lag:
+                    raise RuntimeError(f"replication lag {lag:.1f}s")
+                healthy.append(replica)
+            except Exception as e:
+                if replica in self._healthy:
+                    self._mark_unhealthy(replica, e)
+
+        with self._lock:
+            self._healthy = healthy
+
+    def start(self):
+
+        if self._thread is not None or not self.replicas:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="replica-health-check", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+
+        while not self._stop.wait(self.health_check_interval):
+            try:
+                self.check_health()
+            except Exception as e:
+                self.logger.error("[ReplicaRouter][check_health] health check failed. ERROR: {}".format(e))
+
+    def close(self):
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        for replica in self.replicas:
+            event.remove(replica, "handle_error", self._handle_error)
+
+    def healthy_replicas(self) -> List[Engine]:
+        return list(self._healthy)
+
+
+def setup_replica_router(logger: structlog.stdlib.BoundLogger,
+                         primary: Engine,
+                         replicas: List[Engine],
+                         **kwargs) -> ReplicaRouter:
+
+    router = ReplicaRouter(logger=logger, primary=primary, replicas=replicas, **kwargs)
+    router.start()
+
+    return router
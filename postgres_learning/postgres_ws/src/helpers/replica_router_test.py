@@ -0,0 +1,146 @@
+import time
+import pytest
+import structlog
+
+from concurrent.futures import ThreadPoolExecutor
+
+from assertpy import assert_that
+
+from config.settings import settings
+from helpers import postgres_helpers
+from helpers.replica_router import (
+    ReplicaRouter,
+    LEAST_LOADED
+)
+from repository.robots.robots import (
+    RobotInfo,
+    RobotState,
+    setup_robots_repo
+)
+from repository.robots.sharding import ShardedRobotsRepo
+
+def _engine(port: int = None):
+
+    # the test database stands in for a replica, a dead port for a failed one
+    return postgres_helpers.connect_to_postgres(
+        host=settings.host,
+        port=settings.port if port is None else port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password,
+        bootstrap=port is None,
+    )
+
+@pytest.fixture(scope="module")
+def primary():
+
+    engine = _engine()
+    yield engine
+    engine.dispose()
+
+def test_round_robin_and_read_your_writes(primary):
+
+    replicas = [_engine(), _engine()]
+    router = ReplicaRouter(logger=structlog.get_logger(), primary=primary, replicas=replicas,
+                           read_your_writes_window=0.2)
+
+    assert_that([router.read_engine() for _ in range(4)]).is_equal_to(replicas * 2)
+
+    router.mark_write()
+    assert_that(router.read_engine()).is_same_as(primary)
+
+    time.sleep(0.25)
+    assert_that(router.read_engine()).is_in(*replicas)
+    assert_that((router.primary_reads, router.replica_reads)).is_equal_to((1, 5))
+
+    router.close()
+    for replica in replicas:
+        replica.dispose()
+
+def test_least_loaded_picks_the_idle_replica(primary):
+
+    replicas = [_engine(), _engine()]
+    router = ReplicaRouter(logger=structlog.get_logger(), primary=primary, replicas=replicas,
+                           strategy=LEAST_LOADED)
+
+    with replicas[0].connect():
+        assert_that(router.read_engine()).is_same_as(replicas[1])
+
+    router.close()
+    for replica in replicas:
+        replica.dispose()
+
+def test_robots_repo_fails_over_to_primary(primary):
+
+    dead_replica = _engine(port=1)
+    router = ReplicaRouter(logger=structlog.get_logger(), primary=primary, replicas=[dead_replica])
+    robots_repo = setup_robots_repo(logger=structlog.get_logger(), engine=primary, router=router)
+
+    robots_repo.register([RobotInfo(robot_id="replica-smr01", robot_name="01")])
+    robots_repo.name_cache.clear()
+
+    # the write pins this caller to the primary, the dead replica is not touched
+    assert_that(robots_repo.fetch_robot_name(["replica-smr01"])).is_equal_to({"replica-smr01": "01"})
+    assert_that(router.failovers).is_equal_to(0)
+
+    router.read_your_writes_window = 0.0
+    robots_repo.name_cache.clear()
+
+    # the replica read fails, is retried on the primary and the replica is taken out
+    assert_that(robots_repo.fetch_robot_name(["replica-smr01"])).is_equal_to({"replica-smr01": "01"})
+    assert_that(router.failovers).is_equal_to(1)
+    assert_that(router.healthy_replicas()).is_empty()
+
+    # the health check keeps it out while it does not answer
+    router.check_health()
+    assert_that(router.healthy_replicas()).is_empty()
+
+    router.close()
+    dead_replica.dispose()
+
+def test_read_counts_and_pins_of_pooled_threads(primary):
+
+    replicas = [_engine()]
+    router = ReplicaRouter(logger=structlog.get_logger(), primary=primary, replicas=replicas,
+                           read_your_writes_window=60.0)
+
+    def write_then_read():
+        with router.unit_of_work():
+            router.mark_write()
+            return router.read_engine()
+
+    # the pin of a task does not outlive it, the next task on the same thread reads from the replica
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert_that(executor.submit(write_then_read).result()).is_same_as(primary)
+        assert_that(executor.submit(router.read_engine).result()).is_same_as(replicas[0])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: router.read_engine(), range(8000)))
+    assert_that(router.primary_reads + router.replica_reads).is_equal_to(8002)
+
+    router.close()
+    for replica in replicas:
+        replica.dispose()
+
+def test_sharded_writes_do_not_pin_the_shard_threads(primary):
+
+    replicas = [_engine()]
+    router = ReplicaRouter(logger=structlog.get_logger(), primary=primary, replicas=replicas,
+                           read_your_writes_window=60.0)
+    shards = {shard: setup_robots_repo(logger=structlog.get_logger(), engine=primary, router=router)
+              for shard in ("shard-0", "shard-1")}
+
+    with ShardedRobotsRepo(logger=structlog.get_logger(), shards=shards, max_workers=1) as sharded_repo:
+        robot_ids = [f"replica-smr1{i}" for i in range(10)]
+        sharded_repo.register([RobotInfo(robot_id=robot_id, robot_name=robot_id) for robot_id in robot_ids])
+        sharded_repo.upsert_robot_states([RobotState(robot_id=robot_id,
+                                                     map_uuid="replica-map",
+                                                     position_x=1.0,
+                                                     position_y=0.0,
+                                                     position_theta=0.0) for robot_id in robot_ids])
+
+        assert_that(sharded_repo._executor.submit(router.read_engine).result()).is_same_as(replicas[0])
+
+    router.close()
+    for replica in replicas:
+        replica.dispose()
@@ -0,0 +1,186 @@
+import time
+import threading
+
+from collections import (
+    OrderedDict,
+    namedtuple
+)
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+    Iterable,
+    Sequence,
+    Optional
+)
+
+'''
+    NOTE:
+    A bounded LRU cache with an optional time-to-live, used by RobotsRepo.fetch_robot_name.
+
+    OrderedDict keeps the entries in least-recently-used order, move_to_end marks an entry
+    as recently used and popitem(last=False) evicts the oldest one, both are O(1).
+
+    Like functools.lru_cache, the statistics are exposed with cache_info().
+'''
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+class RobotNameCache():
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 60.0):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # robot_id => (robot_name, expires_at)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get_many(self, robot_ids: Iterable[str]) -> Tuple[Dict[str, str], List[str]]:
+        '''
+            return cached names and the robot_ids which have to be fetched from database.
+        '''
+        found = {}
+        missing = []
+        now = time.monotonic()
+
+        with self._lock:
+            for robot_id in robot_ids:
+                entry = self._entries.get(robot_id)
+                if entry is not None and (entry[1] is None or entry[1] > now):
+                    self._entries.move_to_end(robot_id)
+                    found[robot_id] = entry[0]
+                    self._hits += 1
+                    continue
+
+                if entry is not None:
+                    # expired
+                    del self._entries[robot_id]
+                missing.append(robot_id)
+                self._misses += 1
+
+        return found, missing
+
+    def put_many(self, robot_names: Dict[str, str]):
+
+        if self.maxsize <= 0:
+            return
+
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            for robot_id, robot_name in robot_names.items():
+                self._entries[robot_id] = (robot_name, expires_at)
+                self._entries.move_to_end(robot_id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, robot_ids: Iterable[str]):
+
+        with self._lock:
+            for robot_id in robot_ids:
+                self._entries.pop(robot_id, None)
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+    def cache_info(self) -> CacheInfo:
+
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._evictions, self.maxsize, len(self._entries))
+
+
+'''
+    NOTE:
+    LastWrittenPoses remembers the last pose committed for every robot, so that
+    RobotsRepo.upsert_robot_states can drop reports of robots which did not move.
+
+    A pose is (map_uuid, position_x, position_y, position_theta). A report is written when
+    the robot is unknown, changed map or moved more than epsilon on x, y or theta since
+    the last written pose, so slow drift is written once it adds up to epsilon.
+
+    Entries are bounded like RobotNameCache, an evicted robot is simply written again.
+'''
+
+def _moved(last: Optional[float], current: Optional[float], epsilon: float) -> bool:
+
+    # a robot without position (None) only matches another None
+    if last is None or current is None:
+        return (last is None) != (current is None)
+    return abs(last - current) > epsilon
+
+class LastWrittenPoses():
+
+    def __init__(self, maxsize: int = 100_000):
+
+        self.maxsize = maxsize
+
+        # robot_id => (map_uuid, position_x, position_y, position_theta)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def changed(self, rows: Sequence[Dict], epsilon: float) -> List[Dict]:
+        '''
+            rows whose pose differs from the last written one by more than epsilon.
+        '''
+        if self.maxsize <= 0:
+            return list(rows)
+
+        changed = []
+        with self._lock:
+            for row in rows:
+                pose = self._entries.get(row["robot_id"])
+                if (pose is None
+                        or pose[0] != row["map_uuid"]
+                        or _moved(pose[1], row["position_x"], epsilon)
+                        or _moved(pose[2], row["position_y"], epsilon)
+                        or _moved(pose[3], row["position_theta"], epsilon)):
+                    changed.append(row)
+
+        return changed
+
+    def put_many(self, rows: Sequence[Dict]):
+
+        self.put_columns([row["robot_id"] for row in rows],
+                         [row["map_uuid"] for row in rows],
+                         [row["position_x"] for row in rows],
+                         [row["position_y"] for row in rows],
+                         [row["position_theta"] for row in rows])
+
+    def put_columns(self,
+                    robot_ids: Sequence[str],
+                    map_uuids: Sequence[str],
+                    positions_x: Sequence[float],
+                    positions_y: Sequence[float],
+                    positions_theta: Sequence[float]):
+        '''
+            put_many for column lists, used by the columnar upsert.
+        '''
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            for robot_id, *pose in zip(robot_ids, map_uuids, positions_x, positions_y, positions_theta):
+                self._entries[robot_id] = tuple(pose)
+                self._entries.move_to_end(robot_id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
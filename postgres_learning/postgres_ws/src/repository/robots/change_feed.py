@@ -0,0 +1,297 @@
+import json
+import time
+import select
+import threading
+import structlog
+
+from collections import (
+    OrderedDict,
+    namedtuple
+)
+
+from typing import (
+    Callable,
+    List,
+    Optional
+)
+
+from sqlalchemy import (
+    Engine,
+    text
+)
+
+from repository.robots.robots import RobotState
+
+'''
+    NOTE:
+    Change feed of robot_states built on PostgreSQL LISTEN/NOTIFY.
+
+    1. A trigger on robot_states sends a compact NOTIFY for every inserted row and every
+       updated row whose pose has really changed, so every writer is covered, including
+       bulk loads and other processes.
+    2. RobotStateChangeFeed holds one listening connection per process and fans every
+       change out to in-process subscribers.
+    3. Every Subscription is a bounded queue that keeps only the latest change per
+       robot_id, a slow consumer receives fewer, newer changes instead of a growing backlog.
+
+    Payload: a JSON object (json_build_object) with robot_id, map_uuid, position_x,
+    position_y and position_theta, NULL is sent as null. A payload which cannot be parsed
+    is logged and skipped, the other notifications of the batch are still delivered.
+
+    install_robot_states_notify_trigger is idempotent: the function is replaced, the
+    trigger is only created when it does not exist yet.
+'''
+
+DEFAULT_CHANNEL = "robot_states_changes"
+
+RobotStateChange = namedtuple("RobotStateChange", ["robot_id",
+                                                   "map_uuid",
+                                                   "position_x",
+                                                   "position_y",
+                                                   "position_theta"])
+
+def install_robot_states_notify_trigger(engine: Engine, channel: str = DEFAULT_CHANNEL):
+
+    table = RobotState.__tablename__
+
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION {table}_notify() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'UPDATE'
+                   AND NEW.map_uuid IS NOT DISTINCT FROM OLD.map_uuid
+                   AND NEW.position_x IS NOT DISTINCT FROM OLD.position_x
+                   AND NEW.position_y IS NOT DISTINCT FROM OLD.position_y
+                   AND NEW.position_theta IS NOT DISTINCT FROM OLD.position_theta THEN
+                    RETURN NULL;
+                END IF;
+
+                PERFORM pg_notify('{channel}', json_build_object('robot_id', NEW.robot_id,
+                                                                 'map_uuid', NEW.map_uuid,
+                                                                 'position_x', NEW.position_x,
+                                                                 'position_y', NEW.position_y,
+                                                                 'position_theta', NEW.position_theta)::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """))
+        # CREATE TRIGGER locks the table, only run it when the trigger is missing
+        conn.execute(text(f"""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                               WHERE tgname = '{table}_notify' AND tgrelid = '{table}'::regclass) THEN
+                    CREATE TRIGGER {table}_notify
+                    AFTER INSERT OR UPDATE ON {table}
+                    FOR EACH ROW EXECUTE FUNCTION {table}_notify();
+                END IF;
+            END;
+            $$
+        """))
+
+def _float(value) -> Optional[float]:
+    # json has no NaN/Infinity, PostgreSQL sends them as strings
+    return None if value is None else float(value)
+
+def _parse_payload(payload: str) -> RobotStateChange:
+
+    fields = json.loads(payload)
+    return RobotStateChange(fields["robot_id"],
+                            fields["map_uuid"],
+                            _float(fields["position_x"]),
+                            _float(fields["position_y"]),
+                            _float(fields["position_theta"]))
+
+class Subscription():
+
+    def __init__(self, maxsize: int = 10000):
+
+        self.maxsize = maxsize
+
+        # robot_id => latest change, in arrival order of the robot_id
+        self._pending: OrderedDict = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # statistics
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, change: RobotStateChange):
+
+        with self._cond:
+            if change.robot_id in self._pending:
+                # keep the queue position, so a chatty robot cannot starve the others
+                self._pending[change.robot_id] = change
+                self.coalesced += 1
+            else:
+                if len(self._pending) >= self.maxsize:
+                    self._pending.popitem(last=False)
+                    self.dropped += 1
+                self._pending[change.robot_id] = change
+            self._cond.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[RobotStateChange]:
+
+        changes = self.get_batch(max_items=1, timeout=timeout)
+        return changes[0] if changes else None
+
+    def get_batch(self, max_items: int = 1000, timeout: Optional[float] = None) -> List[RobotStateChange]:
+        '''
+            wait up to timeout for changes, return at most max_items of them (empty on timeout or close).
+        '''
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending or self._closed, timeout=timeout)
+
+            changes = []
+            while self._pending and len(changes) < max_items:
+                changes.append(self._pending.popitem(last=False)[1])
+            return changes
+
+    def close(self):
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+class RobotStateChangeFeed():
+
+    def __init__(self,
+                 logger: structlog.stdlib.BoundLogger,
+                 engine: Engine,
+                 channel: str = DEFAULT_CHANNEL,
+                 poll_interval: float = 1.0,
+                 reconnect_interval: float = 1.0):
+
+        self.logger = logger
+        self.engine = engine
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.reconnect_interval = reconnect_interval
+
+        self._lock = threading.Lock()
+        self._subscriptions: List[Subscription] = []
+        self._listeners: List[Callable[[List[RobotStateChange]], None]] = []
+
+        self._running = False
+        self._listening = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, maxsize: int = 10000) -> Subscription:
+
+        subscription = Subscription(maxsize=maxsize)
+        with self._lock:
+            self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+
+        with self._lock:
+            self._subscriptions = [s for s in self._subscriptions if s is not subscription]
+        subscription.close()
+
+    def add_listener(self, listener: Callable[[List[RobotStateChange]], None]):
+        '''
+            listener is called on the feed thread with every batch of changes, e.g.
+            feed.add_listener(lambda changes: snapshot.apply_robot_states([c._asdict() for c in changes]))
+        '''
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+
+    def start(self, timeout: Optional[float] = 5.0) -> bool:
+        '''
+            start the feed thread, wait up to timeout until LISTEN is active.
+            changes committed before that are not delivered.
+        '''
+        if not self._running:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="robot-states-change-feed", daemon=True)
+            self._thread.start()
+
+        return self._listening.wait(timeout)
+
+    def stop(self):
+
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        for subscription in self._subscriptions:
+            subscription.close()
+
+    def _publish(self, changes: List[RobotStateChange]):
+
+        # copy-on-write lists, iterate without holding the lock
+        for subscription in self._subscriptions:
+            for change in changes:
+                subscription.put(change)
+
+        for listener in self._listeners:
+            try:
+                listener(changes)
+            except Exception as e:
+                self.logger.error(
+                    "[RobotStateChangeFeed][publish] listener failed. ERROR: {}".format(e))
+
+    def _run(self):
+
+        while self._running:
+            try:
+                self._listen()
+            except Exception as e:
+                self.logger.error(
+                    "[RobotStateChangeFeed][listen] listen connection failed. ERROR: {}".format(e))
+                time.sleep(self.reconnect_interval)
+
+    def _listen(self):
+
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel}")
+            self._listening.set()
+
+            while self._running:
+                # select() sleeps until the server sends something, poll() reads it into notifies
+                readable, _, _ = select.select([dbapi_connection], [], [], self.poll_interval)
+                if not readable:
+                    continue
+
+                dbapi_connection.poll()
+                notifies = dbapi_connection.notifies
+                if notifies:
+                    changes = []
+                    for notify in notifies:
+                        try:
+                            changes.append(_parse_payload(notify.payload))
+                        except (ValueError, KeyError, TypeError) as e:
+                            self.logger.error(
+                                "[RobotStateChangeFeed][listen] bad payload {!r} skipped. ERROR: {}".format(notify.payload, e))
+                    notifies.clear()
+                    if changes:
+                        self._publish(changes)
+        finally:
+            self._listening.clear()
+            # the connection was switched to autocommit and is listening, do not return it to the pool
+            connection.invalidate()
+
+
+def setup_robot_state_change_feed(logger: structlog.stdlib.BoundLogger,
+                                  engine: Engine,
+                                  channel: str = DEFAULT_CHANNEL,
+                                  install_trigger: bool = True) -> RobotStateChangeFeed:
+
+    # install_trigger=False for runtime processes, bootstrap.py --change-feed installs it
+    if install_trigger:
+        install_robot_states_notify_trigger(engine, channel)
+
+    change_feed = RobotStateChangeFeed(logger=logger, engine=engine, channel=channel)
+    change_feed.start()
+
+    return change_feed
@@ -0,0 +1,203 @@
+import io
+
+import numpy as np
+
+from collections import namedtuple
+
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    Optional,
+    Sequence
+)
+
+if TYPE_CHECKING:
+    from repository.robots.robots import LatestRobotState
+
+'''
+    NOTE:
+    Columnar fleet state for planners which work on arrays.
+
+    fetch_robot_states builds one LatestRobotState per robot and callers loop over them
+    again to build arrays. Here the poses are read with
+
+        COPY (SELECT position_x, position_y, position_theta, map index ...) TO STDOUT (FORMAT binary)
+
+    Every COPY binary tuple of these columns has the same size, a 2 byte field count and a
+    4 byte length before every field, so the whole COPY output is read as one NumPy
+    structured array (big endian, as sent by the server) and copied into the float64
+    buffers in one step, no Python object per row.
+
+    Robot ids and map_uuids are variable length, they come from one array_agg query in
+    the same REPEATABLE READ transaction and the same robot_id order. map_index[i] is the
+    position of the map of robot i in map_uuids.
+
+    Robots are ordered by robot_id COLLATE "C" (code point order), the order of sorted()
+    in Python, so arrays built from a FleetSnapshot come in the same order whatever the
+    collation of the database is.
+
+    NULL positions are read as NaN and written back as NULL by upsert_robot_states_columnar,
+    a fetch -> upsert round trip does not turn them into NaN in database.
+'''
+
+FleetArrays = namedtuple("FleetArrays", ["robot_ids",
+                                         "map_uuids",
+                                         "map_index",
+                                         "position_x",
+                                         "position_y",
+                                         "position_theta"])
+
+_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+# signature, flags, header extension length
+_COPY_HEADER_SIZE = len(_COPY_SIGNATURE) + 4 + 4
+
+# field count -1
+_COPY_TRAILER_SIZE = 2
+
+_COPY_ROW_DTYPE = np.dtype([("fields", ">i2"),
+                            ("position_x_size", ">i4"), ("position_x", ">f8"),
+                            ("position_y_size", ">i4"), ("position_y", ">f8"),
+                            ("position_theta_size", ">i4"), ("position_theta", ">f8"),
+                            ("map_index_size", ">i4"), ("map_index", ">i4")])
+
+def _fleet_from(robot_states: str, robot_infos: str) -> str:
+    return "FROM {} s JOIN {} i ON i.robot_id = s.robot_id".format(robot_states, robot_infos)
+
+def copy_poses_sql(robot_states: str, robot_infos: str) -> str:
+
+    return ("COPY (SELECT COALESCE(s.position_x, 'NaN'), "
+            "COALESCE(s.position_y, 'NaN'), "
+            "COALESCE(s.position_theta, 'NaN'), "
+            "(dense_rank() OVER (ORDER BY s.map_uuid) - 1)::int4 "
+            "{} ORDER BY s.robot_id COLLATE \"C\") TO STDOUT (FORMAT binary)").format(_fleet_from(robot_states, robot_infos))
+
+def fleet_index_sql(robot_states: str, robot_infos: str) -> str:
+
+    # DISTINCT ... ORDER BY sorts like dense_rank, NULL last
+    return ("SELECT array_agg(s.robot_id ORDER BY s.robot_id COLLATE \"C\"), "
+            "array_agg(DISTINCT s.map_uuid ORDER BY s.map_uuid) {}").format(_fleet_from(robot_states, robot_infos))
+
+def parse_binary_copy(buffer: memoryview) -> np.ndarray:
+    '''
+        COPY (FORMAT binary) output of copy_poses_sql as a structured array, no copy.
+    '''
+    if bytes(buffer[:len(_COPY_SIGNATURE)]) != _COPY_SIGNATURE:
+        raise ValueError("not a binary COPY stream")
+
+    extension_size = int.from_bytes(buffer[_COPY_HEADER_SIZE - 4:_COPY_HEADER_SIZE], "big")
+    offset = _COPY_HEADER_SIZE + extension_size
+
+    body_size = len(buffer) - offset - _COPY_TRAILER_SIZE
+    if body_size % _COPY_ROW_DTYPE.itemsize:
+        raise ValueError("binary COPY rows have an unexpected size")
+
+    return np.frombuffer(buffer, dtype=_COPY_ROW_DTYPE, count=body_size // _COPY_ROW_DTYPE.itemsize, offset=offset)
+
+class FleetBuffers():
+    '''
+        preallocated arrays reused by every fetch_robot_states_columnar call, they grow
+        (doubling) when the fleet does not fit. Returned FleetArrays are views of them and
+        are overwritten by the next fetch into the same buffers.
+    '''
+
+    def __init__(self, capacity: int = 0):
+
+        self.capacity = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+
+        self.capacity = capacity
+        self.map_index = np.empty(capacity, dtype=np.int32)
+        self.position_x = np.empty(capacity, dtype=np.float64)
+        self.position_y = np.empty(capacity, dtype=np.float64)
+        self.position_theta = np.empty(capacity, dtype=np.float64)
+
+    def reserve(self, size: int):
+
+        if size > self.capacity:
+            self._allocate(max(size, self.capacity * 2))
+
+    def fill(self, rows: np.ndarray, robot_ids: List[str], map_uuids: List[Optional[str]]) -> FleetArrays:
+        '''
+            copy parsed COPY rows into the buffers, big endian to native in one pass per column.
+        '''
+        size = len(rows)
+        if size != len(robot_ids):
+            raise ValueError(f"{size} poses for {len(robot_ids)} robot ids, the fleet changed between the queries")
+
+        self.reserve(size)
+        for column in ("map_index", "position_x", "position_y", "position_theta"):
+            np.copyto(getattr(self, column)[:size], rows[column])
+
+        return self._view(robot_ids, map_uuids, size)
+
+    def fill_from_robot_states(self, robot_states: Sequence["LatestRobotState"]) -> FleetArrays:
+        '''
+            same arrays from already built LatestRobotState objects, e.g. a FleetSnapshot.
+        '''
+        size = len(robot_states)
+        self.reserve(size)
+
+        map_positions: Dict[Optional[str], int] = {}
+        for index, robot_state in enumerate(robot_states):
+            self.map_index[index] = map_positions.setdefault(robot_state.map_uuid, len(map_positions))
+            self.position_x[index] = robot_state.position_x
+            self.position_y[index] = robot_state.position_y
+            self.position_theta[index] = robot_state.position_theta
+
+        return self._view([robot_state.robot_id for robot_state in robot_states], list(map_positions), size)
+
+    def _view(self, robot_ids: List[str], map_uuids: List[Optional[str]], size: int) -> FleetArrays:
+
+        return FleetArrays(robot_ids,
+                           map_uuids,
+                           self.map_index[:size],
+                           self.position_x[:size],
+                           self.position_y[:size],
+                           self.position_theta[:size])
+
+def read_fleet_arrays(dbapi_connection, robot_states: str, robot_infos: str, buffers: FleetBuffers) -> FleetArrays:
+    '''
+        run both queries on a psycopg2 connection, the caller holds the transaction.
+    '''
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute(fleet_index_sql(robot_states, robot_infos))
+        robot_ids, map_uuids = cursor.fetchone()
+
+        output = io.BytesIO()
+        cursor.copy_expert(copy_poses_sql(robot_states, robot_infos), output)
+
+    rows = parse_binary_copy(output.getbuffer())
+    return buffers.fill(rows, robot_ids or [], map_uuids or [])
+
+def _nullable(positions: Sequence[float]) -> list:
+
+    # NaN is how NULL is read, send it back as NULL (None)
+    positions = np.asarray(positions, dtype=np.float64)
+    nulls = np.isnan(positions)
+    if not nulls.any():
+        return positions.tolist()
+
+    column = positions.astype(object)
+    column[nulls] = None
+    return column.tolist()
+
+def fleet_columns(fleet: FleetArrays) -> Dict[str, list]:
+    '''
+        FleetArrays as column lists, the parameters of the robot_states unnest upsert.
+    '''
+    size = len(fleet.robot_ids)
+    for column in ("map_index", "position_x", "position_y", "position_theta"):
+        if len(getattr(fleet, column)) != size:
+            raise ValueError(f"{column} has {len(getattr(fleet, column))} values for {size} robot ids")
+
+    map_uuids = np.asarray(fleet.map_uuids, dtype=object)
+
+    return {"robot_id": list(fleet.robot_ids),
+            "map_uuid": map_uuids[np.asarray(fleet.map_index)].tolist() if size else [],
+            "position_x": _nullable(fleet.position_x),
+            "position_y": _nullable(fleet.position_y),
+            "position_theta": _nullable(fleet.position_theta)}
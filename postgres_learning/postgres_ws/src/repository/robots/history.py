@@ -0,0 +1,292 @@
+import structlog
+
+from datetime import (
+    datetime,
+    timedelta,
+    timezone
+)
+
+from typing import (
+    List,
+    Dict,
+    Set,
+    Iterator,
+    Optional
+)
+
+from sqlalchemy import (
+    Engine,
+    Connection,
+    Column,
+    String,
+    Float,
+    DateTime,
+    Index,
+    select,
+    insert,
+    func,
+    text
+)
+
+from sqlalchemy.orm import (
+    registry,
+    sessionmaker,
+    Session
+)
+
+from sqlalchemy.engine.row import Row
+
+from repository.robots.robots import UnexpectedError
+
+_HISTORY_REPO_BASE = registry().generate_base()
+
+'''
+    NOTE:
+    robot_states only keeps the latest pose of every robot, robot_state_history is the
+    append-only log of every pose that has been written.
+
+    The table is range-partitioned by recorded_at. Every partition covers one
+    partition_interval (one day by default) and is named after its lower bound, e.g.
+    robot_state_history_p20240101_000000.
+
+    1. Partition pruning: a query with a recorded_at range only scans the partitions which
+       overlap the range, so the last few minutes never scan weeks of data.
+    2. Retention: old data is removed with DROP TABLE on whole partitions, which is much
+       cheaper than DELETE + VACUUM.
+
+    There is no default partition, rows are only accepted inside created partitions, so
+    ensure_partitions has to run before appending (append does it on demand).
+
+    Retention runs on the write path: whenever ensure_partitions sees the current partition
+    roll over (and on the first write of a process), it also drops the expired partitions.
+    A process which keeps writing therefore never needs a scheduler, maintain() is only
+    needed to prune history which nobody writes to anymore.
+
+    Partitions may be created or dropped by other processes. The partitions known to this
+    process are only a shortcut, every miss re-reads them from pg_inherits. Rows older than
+    retention can still hit a partition another process just dropped, they would be
+    dropped by the next retention run anyway.
+'''
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_PARTITION_NAME_FORMAT = "%Y%m%d_%H%M%S"
+
+class RobotStateHistory(_HISTORY_REPO_BASE):
+    __tablename__ = "robot_state_history"
+    __table_args__ = (Index("ix_robot_state_history_robot_id_recorded_at", "robot_id", "recorded_at"),
+                      {"postgresql_partition_by": "RANGE (recorded_at)"})
+
+    robot_id = Column(String, nullable=False)
+    map_uuid = Column(String)
+    position_x = Column(Float)
+    position_y = Column(Float)
+    position_theta = Column(Float)
+    recorded_at = Column(DateTime(timezone=True), nullable=False)
+
+    # partitioned tables cannot have a primary key without the partition key, the mapper only needs one
+    __mapper_args__ = {"primary_key": [robot_id, recorded_at]}
+
+class RobotStateHistoryRepo():
+
+    def __init__(self,
+                 logger: structlog.stdlib.BoundLogger,
+                 engine: Engine,
+                 partition_interval: timedelta = timedelta(days=1),
+                 retention: timedelta = timedelta(days=7),
+                 partitions_ahead: int = 2):
+
+        self.logger = logger
+
+        self.engine = engine
+        self.session_maker = sessionmaker(autocommit=False,
+                                          autoflush=False,
+                                          bind=engine)
+
+        self.partition_interval = partition_interval
+        self.retention = retention
+        self.partitions_ahead = partitions_ahead
+
+        # lower bounds of the partitions known to exist, refreshed from pg_inherits on a miss
+        self._partitions: Set[datetime] = set()
+
+        # lower bound of the latest partition written to, retention runs when it rolls over
+        self._current: Optional[datetime] = None
+
+    def _partition_start(self, at: datetime) -> datetime:
+        return _EPOCH + ((at - _EPOCH) // self.partition_interval) * self.partition_interval
+
+    def _partition_name(self, start: datetime) -> str:
+        return "{}_p{}".format(RobotStateHistory.__tablename__, start.strftime(_PARTITION_NAME_FORMAT))
+
+    def _existing_partitions(self, conn: Connection) -> Dict[str, datetime]:
+        '''
+            partition name => lower bound of every partition in the database.
+        '''
+        prefix = "{}_p".format(RobotStateHistory.__tablename__)
+
+        partitions = conn.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = :table"), {"table": RobotStateHistory.__tablename__}).scalars().all()
+
+        return {partition: datetime.strptime(partition[len(prefix):], _PARTITION_NAME_FORMAT).replace(tzinfo=timezone.utc)
+                for partition in partitions if partition.startswith(prefix)}
+
+    def ensure_partitions(self, now: Optional[datetime] = None):
+        '''
+            create the partition of now and partitions_ahead partitions after it, drop the
+            expired partitions when the current partition rolled over.
+
+            it runs DDL on its own connection, callers must not hold a transaction which
+            has touched robot_state_history.
+        '''
+        now = now or datetime.now(timezone.utc)
+        start = self._partition_start(now)
+        starts = [start + i * self.partition_interval for i in range(self.partitions_ahead + 1)]
+
+        rolled_over = self._current is None or start > self._current
+
+        if any(start not in self._partitions for start in starts):
+            with self.engine.begin() as conn:
+                # another process may have dropped or created partitions
+                self._partitions = set(self._existing_partitions(conn).values())
+
+                for start in starts:
+                    if start in self._partitions:
+                        continue
+                    conn.execute(text(
+                        "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+                            self._partition_name(start),
+                            RobotStateHistory.__tablename__,
+                            start.isoformat(),
+                            (start + self.partition_interval).isoformat())))
+
+            self._partitions.update(starts)
+
+        if rolled_over:
+            self._current = starts[0]
+            self.drop_expired_partitions(now)
+
+    def drop_expired_partitions(self, now: Optional[datetime] = None) -> List[str]:
+        '''
+            drop partitions whose whole range is older than retention, return dropped partition names.
+        '''
+        expired_before = (now or datetime.now(timezone.utc)) - self.retention
+
+        dropped = []
+        with self.engine.begin() as conn:
+            partitions = self._existing_partitions(conn)
+
+            for partition, start in partitions.items():
+                if start + self.partition_interval > expired_before:
+                    continue
+
+                conn.execute(text("DROP TABLE IF EXISTS {}".format(partition)))
+                dropped.append(partition)
+
+            self._partitions = {start for partition, start in partitions.items() if partition not in dropped}
+
+        if dropped:
+            self.logger.info("dropped expired robot_state_history partitions", partitions=dropped)
+
+        return dropped
+
+    def maintain(self, now: Optional[datetime] = None) -> List[str]:
+        '''
+            create upcoming partitions and drop expired ones, writes do the same on every
+            partition roll over.
+        '''
+        self.ensure_partitions(now)
+        return self.drop_expired_partitions(now)
+
+    def append_in_session(self, session: Session, rows: List[Dict], recorded_at: datetime):
+        '''
+            append robot state rows inside the caller transaction, used by RobotsRepo.upsert_robot_states.
+
+            creating a partition needs a lock on the parent table, so callers should run
+            ensure_partitions(recorded_at) before they open their transaction.
+        '''
+        if not rows:
+            return
+
+        self.ensure_partitions(recorded_at)
+        session.execute(insert(RobotStateHistory), [{**row, "recorded_at": recorded_at} for row in rows])
+
+    def append_staging_in_session(self, session: Session, staging: str, recorded_at: datetime):
+        '''
+            append the latest row per robot_id of a RobotsRepo bulk load staging table.
+        '''
+        self.ensure_partitions(recorded_at)
+        session.execute(text(
+            "INSERT INTO {history} (robot_id, map_uuid, position_x, position_y, position_theta, recorded_at) "
+            "SELECT DISTINCT ON (robot_id) robot_id, map_uuid, position_x, position_y, position_theta, :recorded_at "
+            "FROM {staging} ORDER BY robot_id, _seq DESC".format(history=RobotStateHistory.__tablename__,
+                                                                  staging=staging)),
+            {"recorded_at": recorded_at})
+
+    def append(self, rows: List[Dict], recorded_at: Optional[datetime] = None):
+
+        with self.session_maker() as session:
+            try:
+                self.append_in_session(session, rows, recorded_at or datetime.now(timezone.utc))
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                raise UnexpectedError(f"append robot state history failed. ERROR: {str(e)}")
+
+    def fetch_trajectory(self,
+                         robot_id: str,
+                         start: datetime,
+                         end: datetime,
+                         downsample: Optional[timedelta] = None,
+                         batch_size: int = 1000) -> Iterator[Row]:
+        '''
+            stream the poses of robot_id recorded in [start, end) ordered by recorded_at.
+
+            with downsample, only the first pose of every downsample bucket is returned.
+        '''
+        query = select(RobotStateHistory.robot_id,
+                       RobotStateHistory.map_uuid,
+                       RobotStateHistory.position_x,
+                       RobotStateHistory.position_y,
+                       RobotStateHistory.position_theta,
+                       RobotStateHistory.recorded_at) \
+            .where(RobotStateHistory.robot_id == robot_id,
+                   RobotStateHistory.recorded_at >= start,
+                   RobotStateHistory.recorded_at < end)
+
+        if downsample is None:
+            query = query.order_by(RobotStateHistory.recorded_at)
+        else:
+            '''
+                NOTE:
+                date_bin (PostgreSQL 14+) maps recorded_at to the start of its bucket,
+                DISTINCT ON keeps the first row of every bucket.
+            '''
+            bucket = func.date_bin(downsample, RobotStateHistory.recorded_at, start)
+            query = query.distinct(bucket).order_by(bucket, RobotStateHistory.recorded_at)
+
+        with self.session_maker() as session:
+            try:
+                results = session.execute(query.execution_options(stream_results=True,
+                                                                  yield_per=batch_size))
+                yield from results
+            except Exception as e:
+                session.rollback()
+                raise UnexpectedError(f"fetch trajectory failed. ERROR: {str(e)}")
+
+
+def setup_robot_state_history_repo(logger: structlog.stdlib.BoundLogger,
+                                   engine: Engine,
+                                   create_tables: bool = True,
+                                   **kwargs) -> RobotStateHistoryRepo:
+
+    history_repo = RobotStateHistoryRepo(logger=logger, engine=engine, **kwargs)
+
+    # without create_tables partitions are still created on demand by append
+    if create_tables:
+        _HISTORY_REPO_BASE.metadata.create_all(engine)
+        history_repo.maintain()
+
+    return history_repo
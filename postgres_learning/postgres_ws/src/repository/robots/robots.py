@@ -1,25 +1,51 @@
+import math
 import structlog
 
+from enum import Enum
+from collections import namedtuple
+from operator import attrgetter
+from datetime import (
+    datetime,
+    timezone
+)
+
 from pydantic import (
     BaseModel,
     Field
 )
 
 from typing import (
+    TYPE_CHECKING,
     List,
     Dict,
-    Tuple
+    Tuple,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Union,
+    Callable,
+    TypeVar,
+    Any
 )
 
 from sqlalchemy import (
     Engine,
+    Connection,
+    Table,
     Column,
     String,
-    Float
+    Float,
+    Index,
+    ColumnElement,
+    select,
+    func,
+    text
 )
 
 from sqlalchemy.orm import (
     registry, 
+    Session,
     sessionmaker
 )
 
@@ -27,6 +53,32 @@ from sqlalchemy.engine.row import Row
 
 from sqlalchemy.dialects.postgresql import insert 
 
+from helpers.postgres_helpers import (
+    copy_rows,
+    upsert_unnest_stmt,
+    unnest_params
+)
+from helpers.instrumentation import repository_method
+from repository.robots.cache import (
+    CacheInfo,
+    RobotNameCache,
+    LastWrittenPoses
+)
+
+from repository.robots.spatial import BBox
+
+if TYPE_CHECKING:
+    from repository.robots.snapshot import FleetSnapshot
+    from repository.robots.history import RobotStateHistoryRepo
+    from helpers.replica_router import ReplicaRouter
+    from repository.robots.telemetry import TelemetryStore
+    from repository.robots.columnar import (
+        FleetArrays,
+        FleetBuffers
+    )
+
+T = TypeVar("T")
+
 _ROBOTS_REPO_BASE = registry().generate_base()
 
 '''
@@ -45,6 +97,10 @@ class RobotInfo(_ROBOTS_REPO_BASE):
 
 class RobotState(_ROBOTS_REPO_BASE):
     __tablename__ = "robot_states"
+    __table_args__ = (
+        # bounding box / nearest queries: equality on map_uuid, then a range scan on position_x
+        Index("ix_robot_states_map_position", "map_uuid", "position_x", "position_y"),
+    )
     robot_id = Column(String, primary_key=True)
     map_uuid = Column(String)
     position_x = Column(Float)
@@ -59,11 +115,203 @@ class LatestRobotState(BaseModel):
     position_y: float = Field(..., example=0.0, description="current robot y position")
     position_theta: float = Field(..., example=0.0, description="current robot theta position")
 
+'''
+    NOTE:
+    Result modes of fetch_robot_states.
+
+    Values of a joined row come straight from typed columns, so validating them again with
+    pydantic is pure CPU cost. Cheaper output types can be chosen per repo or per call:
+
+    1. MODEL     => validated LatestRobotState (default)
+    2. CONSTRUCT => LatestRobotState.model_construct, no validation
+    3. RECORD    => RobotStateRecord namedtuple, attribute access without pydantic
+    4. TUPLE     => plain tuple in RobotStateRecord field order
+    5. DICT      => plain dict
+
+    benchmarks/result_mode_benchmark.py shows rows per second of each mode.
+    On pydantic v2 validation runs in Rust and model_construct is pure Python, so CONSTRUCT
+    is actually slower than MODEL, RECORD/TUPLE/DICT are the modes that skip the cost.
+'''
+
+class ResultMode(str, Enum):
+    MODEL = "model"
+    CONSTRUCT = "construct"
+    RECORD = "record"
+    TUPLE = "tuple"
+    DICT = "dict"
+
+RobotStateRecord = namedtuple("RobotStateRecord", ["robot_id",
+                                                   "robot_name",
+                                                   "map_uuid",
+                                                   "position_x",
+                                                   "position_y",
+                                                   "position_theta"])
+
+_RESULT_CONVERTERS: Dict[ResultMode, Callable[[Sequence], Any]] = {
+    ResultMode.MODEL: lambda row: LatestRobotState(**dict(zip(RobotStateRecord._fields, row))),
+    ResultMode.CONSTRUCT: lambda row: LatestRobotState.model_construct(**dict(zip(RobotStateRecord._fields, row))),
+    ResultMode.RECORD: RobotStateRecord._make,
+    ResultMode.TUPLE: tuple,
+    ResultMode.DICT: lambda row: dict(zip(RobotStateRecord._fields, row)),
+}
+
+def _convert_robot_states(rows: Iterable[Sequence], result_mode: ResultMode) -> List:
+    '''
+        rows are sequences in RobotStateRecord field order.
+    '''
+    converter = _RESULT_CONVERTERS[ResultMode(result_mode)]
+    return [converter(row) for row in rows]
+
+def _convert_latest_robot_states(robot_states: Sequence[LatestRobotState], result_mode: ResultMode) -> Sequence:
+
+    if result_mode in (ResultMode.MODEL, ResultMode.CONSTRUCT):
+        return robot_states
+
+    rows = (tuple(getattr(robot_state, field) for field in RobotStateRecord._fields) for robot_state in robot_states)
+    return _convert_robot_states(rows, result_mode)
+
+def _robot_state_row(robot_state: RobotState) -> Dict:
+    return {"robot_id": robot_state.robot_id,
+            "map_uuid": robot_state.map_uuid,
+            "position_x": robot_state.position_x,
+            "position_y": robot_state.position_y,
+            "position_theta": robot_state.position_theta}
+
+def _robot_info_row(robot_info: RobotInfo) -> Dict:
+    return {"robot_id": robot_info.robot_id,
+            "robot_name": robot_info.robot_name}
+
+'''
+    NOTE:
+    statements are built once at module level,
+    so that RobotsRepo and AsyncRobotsRepo always send the same SQL.
+
+    The upserts bind every column as one array (see upsert_unnest_stmt), the statement
+    does not depend on the number of rows and is served from the compiled cache.
+'''
+
+'''
+    NOTE:
+    Delta-only robot state upserts
+
+    Parked robots report the same pose over and over, and every UPDATE of an unchanged
+    row still writes a new row version, WAL and work for vacuum. upsert_robot_states
+    drops such reports twice:
+
+    1. in memory, against LastWrittenPoses, before anything is sent to database.
+    2. in database, with ON CONFLICT DO UPDATE ... WHERE, for robots missing from the
+       in-memory cache (restart, eviction). A row for which the guard is false is not
+       updated and not returned by RETURNING, so only really written poses are cached,
+       appended to history and applied to the snapshot.
+
+    pose_epsilon=0.0 only drops exact repeats. The in-memory check assumes this repo is
+    the only writer of its robots, pass pose_cache_size=0 when several processes write
+    the same robots, the database guard still applies.
+'''
+
+# abs() is NULL when either side is NULL, a pose gained or lost is compared with IS NULL
+_POSE_CHANGED_SQL = "robot_states.map_uuid IS DISTINCT FROM EXCLUDED.map_uuid OR " + " OR ".join(
+    "(robot_states.{0} IS NULL) <> (EXCLUDED.{0} IS NULL) "
+    "OR abs(robot_states.{0} - EXCLUDED.{0}) > :pose_epsilon".format(column)
+    for column in ("position_x", "position_y", "position_theta"))
+
+_REGISTER_STMT = upsert_unnest_stmt(RobotInfo.__table__)
+_UPSERT_ROBOT_STATES_STMT = upsert_unnest_stmt(RobotState.__table__, where=_POSE_CHANGED_SQL, returning="robot_id")
+
+UpsertStats = namedtuple("UpsertStats", ["received", "written", "suppressed_in_memory", "suppressed_in_database"])
+
+def _bulk_merge_sql(table: Table) -> Tuple[str, List[str], str, str]:
+
+    staging = "_{}_staging".format(table.name)
+    columns = [column.name for column in table.columns]
+    primary_keys = [column.name for column in table.primary_key]
+    updates = ", ".join("{0} = EXCLUDED.{0}".format(column) for column in columns if column not in primary_keys)
+
+    # _seq keeps the arrival order, so that the last duplicated row wins
+    create_staging_sql = "CREATE TEMP TABLE {} (LIKE {}, _seq BIGSERIAL) ON COMMIT DROP".format(staging, table.name)
+
+    merge_sql = ("INSERT INTO {table} ({columns}) "
+                 "SELECT DISTINCT ON ({keys}) {columns} FROM {staging} ORDER BY {keys}, _seq DESC "
+                 "ON CONFLICT ({keys}) DO UPDATE SET {updates}").format(table=table.name,
+                                                                       columns=", ".join(columns),
+                                                                       keys=", ".join(primary_keys),
+                                                                       staging=staging,
+                                                                       updates=updates)
+
+    return staging, columns, create_staging_sql, merge_sql
+
+# rows per round trip when fetching robot states, was a hard-coded yield_per(10)
+DEFAULT_FETCH_BATCH_SIZE = 1000
+
+def _robot_states_select():
+
+    # select plain columns instead of ORM entities, rows are lightweight named tuples
+    return select(RobotInfo.robot_id,
+                  RobotInfo.robot_name,
+                  RobotState.map_uuid,
+                  RobotState.position_x,
+                  RobotState.position_y,
+                  RobotState.position_theta).join(RobotState, RobotInfo.robot_id == RobotState.robot_id)
+
+def _robot_info_tuples(robot_infos: Iterable[RobotInfo]) -> Iterable[Tuple]:
+    return ((robot_info.robot_id, robot_info.robot_name) for robot_info in robot_infos)
+
+def _robot_state_tuples(robot_states: Iterable[RobotState]) -> Iterable[Tuple]:
+    return ((robot_state.robot_id,
+             robot_state.map_uuid,
+             robot_state.position_x,
+             robot_state.position_y,
+             robot_state.position_theta) for robot_state in robot_states)
+
+def _ordered_robot_names(robot_ids: List[str],
+                         cached_names: Dict[str, str],
+                         fetched_names: Dict[str, str]) -> Dict[str, str]:
+
+    robot_names = {}
+    for robot_id in robot_ids:
+        if robot_id in cached_names:
+            robot_names[robot_id] = cached_names[robot_id]
+        elif robot_id in fetched_names:
+            robot_names[robot_id] = fetched_names[robot_id]
+
+    return robot_names
+
+def _distance(row: Sequence, x: float, y: float) -> float:
+    # rows are in RobotStateRecord field order
+    return math.hypot(row[3] - x, row[4] - y)
+
+def _in_box_select(map_uuid: str, bbox: BBox):
+
+    min_x, min_y, max_x, max_y = bbox
+    return _robot_states_select().where(RobotState.map_uuid == map_uuid,
+                                        RobotState.position_x.between(min_x, max_x),
+                                        RobotState.position_y.between(min_y, max_y))
+
+def _map_extent_select(map_uuid: str):
+
+    return select(func.min(RobotState.position_x),
+                  func.min(RobotState.position_y),
+                  func.max(RobotState.position_x),
+                  func.max(RobotState.position_y)).where(RobotState.map_uuid == map_uuid)
+
+def _covering_radius(extent: BBox, x: float, y: float) -> float:
+    # half-width of the box around (x, y) which holds every robot of the map
+    return max(abs(x - extent[0]), abs(x - extent[2]), abs(y - extent[1]), abs(y - extent[3]))
+
 class RobotsRepo():
     
     def __init__(self, 
                  logger: structlog.stdlib.BoundLogger,
-                 engine: Engine):
+                 engine: Engine,
+                 name_cache_size: int = 1024,
+                 name_cache_ttl: Optional[float] = 60.0,
+                 snapshot: Optional["FleetSnapshot"] = None,
+                 result_mode: ResultMode = ResultMode.MODEL,
+                 history: Optional["RobotStateHistoryRepo"] = None,
+                 router: Optional["ReplicaRouter"] = None,
+                 pose_epsilon: float = 0.0,
+                 pose_cache_size: int = 100_000,
+                 telemetry: Optional["TelemetryStore"] = None):
         
         # register logger handler
         self.logger = logger
@@ -74,106 +322,559 @@ class RobotsRepo():
                                           autoflush=False, 
                                           bind=engine)
 
+        # read-through cache of fetch_robot_name, name_cache_size=0 disables it
+        self.name_cache = RobotNameCache(maxsize=name_cache_size, ttl=name_cache_ttl)
+
+        # optional in-memory fleet state, written through after every commit
+        self.snapshot = snapshot
+
+        # default output type of fetch_robot_states
+        self.result_mode = ResultMode(result_mode)
+
+        # optional append-only pose log, written in the same transaction as robot_states
+        self.history = history
+
+        # optional read replicas of engine, reads go to the primary without it
+        self.router = router
+
+        # upsert_robot_states skips poses which moved less than pose_epsilon, pose_cache_size=0
+        # leaves the check to database only
+        self.pose_epsilon = pose_epsilon
+        self.last_written_poses = LastWrittenPoses(maxsize=pose_cache_size)
+
+        # optional in-memory ring buffers of the last reported poses per robot
+        self.telemetry = telemetry
+
+        # statistics of upsert_robot_states, see upsert_stats()
+        self._received = 0
+        self._written = 0
+        self._suppressed_in_memory = 0
+        self._suppressed_in_database = 0
+
+    def _read(self, read: Callable[[Session], T]) -> T:
+        '''
+            run read(session) on a replica picked by router, on engine without router.
+        '''
+        if self.router is None:
+            with self.session_maker() as session:
+                return read(session)
+
+        return self.router.run_read(read)
+
+    def _mark_write(self):
+
+        # pin the reads of this caller to the primary for the read-your-writes window
+        if self.router is not None:
+            self.router.mark_write()
+
+    @repository_method("RobotsRepo.register")
     def register(self, robot_infos: List[RobotInfo]):
+
+        rows = [_robot_info_row(robot_info) for robot_info in robot_infos]
+        if not rows:
+            return
         
         with self.session_maker() as session:
             try:
-                insert_stmt = insert(RobotInfo).values(
-                    [{
-                        "robot_id": robot_info.robot_id,
-                        "robot_name": robot_info.robot_name,
-                    } for robot_info in robot_infos])
-
-                do_update_stmt = insert_stmt.on_conflict_do_update(
-                    index_elements=[RobotInfo.robot_id],
-                    set_={"robot_name": insert_stmt.excluded.robot_name})
-    
-                session.execute(do_update_stmt)
+                session.execute(_REGISTER_STMT, unnest_params(RobotInfo.__table__, rows))
                 session.commit()
+                self._mark_write()
             except Exception as e:
                 session.rollback()
                 raise UnexpectedError(f"register robot infos failed. ERROR: {str(e)}")
 
-    def upsert_robot_states(self, robot_states: RobotState):
-        
+        # keep cached names in line with what has just been committed
+        self.name_cache.put_many({row["robot_id"]: row["robot_name"] for row in rows})
+        if self.snapshot is not None:
+            self.snapshot.apply_robot_infos(rows)
+
+    def upsert_robot_states(self, robot_states: List[RobotState]):
+
+        self.upsert_robot_state_rows([_robot_state_row(robot_state) for robot_state in robot_states])
+
+    @repository_method("RobotsRepo.upsert_robot_states")
+    def upsert_robot_state_rows(self, rows: List[Dict]):
+        '''
+            upsert_robot_states for rows shaped like RobotState columns, used by RobotStatesWriteBehind.
+        '''
+
+        # every report is a telemetry sample, also the ones dropped as unchanged below
+        if self.telemetry is not None:
+            self.telemetry.append_rows(rows)
+
+        received = len(rows)
+        rows = self.last_written_poses.changed(rows, self.pose_epsilon)
+        self._received += received
+        self._suppressed_in_memory += received - len(rows)
+        if not rows:
+            return
+
+        recorded_at = datetime.now(timezone.utc)
+        if self.history is not None:
+            self.history.ensure_partitions(recorded_at)
+
         with self.session_maker() as session:
             
             try:
-                insert_stmt = insert(RobotState).values(
-                    [{
-                        "robot_id": robot_state.robot_id,
-                        "map_uuid": robot_state.map_uuid,
-                        "position_x": robot_state.position_x,
-                        "position_y": robot_state.position_y,
-                        "position_theta": robot_state.position_theta,
-                    } for robot_state in robot_states])
-
-                do_update_stmt = insert_stmt.on_conflict_do_update(
-                    index_elements=[RobotState.robot_id],
-                    set_={"map_uuid": insert_stmt.excluded.map_uuid,
-                          "position_x": insert_stmt.excluded.position_x,
-                          "position_y": insert_stmt.excluded.position_y,
-                          "position_theta": insert_stmt.excluded.position_theta})
-    
-                session.execute(do_update_stmt)
+                written_ids = set(session.execute(_UPSERT_ROBOT_STATES_STMT,
+                                                  {**unnest_params(RobotState.__table__, rows),
+                                                   "pose_epsilon": self.pose_epsilon}).scalars())
+                written_rows = [row for row in rows if row["robot_id"] in written_ids]
+                if self.history is not None:
+                    self.history.append_in_session(session, written_rows, recorded_at)
                 session.commit()
+                self._mark_write()
             except Exception as e:
                 session.rollback()
                 raise UnexpectedError(f"update robot states failed. ERROR: {str(e)}")
 
-    def fetch_robot_states(self) -> List[LatestRobotState]:
-        
-        robot_states = []
+        self._written += len(written_rows)
+        self._suppressed_in_database += len(rows) - len(written_rows)
+        self.last_written_poses.put_many(written_rows)
+
+        if self.snapshot is not None:
+            self.snapshot.apply_robot_states(written_rows)
+
+    def upsert_stats(self) -> UpsertStats:
+        '''
+            received robot states and how many of them were written or suppressed as unchanged.
+        '''
+        return UpsertStats(self._received, self._written, self._suppressed_in_memory, self._suppressed_in_database)
+
+    @repository_method("RobotsRepo.upsert_robot_states_columnar")
+    def upsert_robot_states_columnar(self, fleet: "FleetArrays"):
+        '''
+            upsert_robot_states for the arrays of fetch_robot_states_columnar, robot_ids must be unique.
+
+            the arrays go to database as they are, unchanged poses are only dropped by the
+            ON CONFLICT guard, not by the in-memory check.
+        '''
+        from repository.robots.columnar import fleet_columns
+
+        columns = fleet_columns(fleet)
+        received = len(columns["robot_id"])
+        if not received:
+            return
+
+        recorded_at = datetime.now(timezone.utc)
+        if self.history is not None:
+            self.history.ensure_partitions(recorded_at)
+
+        written_rows = None
         with self.session_maker() as session:
-            
+
+            try:
+                written_ids = set(session.execute(_UPSERT_ROBOT_STATES_STMT,
+                                                  {**columns, "pose_epsilon": self.pose_epsilon}).scalars())
+                if len(written_ids) < received:
+                    written = [robot_id in written_ids for robot_id in columns["robot_id"]]
+                    columns = {name: [value for value, keep in zip(values, written) if keep]
+                               for name, values in columns.items()}
+
+                # row dicts only when something needs them
+                if self.history is not None or self.snapshot is not None:
+                    written_rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+                if self.history is not None:
+                    self.history.append_in_session(session, written_rows, recorded_at)
+                session.commit()
+                self._mark_write()
+            except Exception as e:
+                session.rollback()
+                raise UnexpectedError(f"update robot states failed. ERROR: {str(e)}")
+
+        self._received += received
+        self._written += len(written_ids)
+        self._suppressed_in_database += received - len(written_ids)
+        self.last_written_poses.put_columns(columns["robot_id"],
+                                            columns["map_uuid"],
+                                            columns["position_x"],
+                                            columns["position_y"],
+                                            columns["position_theta"])
+
+        if self.snapshot is not None:
+            self.snapshot.apply_robot_states(written_rows)
+
+    '''
+        NOTE:
+        Bulk loading path for fleet imports and full-state resyncs.
+
+        insert(...).values([...]) sends one huge parameterised statement and has to be
+        compiled again for every batch size. Instead, rows are streamed with COPY FROM STDIN
+        into a temporary staging table and then merged with one set-based
+        INSERT ... SELECT ... ON CONFLICT DO UPDATE statement.
+
+        The input can be any iterator, so memory usage stays flat for 100k+ rows.
+        If the same robot_id shows up more than once, the last one wins.
+    '''
+
+    @repository_method("RobotsRepo.bulk_load_robot_infos")
+    def bulk_load_robot_infos(self, robot_infos: Iterable[RobotInfo]) -> int:
+
+        try:
+            return self._bulk_merge(RobotInfo.__table__, _robot_info_tuples(robot_infos))
+        finally:
+            # rows were streamed, we do not know which robot names have changed
+            self.name_cache.clear()
+
+    @repository_method("RobotsRepo.bulk_load_robot_states")
+    def bulk_load_robot_states(self, robot_states: Iterable[RobotState]) -> int:
+
+        try:
+            return self._bulk_merge(RobotState.__table__, _robot_state_tuples(robot_states))
+        finally:
+            # rows were streamed, the last written poses are unknown
+            self.last_written_poses.clear()
+
+    def _bulk_merge(self, table: Table, rows: Iterable[Tuple]) -> int:
+
+        staging, columns, create_staging_sql, merge_sql = _bulk_merge_sql(table)
+
+        history = self.history if table is RobotState.__table__ else None
+        recorded_at = datetime.now(timezone.utc)
+        if history is not None:
+            history.ensure_partitions(recorded_at)
+
+        with self.session_maker() as session:
+
+            try:
+                session.execute(text(create_staging_sql))
+
+                dbapi_connection = session.connection().connection.dbapi_connection
+                with dbapi_connection.cursor() as cursor:
+                    copy_rows(cursor, staging, columns, rows)
+
+                result = session.execute(text(merge_sql))
+                if history is not None:
+                    history.append_staging_in_session(session, staging, recorded_at)
+                session.commit()
+                self._mark_write()
+            except Exception as e:
+                session.rollback()
+                raise UnexpectedError(f"bulk load {table.name} failed. ERROR: {str(e)}")
+
+        # rows were streamed, reload the snapshot instead of tracking them
+        if self.snapshot is not None:
+            self.refresh_snapshot()
+
+        return result.rowcount
+
+    @repository_method("RobotsRepo.refresh_snapshot")
+    def refresh_snapshot(self):
+        '''
+            reload the whole fleet snapshot from database.
+        '''
+        with self.session_maker() as session:
+
+            try:
+                robot_infos = [row._asdict() for row in session.query(RobotInfo.robot_id, RobotInfo.robot_name)]
+                robot_states = [row._asdict() for row in session.query(*RobotState.__table__.columns)]
+            except Exception as e:
+                session.rollback()
+                raise UnexpectedError(f"refresh snapshot failed. ERROR: {str(e)}")
+
+        self.snapshot.load(robot_infos, robot_states)
+
+    @repository_method("RobotsRepo.fetch_robot_state")
+    def fetch_robot_state(self, robot_id: str) -> Optional[LatestRobotState]:
+
+        if self.snapshot is not None:
+            return self.snapshot.get(robot_id)
+
+        try:
+            row = self._read(lambda session: session.query(RobotInfo, RobotState) \
+                                                    .join(RobotState, RobotInfo.robot_id == RobotState.robot_id) \
+                                                    .filter(RobotInfo.robot_id == robot_id) \
+                                                    .first())
+        except Exception as e:
+            raise UnexpectedError(f"fetch robot_state failed. ERROR: {str(e)}")
+
+        if row is None:
+            return None
+
+        robot_info, robot_state = row
+        return LatestRobotState(robot_id=robot_info.robot_id,
+                                robot_name=robot_info.robot_name,
+                                map_uuid=robot_state.map_uuid,
+                                position_x=robot_state.position_x,
+                                position_y=robot_state.position_y,
+                                position_theta=robot_state.position_theta)
+
+    @repository_method("RobotsRepo.fetch_robot_states")
+    def fetch_robot_states(self,
+                           batch_size: int = DEFAULT_FETCH_BATCH_SIZE,
+                           result_mode: Optional[ResultMode] = None) -> Sequence:
+        '''
+            result_mode overrides the repo result_mode for this call, see ResultMode.
+
+            with a snapshot, the prebuilt immutable fleet tuple is returned without touching database.
+        '''
+        result_mode = self.result_mode if result_mode is None else ResultMode(result_mode)
+
+        if self.snapshot is not None:
+            return _convert_latest_robot_states(self.snapshot.fleet(), result_mode)
+
+        try:
+            robot_states = _convert_robot_states(self.iter_robot_states(batch_size=batch_size), result_mode)
+        except UnexpectedError:
+            raise
+        except Exception as e:
+            raise UnexpectedError(f"fetch robot_state failed. ERROR: {str(e)}")
+
+        return robot_states
+
+    @repository_method("RobotsRepo.fetch_robot_states_columnar")
+    def fetch_robot_states_columnar(self, buffers: Optional["FleetBuffers"] = None) -> "FleetArrays":
+        '''
+            the fleet as NumPy arrays ordered by robot_id, see repository/robots/columnar.py.
+
+            pass the same FleetBuffers on every poll to fill its preallocated arrays.
+        '''
+        # numpy is only imported by the columnar API
+        from repository.robots.columnar import (
+            FleetBuffers,
+            read_fleet_arrays
+        )
+
+        buffers = FleetBuffers() if buffers is None else buffers
+
+        # the snapshot keeps insertion order, sort it like the database query
+        if self.snapshot is not None:
+            return buffers.fill_from_robot_states(sorted(self.snapshot.fleet(), key=attrgetter("robot_id")))
+
+        def read(session):
+            # both queries of read_fleet_arrays must see the same fleet
+            connection = session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+            return read_fleet_arrays(connection.connection.dbapi_connection,
+                                     RobotState.__tablename__,
+                                     RobotInfo.__tablename__,
+                                     buffers)
+
+        try:
+            return self._read(read)
+        except Exception as e:
+            raise UnexpectedError(f"fetch robot_states columnar failed. ERROR: {str(e)}")
+
+    def iter_robot_states(self,
+                          batch_size: int = DEFAULT_FETCH_BATCH_SIZE,
+                          filter: Optional[ColumnElement] = None,
+                          chunked: bool = False) -> Iterator[Union[Row, List[Row]]]:
+        '''
+            stream joined robot states from database with a server-side cursor.
+
+            rows are fetched batch_size at a time and yielded as soon as they arrive, so memory
+            stays constant no matter how large the fleet is. With chunked=True every fetched batch
+            is yielded as a list of rows.
+
+            filter is an optional where clause, e.g. RobotState.map_uuid == "xxx".
+            The session is held open until the iterator is exhausted or closed.
+        '''
+        query = _robot_states_select()
+        if filter is not None:
+            query = query.where(filter)
+
+        # a half consumed stream cannot be retried on the primary, no run_read here
+        session_maker = self.session_maker if self.router is None else self.router.read_session_maker()
+
+        with session_maker() as session:
+
             try:
                 '''
-                    query multiple tables
+                    NOTE:
+                    stream_results asks psycopg2 for a named (server-side) cursor,
+                    yield_per sets how many rows are fetched per round trip.
                 '''
-                # query = session.query(RobotInfo, RobotState).join(RobotState, RobotInfo.robot_id == RobotState.robot_id).all()
-                query = session.query(RobotInfo, RobotState).join(RobotState, RobotInfo.robot_id == RobotState.robot_id)
-                results = query.yield_per(10)
-                robot_states = [LatestRobotState(robot_id=robot_info.robot_id,
-                                                 robot_name=robot_info.robot_name,
-                                                 map_uuid=robot_state.map_uuid,
-                                                 position_x=robot_state.position_x,
-                                                 position_y=robot_state.position_y,
-                                                 position_theta=robot_state.position_theta) for robot_info, robot_state in results]
+                results = session.execute(query.execution_options(stream_results=True,
+                                                                  yield_per=batch_size))
+                if chunked:
+                    yield from results.partitions()
+                else:
+                    yield from results
             except Exception as e:
                 session.rollback()
-                raise UnexpectedError(f"fetch robot_state failed. ERROR: {str(e)}")
+                raise UnexpectedError(f"iterate robot_states failed. ERROR: {str(e)}")
 
-        return robot_states
+    '''
+        NOTE:
+        Spatial queries on robot positions.
 
-    def fetch_robot_name(self, robot_ids: List[str]) -> List:
-        
-        robot_names = []
-        with self.session_maker() as session:
-            
+        In database they are served by the composite B-tree ix_robot_states_map_position:
+        map_uuid is matched exactly and position_x is a range scan, position_y is checked
+        from the index entries. A GiST index would need a point/PostGIS column, the B-tree
+        works on the existing columns.
+
+        With a snapshot they are answered by the in-process SpatialGrid, no database at all.
+
+        BBox is (min_x, min_y, max_x, max_y).
+    '''
+
+    @repository_method("RobotsRepo.robots_in_box")
+    def robots_in_box(self, map_uuid: str, bbox: BBox, result_mode: Optional[ResultMode] = None) -> Sequence:
+
+        result_mode = self.result_mode if result_mode is None else ResultMode(result_mode)
+
+        if self.snapshot is not None:
+            return _convert_latest_robot_states(self.snapshot.in_box(map_uuid, bbox), result_mode)
+
+        return _convert_robot_states(self._robots_in_box(map_uuid, bbox), result_mode)
+
+    @repository_method("RobotsRepo.robots_within_radius")
+    def robots_within_radius(self,
+                             map_uuid: str,
+                             x: float,
+                             y: float,
+                             radius: float,
+                             result_mode: Optional[ResultMode] = None) -> Sequence:
+
+        result_mode = self.result_mode if result_mode is None else ResultMode(result_mode)
+
+        if self.snapshot is not None:
+            return _convert_latest_robot_states(self.snapshot.within_radius(map_uuid, x, y, radius), result_mode)
+
+        rows = self._robots_in_box(map_uuid, (x - radius, y - radius, x + radius, y + radius))
+        rows = [row for row in rows if _distance(row, x, y) <= radius]
+        return _convert_robot_states(rows, result_mode)
+
+    @repository_method("RobotsRepo.nearest_robots")
+    def nearest_robots(self,
+                       map_uuid: str,
+                       x: float,
+                       y: float,
+                       k: int,
+                       search_radius: float = 10.0,
+                       result_mode: Optional[ResultMode] = None) -> Sequence:
+        '''
+            return the k robots closest to (x, y) on map_uuid, ordered by distance.
+
+            in database, boxes around (x, y) are queried starting with search_radius. Once a box
+            holds k robots and the k-th one is not farther than the box half-width, nothing
+            outside the box can be closer, otherwise the box grows to the k-th distance.
+        '''
+        result_mode = self.result_mode if result_mode is None else ResultMode(result_mode)
+
+        if self.snapshot is not None:
+            return _convert_latest_robot_states(self.snapshot.nearest(map_uuid, x, y, k), result_mode)
+
+        if k <= 0:
+            return []
+
+        radius = search_radius
+        while True:
+            rows = sorted(self._robots_in_box(map_uuid, (x - radius, y - radius, x + radius, y + radius)),
+                          key=lambda row: _distance(row, x, y))
+
+            if len(rows) >= k:
+                kth_distance = _distance(rows[k - 1], x, y)
+                if kth_distance <= radius:
+                    return _convert_robot_states(rows[:k], result_mode)
+                radius = kth_distance
+                continue
+
+            # fewer than k robots in the box, grow it to cover every robot on the map
+            extent = self._map_extent(map_uuid)
+            if extent is None:
+                return []
+
+            covering_radius = _covering_radius(extent, x, y)
+            if radius >= covering_radius:
+                return _convert_robot_states(rows, result_mode)
+            radius = covering_radius
+
+    def _robots_in_box(self, map_uuid: str, bbox: BBox) -> List[Row]:
+
+        query = _in_box_select(map_uuid, bbox)
+
+        try:
+            return self._read(lambda session: session.execute(query).all())
+        except Exception as e:
+            raise UnexpectedError(f"fetch robots in box failed. ERROR: {str(e)}")
+
+    def _map_extent(self, map_uuid: str) -> Optional[BBox]:
+
+        query = _map_extent_select(map_uuid)
+
+        try:
+            extent = self._read(lambda session: session.execute(query).one())
+        except Exception as e:
+            raise UnexpectedError(f"fetch map extent failed. ERROR: {str(e)}")
+
+        return None if extent[0] is None else tuple(extent)
+
+    @repository_method("RobotsRepo.fetch_robot_name")
+    def fetch_robot_name(self, robot_ids: List[str]) -> Dict[str, str]:
+        '''
+            return {robot_id: robot_name} in the order of robot_ids, unknown robot_ids are left out.
+
+            names are served from name_cache, only the missing robot_ids are fetched from database.
+        '''
+        cached_names, missing_ids = self.name_cache.get_many(dict.fromkeys(robot_ids))
+
+        fetched_names = {}
+        if missing_ids:
             try:
                 '''
                     NOTE:
                     in sqlalchemy, we can use in_ function filter table by a list
                 '''
-                robot_names: Row = session.query(RobotInfo.robot_name).filter(RobotInfo.robot_id.in_(robot_ids)).yield_per(10)
-                
-                # use zip two list
-                robot_names: List[str] = [row.robot_name for row in robot_names]
-                # robot_names = dict(zip(robot_ids, robot_names))
+                fetched_names = self._read(
+                    lambda session: {row.robot_id: row.robot_name
+                                     for row in session.query(RobotInfo.robot_id, RobotInfo.robot_name)
+                                                       .filter(RobotInfo.robot_id.in_(missing_ids))})
             except Exception as e:
-                session.rollback()
                 raise UnexpectedError(f"fetch robot_name failed. ERROR: {str(e)}")
-        
-        return robot_names
 
+            self.name_cache.put_many(fetched_names)
 
-def setup_robots_repo(logger: structlog.stdlib.BoundLogger, engine: Engine) -> RobotsRepo:
-    
+        return _ordered_robot_names(robot_ids, cached_names, fetched_names)
+
+    def name_cache_info(self) -> CacheInfo:
+        return self.name_cache.cache_info()
+
+
+def create_robots_schema(bind: Union[Engine, Connection]):
+    '''
+        tables and indexes of the robots repo, shared by the sync and the async setup
+        (AsyncConnection.run_sync passes a Connection).
+    '''
     # create database table
-    _ROBOTS_REPO_BASE.metadata.create_all(engine)
+    _ROBOTS_REPO_BASE.metadata.create_all(bind)
+
+    # create_all skips indexes of tables which already exist
+    for index in RobotState.__table__.indexes:
+        index.create(bind, checkfirst=True)
+
+def setup_robots_repo(logger: structlog.stdlib.BoundLogger,
+                      engine: Engine,
+                      enable_snapshot: bool = False,
+                      history: Optional["RobotStateHistoryRepo"] = None,
+                      create_tables: bool = True,
+                      router: Optional["ReplicaRouter"] = None,
+                      pose_epsilon: float = 0.0,
+                      telemetry: Optional["TelemetryStore"] = None,
+                      name_cache_size: int = 1024,
+                      name_cache_ttl: Optional[float] = 60.0,
+                      result_mode: ResultMode = ResultMode.MODEL,
+                      pose_cache_size: int = 100_000) -> RobotsRepo:
+    
+    # create_tables=False skips every DDL and catalog query, the schema is created by bootstrap.py
+    if create_tables:
+        create_robots_schema(engine)
     
     robots_repo = RobotsRepo(logger=logger,
-                             engine=engine)
+                             engine=engine,
+                             name_cache_size=name_cache_size,
+                             name_cache_ttl=name_cache_ttl,
+                             result_mode=result_mode,
+                             history=history,
+                             router=router,
+                             pose_epsilon=pose_epsilon,
+                             pose_cache_size=pose_cache_size,
+                             telemetry=telemetry)
+
+    if enable_snapshot:
+        from repository.robots.snapshot import FleetSnapshot
+
+        robots_repo.snapshot = FleetSnapshot()
+        robots_repo.refresh_snapshot()
     
     return robots_repo
 
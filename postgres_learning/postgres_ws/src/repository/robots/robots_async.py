@@ -0,0 +1,404 @@
+import structlog
+
+from typing import (
+    List,
+    Dict,
+    Iterable,
+    Optional,
+    Sequence,
+    Union,
+    AsyncIterator
+)
+
+from sqlalchemy import (
+    Table,
+    ColumnElement,
+    select,
+    text
+)
+
+from sqlalchemy.engine.row import Row
+
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    async_sessionmaker
+)
+
+from repository.robots.robots import (
+    create_robots_schema,
+    UnexpectedError,
+    RobotInfo,
+    RobotState,
+    _robot_info_row,
+    _robot_state_row,
+    _REGISTER_STMT,
+    _UPSERT_ROBOT_STATES_STMT,
+    _bulk_merge_sql,
+    _robot_info_tuples,
+    _robot_state_tuples,
+    _ordered_robot_names,
+    _robot_states_select,
+    _convert_robot_states,
+    _distance,
+    _in_box_select,
+    _map_extent_select,
+    _covering_radius,
+    DEFAULT_FETCH_BATCH_SIZE,
+    ResultMode,
+    UpsertStats
+)
+from helpers.instrumentation import repository_method
+from helpers.postgres_helpers import unnest_params
+from repository.robots.spatial import BBox
+from repository.robots.cache import (
+    CacheInfo,
+    RobotNameCache,
+    LastWrittenPoses
+)
+
+'''
+    NOTE:
+    AsyncRobotsRepo has the same methods as RobotsRepo, but as coroutines.
+
+    It runs on create_async_engine + asyncpg, so the event loop is never blocked by
+    socket I/O and no thread pool is needed. Tables, rows and statements are shared
+    with RobotsRepo, both repos always send the same SQL.
+
+    Not ported, use RobotsRepo for them:
+
+    1. snapshot (FleetSnapshot), spatial reads always query the database.
+    2. history (RobotStateHistoryRepo) and telemetry (TelemetryStore).
+    3. router (ReplicaRouter), every read goes to engine.
+    4. the columnar API (fetch_robot_states_columnar/upsert_robot_states_columnar),
+       asyncpg has no COPY into a NumPy buffer.
+'''
+
+class AsyncRobotsRepo():
+
+    def __init__(self,
+                 logger: structlog.stdlib.BoundLogger,
+                 engine: AsyncEngine,
+                 name_cache_size: int = 1024,
+                 name_cache_ttl: Optional[float] = 60.0,
+                 result_mode: ResultMode = ResultMode.MODEL,
+                 pose_epsilon: float = 0.0,
+                 pose_cache_size: int = 100_000):
+
+        # register logger handler
+        self.logger = logger
+
+        # register engine
+        self.engine = engine
+        self.session_maker = async_sessionmaker(autoflush=False,
+                                                expire_on_commit=False,
+                                                bind=engine)
+
+        # read-through cache of fetch_robot_name, name_cache_size=0 disables it
+        self.name_cache = RobotNameCache(maxsize=name_cache_size, ttl=name_cache_ttl)
+
+        # default output type of fetch_robot_states
+        self.result_mode = ResultMode(result_mode)
+
+        # delta-only upserts, see RobotsRepo
+        self.pose_epsilon = pose_epsilon
+        self.last_written_poses = LastWrittenPoses(maxsize=pose_cache_size)
+
+        self._received = 0
+        self._written = 0
+        self._suppressed_in_memory = 0
+        self._suppressed_in_database = 0
+
+    @repository_method("AsyncRobotsRepo.register")
+    async def register(self, robot_infos: List[RobotInfo]):
+
+        rows = [_robot_info_row(robot_info) for robot_info in robot_infos]
+        if not rows:
+            return
+
+        async with self.session_maker() as session:
+            try:
+                await session.execute(_REGISTER_STMT, unnest_params(RobotInfo.__table__, rows))
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                raise UnexpectedError(f"register robot infos failed. ERROR: {str(e)}")
+
+        self.name_cache.put_many({row["robot_id"]: row["robot_name"] for row in rows})
+
+    async def upsert_robot_states(self, robot_states: List[RobotState]):
+
+        await self.upsert_robot_state_rows([_robot_state_row(robot_state) for robot_state in robot_states])
+
+    @repository_method("AsyncRobotsRepo.upsert_robot_states")
+    async def upsert_robot_state_rows(self, rows: List[Dict]):
+        '''
+            upsert_robot_states for rows shaped like RobotState columns, used by RobotStatesWriteBehind.
+        '''
+
+        received = len(rows)
+        rows = self.last_written_poses.changed(rows, self.pose_epsilon)
+        self._received += received
+        self._suppressed_in_memory += received - len(rows)
+        if not rows:
+            return
+
+        async with self.session_maker() as session:
+            try:
+                result = await session.execute(_UPSERT_ROBOT_STATES_STMT,
+                                               {**unnest_params(RobotState.__table__, rows),
+                                                "pose_epsilon": self.pose_epsilon})
+                written_ids = set(result.scalars())
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                raise UnexpectedError(f"update robot states failed. ERROR: {str(e)}")
+
+        written_rows = [row for row in rows if row["robot_id"] in written_ids]
+        self._written += len(written_rows)
+        self._suppressed_in_database += len(rows) - len(written_rows)
+        self.last_written_poses.put_many(written_rows)
+
+    def upsert_stats(self) -> UpsertStats:
+        return UpsertStats(self._received, self._written, self._suppressed_in_memory, self._suppressed_in_database)
+
+    @repository_method("AsyncRobotsRepo.bulk_load_robot_infos")
+    async def bulk_load_robot_infos(self, robot_infos: Iterable[RobotInfo]) -> int:
+
+        try:
+            return await self._bulk_merge(RobotInfo.__table__, _robot_info_tuples(robot_infos))
+        finally:
+            self.name_cache.clear()
+
+    @repository_method("AsyncRobotsRepo.bulk_load_robot_states")
+    async def bulk_load_robot_states(self, robot_states: Iterable[RobotState]) -> int:
+
+        try:
+            return await self._bulk_merge(RobotState.__table__, _robot_state_tuples(robot_states))
+        finally:
+            self.last_written_poses.clear()
+
+    async def _bulk_merge(self, table: Table, rows: Iterable[tuple]) -> int:
+
+        staging, columns, create_staging_sql, merge_sql = _bulk_merge_sql(table)
+
+        async with self.session_maker() as session:
+            try:
+                await session.execute(text(create_staging_sql))
+
+                # asyncpg speaks the binary COPY protocol itself
+                connection = await session.connection()
+                raw_connection = await connection.get_raw_connection()
+                await raw_connection.driver_connection.copy_records_to_table(staging,
+                                                                             records=rows,
+                                                                             columns=columns)
+
+                result = await session.execute(text(merge_sql))
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                raise UnexpectedError(f"bulk load {table.name} failed. ERROR: {str(e)}")
+
+        return result.rowcount
+
+    @repository_method("AsyncRobotsRepo.fetch_robot_states")
+    async def fetch_robot_states(self,
+                                 batch_size: int = DEFAULT_FETCH_BATCH_SIZE,
+                                 result_mode: Optional[ResultMode] = None) -> List:
+
+        result_mode = self.result_mode if result_mode is None else ResultMode(result_mode)
+
+        try:
+            rows = [row async for row in self.iter_robot_states(batch_size=batch_size)]
+            robot_states = _convert_robot_states(rows, result_mode)
+        except UnexpectedError:
+            raise
+        except Exception as e:
+            raise UnexpectedError(f"fetch robot_state failed. ERROR: {str(e)}")
+
+        return robot_states
+
+    async def iter_robot_states(self,
+                                batch_size: int = DEFAULT_FETCH_BATCH_SIZE,
+                                filter: Optional[ColumnElement] = None,
+                                chunked: bool = False) -> AsyncIterator[Union[Row, List[Row]]]:
+
+        query = _robot_states_select()
+        if filter is not None:
+            query = query.where(filter)
+
+        async with self.session_maker() as session:
+            try:
+                results = await session.stream(query.execution_options(yield_per=batch_size))
+                async for partition in results.partitions():
+                    if chunked:
+                        yield partition
+                    else:
+                        for row in partition:
+                            yield row
+            except Exception as e:
+                await session.rollback()
+                raise UnexpectedError(f"iterate robot_states failed. ERROR: {str(e)}")
+
+    @repository_method("AsyncRobotsRepo.robots_in_box")
+    async def robots_in_box(self, map_uuid: str, bbox: BBox, result_mode: Optional[ResultMode] = None) -> Sequence:
+
+        result_mode = self.result_mode if result_mode is None else ResultMode(result_mode)
+        return _convert_robot_states(await self._robots_in_box(map_uuid, bbox), result_mode)
+
+    @repository_method("AsyncRobotsRepo.robots_within_radius")
+    async def robots_within_radius(self,
+                                   map_uuid: str,
+                                   x: float,
+                                   y: float,
+                                   radius: float,
+                                   result_mode: Optional[ResultMode] = None) -> Sequence:
+
+        result_mode = self.result_mode if result_mode is None else ResultMode(result_mode)
+
+        rows = await self._robots_in_box(map_uuid, (x - radius, y - radius, x + radius, y + radius))
+        rows = [row for row in rows if _distance(row, x, y) <= radius]
+        return _convert_robot_states(rows, result_mode)
+
+    @repository_method("AsyncRobotsRepo.nearest_robots")
+    async def nearest_robots(self,
+                             map_uuid: str,
+                             x: float,
+                             y: float,
+                             k: int,
+                             search_radius: float = 10.0,
+                             result_mode: Optional[ResultMode] = None) -> Sequence:
+        '''
+            return the k robots closest to (x, y) on map_uuid, ordered by distance, see RobotsRepo.nearest_robots.
+        '''
+        result_mode = self.result_mode if result_mode is None else ResultMode(result_mode)
+
+        if k <= 0:
+            return []
+
+        radius = search_radius
+        while True:
+            rows = sorted(await self._robots_in_box(map_uuid, (x - radius, y - radius, x + radius, y + radius)),
+                          key=lambda row: _distance(row, x, y))
+
+            if len(rows) >= k:
+                kth_distance = _distance(rows[k - 1], x, y)
+                if kth_distance <= radius:
+                    return _convert_robot_states(rows[:k], result_mode)
+                radius = kth_distance
+                continue
+
+            # fewer than k robots in the box, grow it to cover every robot on the map
+            extent = await self._map_extent(map_uuid)
+            if extent is None:
+                return []
+
+            covering_radius = _covering_radius(extent, x, y)
+            if radius >= covering_radius:
+                return _convert_robot_states(rows, result_mode)
+            radius = covering_radius
+
+    async def _robots_in_box(self, map_uuid: str, bbox: BBox) -> List[Row]:
+
+        async with self.session_maker() as session:
+            try:
+                return (await session.execute(_in_box_select(map_uuid, bbox))).all()
+            except Exception as e:
+                await session.rollback()
+                raise UnexpectedError(f"fetch robots in box failed. ERROR: {str(e)}")
+
+    async def _map_extent(self, map_uuid: str) -> Optional[BBox]:
+
+        async with self.session_maker() as session:
+            try:
+                extent = (await session.execute(_map_extent_select(map_uuid))).one()
+            except Exception as e:
+                await session.rollback()
+                raise UnexpectedError(f"fetch map extent failed. ERROR: {str(e)}")
+
+        return None if extent[0] is None else tuple(extent)
+
+    @repository_method("AsyncRobotsRepo.fetch_robot_name")
+    async def fetch_robot_name(self, robot_ids: List[str]) -> Dict[str, str]:
+
+        cached_names, missing_ids = self.name_cache.get_many(dict.fromkeys(robot_ids))
+
+        fetched_names = {}
+        if missing_ids:
+            async with self.session_maker() as session:
+                try:
+                    rows = await session.execute(select(RobotInfo.robot_id, RobotInfo.robot_name)
+                                                 .filter(RobotInfo.robot_id.in_(missing_ids)))
+                    fetched_names = {row.robot_id: row.robot_name for row in rows}
+                except Exception as e:
+                    await session.rollback()
+                    raise UnexpectedError(f"fetch robot_name failed. ERROR: {str(e)}")
+
+            self.name_cache.put_many(fetched_names)
+
+        return _ordered_robot_names(robot_ids, cached_names, fetched_names)
+
+    def name_cache_info(self) -> CacheInfo:
+        return self.name_cache.cache_info()
+
+
+async def setup_async_robots_repo(logger: structlog.stdlib.BoundLogger,
+                                  engine: AsyncEngine,
+                                  create_tables: bool = True,
+                                  name_cache_size: int = 1024,
+                                  name_cache_ttl: Optional[float] = 60.0,
+                                  result_mode: ResultMode = ResultMode.MODEL,
+                                  pose_epsilon: float = 0.0,
+                                  pose_cache_size: int = 100_000) -> AsyncRobotsRepo:
+
+    # create database table and the indexes the map and spatial queries rely on
+    if create_tables:
+        async with engine.begin() as conn:
+            await conn.run_sync(create_robots_schema)
+
+    robots_repo = AsyncRobotsRepo(logger=logger,
+                                  engine=engine,
+                                  name_cache_size=name_cache_size,
+                                  name_cache_ttl=name_cache_ttl,
+                                  result_mode=result_mode,
+                                  pose_epsilon=pose_epsilon,
+                                  pose_cache_size=pose_cache_size)
+
+    return robots_repo
+
+if __name__ == "__main__":
+
+    import asyncio
+
+    from helpers.postgres_helpers import connect_to_postgres_async
+    from config.settings import settings
+
+    async def main():
+
+        pg_engine = await connect_to_postgres_async(
+            host=settings.host,
+            port=settings.port,
+            db_name=settings.db_name,
+            user=settings.user,
+            password=settings.password
+        )
+
+        robots_repo = await setup_async_robots_repo(logger=structlog.get_logger(), engine=pg_engine)
+
+        await robots_repo.register([RobotInfo(robot_id="smr01", robot_name="01"),
+                                    RobotInfo(robot_id="smr02", robot_name="02")])
+
+        await robots_repo.upsert_robot_states([RobotState(robot_id="smr01",
+                                                          map_uuid="xxx",
+                                                          position_x=0.0,
+                                                          position_y=0.0,
+                                                          position_theta=0.0)])
+
+        robot_names = await robots_repo.fetch_robot_name(robot_ids=["smr01", "smr02"])
+        structlog.get_logger().info(robot_names)
+
+        robot_states = await robots_repo.fetch_robot_states()
+        structlog.get_logger().info(robot_states)
+
+        await pg_engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,764 @@
+import asyncio
+
+from datetime import (
+    datetime,
+    timedelta,
+    timezone
+)
+
+import pytest
+import structlog
+import numpy as np
+import structlog.testing
+from assertpy import assert_that
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from config.settings import settings
+from helpers import postgres_helpers
+from helpers.instrumentation import (
+    CompileCacheStats,
+    setup_query_instrumentation
+)
+from repository.robots import robots
+from repository.robots.history import (
+    RobotStateHistoryRepo,
+    setup_robot_state_history_repo
+)
+from repository.robots.robots_async import setup_async_robots_repo
+from repository.robots.sharding import (
+    HashRing,
+    setup_sharded_robots_repo
+)
+from repository.robots.change_feed import (
+    setup_robot_state_change_feed,
+    Subscription,
+    RobotStateChange
+)
+from repository.robots.columnar import (
+    FleetArrays,
+    FleetBuffers
+)
+from repository.robots.write_behind import (
+    RobotStatesWriteBehind,
+    BufferFullError
+)
+from repository.robots.telemetry import TelemetryStore
+from repository.robots.snapshot import FleetSnapshot
+
+@pytest.fixture(scope="module")
+def robots_repo() -> robots.RobotsRepo:
+
+    pg_engine = postgres_helpers.connect_to_postgres(
+        host=settings.host,
+        port=settings.port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password,
+    )
+
+    return robots.setup_robots_repo(logger=structlog.get_logger(), engine=pg_engine)
+
+def _robot_state(robot_id: str, x: float) -> robots.RobotState:
+    return robots.RobotState(robot_id=robot_id,
+                             map_uuid="test-map",
+                             position_x=x,
+                             position_y=0.0,
+                             position_theta=0.0)
+
+def test_write_behind_keeps_latest_pose(robots_repo: robots.RobotsRepo):
+
+    robots_repo.register([robots.RobotInfo(robot_id="wb-smr01", robot_name="wb01"),
+                          robots.RobotInfo(robot_id="wb-smr02", robot_name="wb02")])
+
+    with RobotStatesWriteBehind(robots_repo, flush_interval=60.0) as buffer:
+        for x in range(10):
+            buffer.put([_robot_state("wb-smr01", float(x)),
+                        _robot_state("wb-smr02", float(-x))])
+
+        assert_that(buffer.pending()).is_equal_to(2)
+        assert_that(buffer.coalesced).is_equal_to(18)
+
+        buffer.flush()
+        assert_that(buffer.flushed_batches).is_equal_to(1)
+
+    positions = {state.robot_id: state.position_x for state in robots_repo.fetch_robot_states()}
+    assert_that(positions).contains_entry({"wb-smr01": 9.0}, {"wb-smr02": -9.0})
+
+def test_write_behind_flushes_in_bounded_batches(robots_repo: robots.RobotsRepo, monkeypatch):
+
+    robot_ids = [f"wb-smr1{i}" for i in range(5)]
+    robots_repo.register([robots.RobotInfo(robot_id=robot_id, robot_name=robot_id) for robot_id in robot_ids])
+
+    sizes = []
+    upsert_robot_state_rows = robots_repo.upsert_robot_state_rows
+
+    def failing_third_batch(rows):
+        sizes.append(len(rows))
+        if len(sizes) == 3:
+            raise robots.UnexpectedError("third batch failed")
+        upsert_robot_state_rows(rows)
+
+    monkeypatch.setattr(robots_repo, "upsert_robot_state_rows", failing_third_batch)
+
+    buffer = RobotStatesWriteBehind(robots_repo, max_batch_size=2, flush_interval=60.0, max_pending=10)
+    buffer.put([_robot_state(robot_id, 1.0) for robot_id in robot_ids])
+    with pytest.raises(robots.UnexpectedError):
+        buffer.flush()
+
+    # two batches of two written, the last robot is back in the buffer
+    assert_that(sizes).is_equal_to([2, 2, 1])
+    assert_that((buffer.flushed_batches, buffer.flushed_rows, buffer.pending())).is_equal_to((2, 4, 1))
+
+    buffer.close()
+    assert_that((buffer.flushed_batches, buffer.pending())).is_equal_to((3, 0))
+
+def test_write_behind_backpressure(robots_repo: robots.RobotsRepo):
+
+    buffer = RobotStatesWriteBehind(robots_repo,
+                                    max_batch_size=2,
+                                    flush_interval=60.0,
+                                    max_pending=2,
+                                    put_timeout=0.0)
+
+    # hold the flush lock so that the flusher cannot drain the buffer
+    with buffer._flush_lock:
+        buffer.put([_robot_state("wb-smr01", 1.0), _robot_state("wb-smr02", 1.0)])
+        with pytest.raises(BufferFullError):
+            buffer.put([_robot_state("wb-smr03", 1.0)])
+
+    buffer.close()
+    assert_that(buffer.pending()).is_zero()
+
+def test_bulk_load_robot_states_last_row_wins(robots_repo: robots.RobotsRepo):
+
+    robot_infos = (robots.RobotInfo(robot_id=f"bulk-smr{i:03d}", robot_name=f"bulk\t{i}") for i in range(100))
+    assert_that(robots_repo.bulk_load_robot_infos(robot_infos)).is_equal_to(100)
+
+    robot_states = (_robot_state(f"bulk-smr{i % 100:03d}", float(i)) for i in range(300))
+    assert_that(robots_repo.bulk_load_robot_states(robot_states)).is_equal_to(100)
+
+    states = {state.robot_id: state for state in robots_repo.fetch_robot_states()}
+    assert_that(states["bulk-smr042"].robot_name).is_equal_to("bulk\t42")
+    assert_that(states["bulk-smr042"].position_x).is_equal_to(242.0)
+
+def test_async_robots_repo_round_trip():
+
+    async def round_trip():
+
+        pg_engine = await postgres_helpers.connect_to_postgres_async(
+            host=settings.host,
+            port=settings.port,
+            db_name=settings.db_name,
+            user=settings.user,
+            password=settings.password,
+        )
+
+        try:
+            robots_repo = await setup_async_robots_repo(logger=structlog.get_logger(), engine=pg_engine)
+
+            await robots_repo.register([robots.RobotInfo(robot_id="async-smr01", robot_name="async01")])
+            await robots_repo.upsert_robot_states([_robot_state("async-smr01", 1.0)])
+            await robots_repo.bulk_load_robot_states(_robot_state("async-smr01", float(x)) for x in range(5))
+
+            return await robots_repo.fetch_robot_name(["async-smr01"]), await robots_repo.fetch_robot_states()
+        finally:
+            await pg_engine.dispose()
+
+    robot_names, robot_states = asyncio.run(round_trip())
+
+    assert_that(robot_names).is_equal_to({"async-smr01": "async01"})
+    assert_that({state.robot_id: state.position_x for state in robot_states}).contains_entry({"async-smr01": 4.0})
+
+def test_async_spatial_queries_match_robots_repo(robots_repo: robots.RobotsRepo):
+
+    positions = {"ageo-smr01": (0.0, 0.0), "ageo-smr02": (3.0, 4.0), "ageo-smr03": (-1.0, 1.0), "ageo-smr04": (50.0, 50.0)}
+    robots_repo.register([robots.RobotInfo(robot_id=robot_id, robot_name=robot_id) for robot_id in positions])
+    robots_repo.upsert_robot_states([robots.RobotState(robot_id=robot_id,
+                                                       map_uuid="ageo-map",
+                                                       position_x=x,
+                                                       position_y=y,
+                                                       position_theta=0.0) for robot_id, (x, y) in positions.items()])
+
+    async def spatial_queries():
+
+        pg_engine = await postgres_helpers.connect_to_postgres_async(
+            host=settings.host,
+            port=settings.port,
+            db_name=settings.db_name,
+            user=settings.user,
+            password=settings.password,
+        )
+
+        try:
+            async_repo = await setup_async_robots_repo(logger=structlog.get_logger(),
+                                                       engine=pg_engine,
+                                                       create_tables=False,
+                                                       result_mode=robots.ResultMode.RECORD)
+            return (await async_repo.robots_in_box("ageo-map", (-2.0, -2.0, 3.0, 4.0)),
+                    await async_repo.robots_within_radius("ageo-map", 0.0, 0.0, 2.0),
+                    await async_repo.nearest_robots("ageo-map", 2.0, 3.5, 2, search_radius=0.5),
+                    await async_repo.nearest_robots("ageo-map", 0.0, 0.0, 10))
+        finally:
+            await pg_engine.dispose()
+
+    in_box, within, nearest, everyone = asyncio.run(spatial_queries())
+
+    assert_that(sorted(record.robot_id for record in in_box)).is_equal_to(["ageo-smr01", "ageo-smr02", "ageo-smr03"])
+    assert_that(sorted(record.robot_id for record in within)).is_equal_to(["ageo-smr01", "ageo-smr03"])
+    assert_that([record.robot_id for record in nearest]).is_equal_to(["ageo-smr02", "ageo-smr03"])
+    assert_that(everyone).is_equal_to(robots_repo.nearest_robots("ageo-map", 0.0, 0.0, 10, result_mode=robots.ResultMode.RECORD))
+
+def test_async_setup_creates_indexes_on_existing_tables(robots_repo: robots.RobotsRepo):
+
+    def map_position_index_exists() -> bool:
+        with robots_repo.engine.connect() as conn:
+            return conn.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_robot_states_map_position'")).first() is not None
+
+    with robots_repo.engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_robot_states_map_position"))
+    assert_that(map_position_index_exists()).is_false()
+
+    async def setup():
+
+        pg_engine = await postgres_helpers.connect_to_postgres_async(
+            host=settings.host,
+            port=settings.port,
+            db_name=settings.db_name,
+            user=settings.user,
+            password=settings.password,
+        )
+
+        try:
+            await setup_async_robots_repo(logger=structlog.get_logger(), engine=pg_engine)
+        finally:
+            await pg_engine.dispose()
+
+    asyncio.run(setup())
+    assert_that(map_position_index_exists()).is_true()
+
+def test_fetch_robot_name_is_cached_and_ordered(robots_repo: robots.RobotsRepo):
+
+    robots_repo.register([robots.RobotInfo(robot_id="cache-smr01", robot_name="c01"),
+                          robots.RobotInfo(robot_id="cache-smr02", robot_name="c02")])
+    robots_repo.name_cache.clear()
+    hits, misses = robots_repo.name_cache_info()[:2]
+
+    robot_names = robots_repo.fetch_robot_name(["cache-smr02", "unknown", "cache-smr01"])
+    assert_that(list(robot_names.items())).is_equal_to([("cache-smr02", "c02"), ("cache-smr01", "c01")])
+
+    robots_repo.fetch_robot_name(["cache-smr01", "cache-smr02"])
+    assert_that(robots_repo.name_cache_info().hits).is_equal_to(hits + 2)
+    assert_that(robots_repo.name_cache_info().misses).is_equal_to(misses + 3)
+
+    # register updates cached names
+    robots_repo.register([robots.RobotInfo(robot_id="cache-smr01", robot_name="renamed")])
+    assert_that(robots_repo.fetch_robot_name(["cache-smr01"])).is_equal_to({"cache-smr01": "renamed"})
+
+def test_setup_robots_repo_passes_cache_and_result_mode_options(robots_repo: robots.RobotsRepo):
+
+    configured_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                               engine=robots_repo.engine,
+                                               create_tables=False,
+                                               name_cache_size=0,
+                                               name_cache_ttl=None,
+                                               result_mode=robots.ResultMode.RECORD,
+                                               pose_cache_size=0)
+
+    assert_that(configured_repo.name_cache_info().maxsize).is_zero()
+    assert_that(configured_repo.last_written_poses.maxsize).is_zero()
+    assert_that(configured_repo.fetch_robot_states()[0]).is_instance_of(robots.RobotStateRecord)
+
+def test_snapshot_serves_reads_from_memory(robots_repo: robots.RobotsRepo):
+
+    snapshot_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                             engine=robots_repo.engine,
+                                             enable_snapshot=True)
+
+    snapshot_repo.register([robots.RobotInfo(robot_id="snap-smr01", robot_name="s01")])
+    snapshot_repo.upsert_robot_states([_robot_state("snap-smr01", 3.0)])
+
+    fleet = snapshot_repo.fetch_robot_states()
+    assert_that(snapshot_repo.fetch_robot_states()).is_same_as(fleet)
+    assert_that(snapshot_repo.fetch_robot_state("snap-smr01").position_x).is_equal_to(3.0)
+
+    snapshot_repo.upsert_robot_states([_robot_state("snap-smr01", 4.0)])
+    assert_that(snapshot_repo.fetch_robot_states()).is_not_same_as(fleet)
+    assert_that(snapshot_repo.fetch_robot_state("snap-smr01").position_x).is_equal_to(4.0)
+
+    # the snapshot matches what is stored in database
+    assert_that(robots_repo.fetch_robot_state("snap-smr01")).is_equal_to(snapshot_repo.fetch_robot_state("snap-smr01"))
+
+def test_snapshot_keeps_robots_without_position():
+
+    snapshot = FleetSnapshot()
+    snapshot.apply_robot_infos([{"robot_id": "snap-smr02", "robot_name": "s02"}])
+    snapshot.apply_robot_states([{"robot_id": "snap-smr02",
+                                  "map_uuid": "snap-map",
+                                  "position_x": None,
+                                  "position_y": None,
+                                  "position_theta": None}])
+
+    assert_that(snapshot.get("snap-smr02").position_x).is_none()
+    assert_that(snapshot.in_box("snap-map", (-1e9, -1e9, 1e9, 1e9))).is_empty()
+
+def test_snapshot_keeps_robots_registered_without_name():
+
+    snapshot = FleetSnapshot()
+    snapshot.apply_robot_infos([{"robot_id": "snap-smr04", "robot_name": None}])
+    snapshot.apply_robot_states([{"robot_id": "snap-smr04",
+                                  "map_uuid": "snap-map",
+                                  "position_x": 1.0,
+                                  "position_y": 1.0,
+                                  "position_theta": 0.0}])
+
+    assert_that(snapshot.get("snap-smr04").robot_name).is_none()
+    assert_that([robot_state.robot_id for robot_state in snapshot.nearest("snap-map", 0.0, 0.0, 1)]).is_equal_to(
+        ["snap-smr04"])
+
+def test_snapshot_keeps_robots_with_nan_position(robots_repo: robots.RobotsRepo):
+
+    snapshot_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                             engine=robots_repo.engine,
+                                             enable_snapshot=True)
+    snapshot_repo.register([robots.RobotInfo(robot_id="snap-smr03", robot_name="s03")])
+
+    snapshot_repo.upsert_robot_states([robots.RobotState(robot_id="snap-smr03",
+                                                         map_uuid="snap-nan-map",
+                                                         position_x=float("nan"),
+                                                         position_y=float("inf"),
+                                                         position_theta=0.0)])
+
+    assert_that(np.isnan(snapshot_repo.fetch_robot_state("snap-smr03").position_x)).is_true()
+    assert_that(snapshot_repo.nearest_robots("snap-nan-map", 0.0, 0.0, 1)).is_empty()
+
+    snapshot_repo.upsert_robot_states([robots.RobotState(robot_id="snap-smr03",
+                                                         map_uuid="snap-nan-map",
+                                                         position_x=1.0,
+                                                         position_y=1.0,
+                                                         position_theta=0.0)])
+    assert_that([robot_state.robot_id for robot_state in snapshot_repo.nearest_robots("snap-nan-map", 0.0, 0.0, 1)]).is_equal_to(
+        ["snap-smr03"])
+
+def test_iter_robot_states_streams_in_chunks(robots_repo: robots.RobotsRepo):
+
+    robots_repo.bulk_load_robot_infos(robots.RobotInfo(robot_id=f"iter-smr{i:02d}", robot_name=f"{i}") for i in range(25))
+    robots_repo.bulk_load_robot_states(robots.RobotState(robot_id=f"iter-smr{i:02d}",
+                                                         map_uuid="iter-map",
+                                                         position_x=float(i),
+                                                         position_y=0.0,
+                                                         position_theta=0.0) for i in range(25))
+
+    chunks = list(robots_repo.iter_robot_states(batch_size=10,
+                                                filter=robots.RobotState.map_uuid == "iter-map",
+                                                chunked=True))
+    assert_that([len(chunk) for chunk in chunks]).is_equal_to([10, 10, 5])
+
+    rows = robots_repo.iter_robot_states(batch_size=10, filter=robots.RobotState.map_uuid == "iter-map")
+    first = next(rows)
+    assert_that(first.map_uuid).is_equal_to("iter-map")
+    rows.close()
+
+def _as_record(robot_state) -> robots.RobotStateRecord:
+
+    if isinstance(robot_state, dict):
+        return robots.RobotStateRecord(**robot_state)
+    if isinstance(robot_state, robots.LatestRobotState):
+        return robots.RobotStateRecord(**robot_state.model_dump())
+    return robots.RobotStateRecord._make(robot_state)
+
+@pytest.mark.parametrize("result_mode, expected_type", [
+    (robots.ResultMode.MODEL, robots.LatestRobotState),
+    (robots.ResultMode.CONSTRUCT, robots.LatestRobotState),
+    (robots.ResultMode.RECORD, robots.RobotStateRecord),
+    (robots.ResultMode.TUPLE, tuple),
+    (robots.ResultMode.DICT, dict),
+])
+def test_fetch_robot_states_result_modes(robots_repo: robots.RobotsRepo, result_mode, expected_type):
+
+    robots_repo.register([robots.RobotInfo(robot_id="mode-smr01", robot_name="m01")])
+    robots_repo.upsert_robot_states([_robot_state("mode-smr01", 5.0)])
+
+    robot_states = robots_repo.fetch_robot_states(result_mode=result_mode)
+    assert_that(robot_states[0]).is_instance_of(expected_type)
+
+    records = {record.robot_id: record for record in map(_as_record, robot_states)}
+    assert_that(records["mode-smr01"]).is_equal_to(robots.RobotStateRecord("mode-smr01", "m01", "test-map", 5.0, 0.0, 0.0))
+
+def test_history_appends_and_prunes_partitions(robots_repo: robots.RobotsRepo):
+
+    history_repo = setup_robot_state_history_repo(logger=structlog.get_logger(), engine=robots_repo.engine)
+    history_robots_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                                   engine=robots_repo.engine,
+                                                   history=history_repo)
+
+    started_at = datetime.now(timezone.utc)
+    for x in range(3):
+        history_robots_repo.upsert_robot_states([_robot_state("hist-smr01", float(x))])
+
+    # older samples, two days ago
+    two_days_ago = started_at - timedelta(days=2)
+    history_repo.append([robots._robot_state_row(_robot_state("hist-smr01", -1.0))],
+                        recorded_at=two_days_ago)
+
+    trajectory = list(history_repo.fetch_trajectory("hist-smr01", started_at, started_at + timedelta(minutes=1)))
+    assert_that([row.position_x for row in trajectory]).is_equal_to([0.0, 1.0, 2.0])
+
+    downsampled = list(history_repo.fetch_trajectory("hist-smr01",
+                                                     started_at,
+                                                     started_at + timedelta(minutes=1),
+                                                     downsample=timedelta(minutes=1)))
+    assert_that(downsampled).is_length(1)
+
+    # querying the last minutes only scans the current partition
+    with robots_repo.engine.connect() as conn:
+        plan = "\n".join(conn.exec_driver_sql(
+            "EXPLAIN SELECT * FROM robot_state_history WHERE recorded_at >= %(start)s",
+            {"start": started_at}).scalars())
+    assert_that(plan).does_not_contain(history_repo._partition_name(history_repo._partition_start(two_days_ago)))
+
+    dropped = history_repo.drop_expired_partitions(now=started_at + timedelta(days=7))
+    assert_that(dropped).contains(history_repo._partition_name(history_repo._partition_start(two_days_ago)))
+
+def test_history_drops_expired_partitions_when_the_partition_rolls_over(robots_repo: robots.RobotsRepo):
+
+    # far in the past, retention of other tests never reaches these partitions
+    day = datetime(2001, 3, 1, 12, tzinfo=timezone.utc)
+    setup_robot_state_history_repo(logger=structlog.get_logger(), engine=robots_repo.engine)
+
+    # a writer process which has not written before
+    history_repo = RobotStateHistoryRepo(logger=structlog.get_logger(),
+                                         engine=robots_repo.engine,
+                                         retention=timedelta(days=1),
+                                         partitions_ahead=0)
+    row = robots._robot_state_row(_robot_state("hist-smr02", 1.0))
+
+    history_repo.append([row], recorded_at=day)
+    expired = history_repo._partition_name(history_repo._partition_start(day))
+
+    # no maintain() call, the write into a later partition prunes the expired one
+    history_repo.append([row], recorded_at=day + timedelta(days=3))
+    with robots_repo.engine.connect() as conn:
+        assert_that(conn.execute(text("SELECT to_regclass(:name)"), {"name": expired}).scalar()).is_none()
+
+def test_history_rereads_partitions_dropped_by_another_process(robots_repo: robots.RobotsRepo):
+
+    day = datetime(2001, 4, 1, 12, tzinfo=timezone.utc)
+    history_repo = setup_robot_state_history_repo(logger=structlog.get_logger(),
+                                                  engine=robots_repo.engine,
+                                                  retention=timedelta(days=3650 * 100))
+    history_repo.ensure_partitions(day)
+
+    # another process drops the partitions this repo has seen
+    other_repo = setup_robot_state_history_repo(logger=structlog.get_logger(),
+                                                engine=robots_repo.engine,
+                                                create_tables=False,
+                                                retention=timedelta(days=1))
+    other_repo.drop_expired_partitions(now=day + timedelta(days=10))
+
+    next_day = day + timedelta(days=1)
+    history_repo.append([robots._robot_state_row(_robot_state("hist-smr03", 2.0))], recorded_at=next_day)
+    trajectory = list(history_repo.fetch_trajectory("hist-smr03", next_day, next_day + timedelta(seconds=1)))
+    assert_that([row.position_x for row in trajectory]).is_equal_to([2.0])
+
+def test_spatial_queries_in_database_and_snapshot(robots_repo: robots.RobotsRepo):
+
+    positions = {"geo-smr01": (0.0, 0.0), "geo-smr02": (3.0, 4.0), "geo-smr03": (-1.0, 1.0), "geo-smr04": (50.0, 50.0)}
+    robots_repo.register([robots.RobotInfo(robot_id=robot_id, robot_name=robot_id) for robot_id in positions])
+    robots_repo.upsert_robot_states([robots.RobotState(robot_id=robot_id,
+                                                       map_uuid="geo-map",
+                                                       position_x=x,
+                                                       position_y=y,
+                                                       position_theta=0.0) for robot_id, (x, y) in positions.items()])
+
+    snapshot_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                             engine=robots_repo.engine,
+                                             enable_snapshot=True)
+
+    for repo in (robots_repo, snapshot_repo):
+        in_box = repo.robots_in_box("geo-map", (-2.0, -2.0, 3.0, 4.0), result_mode=robots.ResultMode.RECORD)
+        assert_that(sorted(record.robot_id for record in in_box)).is_equal_to(["geo-smr01", "geo-smr02", "geo-smr03"])
+
+        within = repo.robots_within_radius("geo-map", 0.0, 0.0, 2.0, result_mode=robots.ResultMode.RECORD)
+        assert_that(sorted(record.robot_id for record in within)).is_equal_to(["geo-smr01", "geo-smr03"])
+
+        nearest = repo.nearest_robots("geo-map", 2.0, 3.5, 2, search_radius=0.5, result_mode=robots.ResultMode.RECORD)
+        assert_that([record.robot_id for record in nearest]).is_equal_to(["geo-smr02", "geo-smr03"])
+
+        nearest = repo.nearest_robots("geo-map", 0.0, 0.0, 10, result_mode=robots.ResultMode.RECORD)
+        assert_that([record.robot_id for record in nearest]).is_equal_to(["geo-smr01", "geo-smr03", "geo-smr02", "geo-smr04"])
+
+def test_change_feed_delivers_changed_poses(robots_repo: robots.RobotsRepo):
+
+    change_feed = setup_robot_state_change_feed(logger=structlog.get_logger(), engine=robots_repo.engine)
+    subscription = change_feed.subscribe()
+    try:
+        # poses of previous runs are still stored, make this run's poses new
+        x = datetime.now(timezone.utc).timestamp()
+
+        robots_repo.upsert_robot_states([_robot_state("cf-smr01", x)])
+        assert_that(subscription.get(timeout=5.0)).is_equal_to(RobotStateChange("cf-smr01", "test-map", x, 0.0, 0.0))
+
+        # same pose again is not a change
+        robots_repo.upsert_robot_states([_robot_state("cf-smr01", x)])
+        robots_repo.upsert_robot_states([_robot_state("cf-smr02", x)])
+        assert_that([change.robot_id for change in subscription.get_batch(timeout=5.0)]).is_equal_to(["cf-smr02"])
+
+        # a bad payload is skipped, a tab inside an id is just data
+        with robots_repo.engine.begin() as conn:
+            conn.execute(text("SELECT pg_notify(:channel, 'not json')"), {"channel": change_feed.channel})
+        robots_repo.upsert_robot_states([_robot_state("cf\tsmr03", x)])
+        assert_that(subscription.get(timeout=5.0)).is_equal_to(RobotStateChange("cf\tsmr03", "test-map", x, 0.0, 0.0))
+    finally:
+        change_feed.stop()
+
+def test_subscription_coalesces_per_robot():
+
+    subscription = Subscription(maxsize=2)
+    subscription.put(RobotStateChange("smr01", "map", 1.0, 0.0, 0.0))
+    subscription.put(RobotStateChange("smr02", "map", 1.0, 0.0, 0.0))
+    subscription.put(RobotStateChange("smr01", "map", 2.0, 0.0, 0.0))
+    subscription.put(RobotStateChange("smr03", "map", 1.0, 0.0, 0.0))
+
+    changes = subscription.get_batch(timeout=0)
+    assert_that(changes).is_equal_to([RobotStateChange("smr02", "map", 1.0, 0.0, 0.0),
+                                      RobotStateChange("smr03", "map", 1.0, 0.0, 0.0)])
+    assert_that((subscription.coalesced, subscription.dropped)).is_equal_to((1, 1))
+
+def test_unchanged_poses_are_not_written(robots_repo: robots.RobotsRepo):
+
+    delta_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                          engine=robots_repo.engine,
+                                          pose_epsilon=0.01)
+    robot_ids = ["delta-smr01", "delta-smr02"]
+    delta_repo.register([robots.RobotInfo(robot_id=robot_id, robot_name=robot_id) for robot_id in robot_ids])
+
+    # unique pose per run, the first upsert is always written
+    x = datetime.now().timestamp() % 1000
+    delta_repo.upsert_robot_states([_robot_state(robot_id, x) for robot_id in robot_ids])
+
+    # parked and jittering below epsilon, dropped in memory
+    delta_repo.upsert_robot_states([_robot_state(robot_id, x + 0.005) for robot_id in robot_ids])
+    assert_that(delta_repo.upsert_stats()).is_equal_to(robots.UpsertStats(4, 2, 2, 0))
+
+    # a cold repo sends them, the ON CONFLICT guard drops them in database
+    cold_repo = robots.RobotsRepo(logger=structlog.get_logger(), engine=robots_repo.engine, pose_epsilon=0.01)
+    cold_repo.upsert_robot_states([_robot_state("delta-smr01", x + 0.005),
+                                   _robot_state("delta-smr02", x + 1.0)])
+    assert_that(cold_repo.upsert_stats()).is_equal_to(robots.UpsertStats(2, 1, 0, 1))
+
+    assert_that(delta_repo.fetch_robot_state("delta-smr01").position_x).is_equal_to(x)
+    assert_that(delta_repo.fetch_robot_state("delta-smr02").position_x).is_equal_to(x + 1.0)
+
+def test_poses_without_position_are_compared_as_null(robots_repo: robots.RobotsRepo):
+
+    null_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                         engine=robots_repo.engine,
+                                         pose_epsilon=0.01)
+    null_repo.register([robots.RobotInfo(robot_id="null-smr01", robot_name="null01")])
+    lost = robots.RobotState(robot_id="null-smr01", map_uuid="test-map")
+
+    # losing the position is a change, repeating it is not
+    x = datetime.now().timestamp() % 1000
+    null_repo.upsert_robot_states([_robot_state("null-smr01", x)])
+    null_repo.upsert_robot_states([lost])
+    null_repo.upsert_robot_states([lost])
+    assert_that(null_repo.upsert_stats()).is_equal_to(robots.UpsertStats(3, 2, 1, 0))
+
+    # the ON CONFLICT guard compares NULL the same way, the pose is restored for the other tests
+    cold_repo = robots.RobotsRepo(logger=structlog.get_logger(), engine=robots_repo.engine, pose_epsilon=0.01)
+    cold_repo.upsert_robot_states([lost])
+    cold_repo.upsert_robot_states([_robot_state("null-smr01", x)])
+    assert_that(cold_repo.upsert_stats()).is_equal_to(robots.UpsertStats(2, 1, 0, 1))
+    assert_that(cold_repo.fetch_robot_state("null-smr01").position_x).is_equal_to(x)
+
+def test_columnar_fetch_matches_fetch_robot_states(robots_repo: robots.RobotsRepo):
+
+    buffers = FleetBuffers()
+    fleet = robots_repo.fetch_robot_states_columnar(buffers)
+
+    # ordered by the database collation, compare by robot_id
+    robot_states = robots_repo.fetch_robot_states(result_mode=robots.ResultMode.RECORD)
+    assert_that({robot_id: (fleet.map_uuids[map_index], x)
+                 for robot_id, map_index, x in zip(fleet.robot_ids, fleet.map_index, fleet.position_x)}).is_equal_to(
+        {robot_state.robot_id: (robot_state.map_uuid, robot_state.position_x) for robot_state in robot_states})
+    assert_that(np.shares_memory(fleet.position_x, buffers.position_x)).is_true()
+
+def test_columnar_fetch_is_ordered_by_robot_id_with_and_without_snapshot(robots_repo: robots.RobotsRepo):
+
+    snapshot_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                             engine=robots_repo.engine,
+                                             enable_snapshot=True)
+
+    # registered in reverse, the snapshot keeps them in insertion order
+    robot_ids = [f"col-order-smr{i}" for i in (3, 2, 1)] + ["col-order-SMR0", "col-order-_smr4"]
+    snapshot_repo.register([robots.RobotInfo(robot_id=robot_id, robot_name=robot_id) for robot_id in robot_ids])
+    snapshot_repo.upsert_robot_states([_robot_state(robot_id, 0.0) for robot_id in robot_ids])
+
+    in_database = robots_repo.fetch_robot_states_columnar().robot_ids
+    from_snapshot = snapshot_repo.fetch_robot_states_columnar().robot_ids
+    assert_that(in_database).is_equal_to(sorted(in_database))
+    assert_that(from_snapshot).is_equal_to(in_database)
+
+def test_columnar_upsert_round_trip(robots_repo: robots.RobotsRepo):
+
+    robot_ids = [f"col-smr{i:02d}" for i in range(3)]
+    robots_repo.register([robots.RobotInfo(robot_id=robot_id, robot_name=robot_id) for robot_id in robot_ids])
+
+    x = datetime.now().timestamp() % 1000
+    robots_repo.upsert_robot_states_columnar(FleetArrays(robot_ids,
+                                                         ["col-map-a", "col-map-b"],
+                                                         np.array([0, 1, 0], dtype=np.int32),
+                                                         np.arange(3, dtype=np.float64) + x,
+                                                         np.zeros(3),
+                                                         np.full(3, 0.5)))
+
+    robot_state = robots_repo.fetch_robot_state("col-smr01")
+    assert_that((robot_state.map_uuid, robot_state.position_x, robot_state.position_theta)).is_equal_to(
+        ("col-map-b", x + 1.0, 0.5))
+
+    # the same arrays again, nothing is written
+    written = robots_repo.upsert_stats().written
+    robots_repo.upsert_robot_states_columnar(robots_repo.fetch_robot_states_columnar())
+    assert_that(robots_repo.upsert_stats().written).is_equal_to(written)
+
+def test_columnar_round_trip_keeps_null_positions(robots_repo: robots.RobotsRepo):
+
+    robots_repo.register([robots.RobotInfo(robot_id="col-null-smr01", robot_name="colnull01")])
+    robots_repo.upsert_robot_states([robots.RobotState(robot_id="col-null-smr01", map_uuid="test-map")])
+
+    fleet = robots_repo.fetch_robot_states_columnar()
+    assert_that(np.isnan(fleet.position_x[fleet.robot_ids.index("col-null-smr01")])).is_true()
+
+    written = robots_repo.upsert_stats().written
+    robots_repo.upsert_robot_states_columnar(fleet)
+    assert_that(robots_repo.upsert_stats().written).is_equal_to(written)
+
+    with robots_repo.engine.connect() as conn:
+        position_x = conn.execute(text("SELECT position_x FROM robot_states WHERE robot_id = 'col-null-smr01'")).scalar_one()
+    assert_that(position_x).is_none()
+
+    # a pose again, model mode fetches of the other tests need one
+    robots_repo.upsert_robot_states([_robot_state("col-null-smr01", 0.0)])
+
+def test_telemetry_samples_every_upserted_report(robots_repo: robots.RobotsRepo):
+
+    telemetry = TelemetryStore(window=8, max_robots=4)
+    telemetry_repo = robots.setup_robots_repo(logger=structlog.get_logger(),
+                                              engine=robots_repo.engine,
+                                              pose_epsilon=0.01,
+                                              telemetry=telemetry)
+    telemetry_repo.register([robots.RobotInfo(robot_id="tel-smr10", robot_name="tel-smr10")])
+
+    x = datetime.now().timestamp() % 1000
+    for dx in (0.0, 0.005, 1.0):
+        telemetry_repo.upsert_robot_states([_robot_state("tel-smr10", x + dx)])
+
+    # the report below epsilon is not written but still sampled
+    assert_that(telemetry_repo.upsert_stats().written).is_equal_to(2)
+    assert_that(telemetry.window_of("tel-smr10")[:, 1].tolist()).is_equal_to([x, x + 0.005, x + 1.0])
+
+def test_upserts_hit_the_compiled_cache(robots_repo: robots.RobotsRepo):
+
+    compile_cache_stats = CompileCacheStats().attach(robots_repo.engine)
+    try:
+        robots_repo.register([robots.RobotInfo(robot_id="cc-smr01", robot_name="cc01")])
+        robots_repo.upsert_robot_states([_robot_state("cc-smr01", 0.0)])
+        compile_cache_stats.reset()
+
+        # different number of rows, same statement
+        robots_repo.register([robots.RobotInfo(robot_id=f"cc-smr{i:02d}", robot_name=f"cc{i:02d}") for i in range(3)])
+        robots_repo.upsert_robot_states([_robot_state(f"cc-smr{i:02d}", float(i)) for i in range(3)])
+
+        info = compile_cache_stats.info()
+        for method in ("RobotsRepo.register", "RobotsRepo.upsert_robot_states"):
+            assert_that(info[method].misses).is_equal_to(0)
+            assert_that(info[method].hit_rate).is_equal_to(1.0)
+    finally:
+        compile_cache_stats.detach(robots_repo.engine)
+
+def test_query_instrumentation_times_methods_and_logs_slow_queries(robots_repo: robots.RobotsRepo):
+
+    query_instrumentation = setup_query_instrumentation(logger=structlog.get_logger(),
+                                                        engine=robots_repo.engine,
+                                                        slow_query_threshold=0.0)
+    try:
+        with structlog.testing.capture_logs() as logs:
+            robots_repo.register([robots.RobotInfo(robot_id="qi-smr01", robot_name="qi01")])
+            robots_repo.name_cache.clear()
+            robots_repo.fetch_robot_name(["qi-smr01", "qi-smr02"])
+    finally:
+        query_instrumentation.detach(robots_repo.engine)
+
+    slow_queries = [log for log in logs if log["event"] == "slow query"]
+    assert_that([log["method"] for log in slow_queries]).contains("RobotsRepo.register", "RobotsRepo.fetch_robot_name")
+
+    dump = query_instrumentation.dump()
+    assert_that(dump["methods"]["RobotsRepo.register"]).has_count(1).has_errors(0)
+    assert_that(dump["methods"]["RobotsRepo.fetch_robot_name"]["rows"]).is_equal_to(1)
+    assert_that(dump["statements"]).contains_key(
+        "SELECT robot_infos.robot_id AS robot_infos_robot_id, robot_infos.robot_name AS robot_infos_robot_name "
+        "FROM robot_infos WHERE robot_infos.robot_id IN (?)")
+
+def test_query_instrumentation_counts_failed_statements(robots_repo: robots.RobotsRepo):
+
+    query_instrumentation = setup_query_instrumentation(logger=structlog.get_logger(), engine=robots_repo.engine)
+    try:
+        with robots_repo.engine.connect() as conn:
+            for _ in range(3):
+                with pytest.raises(DBAPIError):
+                    conn.execute(text("SELECT 1 / 0"))
+                conn.rollback()
+
+            # nothing left behind on the pooled connection
+            assert_that(conn.info.get("query_started_at")).is_empty()
+    finally:
+        query_instrumentation.detach(robots_repo.engine)
+
+    dump = query_instrumentation.dump()
+    assert_that(dump["methods"]["-"]["query_errors"]).is_equal_to(3)
+    assert_that(dump["statements"]["SELECT ? / ?"]).has_count(3).has_errors(3)
+
+def test_hash_ring_moves_few_keys_when_a_shard_is_added():
+
+    robot_ids = [f"smr{i:05d}" for i in range(10000)]
+    before = HashRing(["shard-0", "shard-1", "shard-2"])
+    after = HashRing(["shard-0", "shard-1", "shard-2", "shard-3"])
+
+    moved = [robot_id for robot_id in robot_ids if before.shard_for(robot_id) != after.shard_for(robot_id)]
+    assert_that(len(moved) / len(robot_ids)).is_between(0.15, 0.35)
+    assert_that({after.shard_for(robot_id) for robot_id in moved}).is_equal_to({"shard-3"})
+
+def test_sharded_robots_repo_routes_by_robot_id():
+
+    engines = {f"shard-{i}": postgres_helpers.connect_to_postgres(host=settings.host,
+                                                                  port=settings.port,
+                                                                  db_name=f"{settings.db_name}_shard{i}",
+                                                                  user=settings.user,
+                                                                  password=settings.password) for i in range(2)}
+
+    robot_ids = [f"shard-smr{i:02d}" for i in range(20)]
+    with setup_sharded_robots_repo(logger=structlog.get_logger(), engines=engines, pose_epsilon=0.5) as sharded_repo:
+        assert_that({shard_repo.pose_epsilon for shard_repo in sharded_repo.shards.values()}).is_equal_to({0.5})
+
+        sharded_repo.register([robots.RobotInfo(robot_id=robot_id, robot_name=robot_id) for robot_id in robot_ids])
+        sharded_repo.upsert_robot_states([_robot_state(robot_id, 1.0) for robot_id in robot_ids])
+
+        # every robot is stored on its own shard only
+        for shard, shard_repo in sharded_repo.shards.items():
+            stored = {record.robot_id for record in shard_repo.fetch_robot_states(result_mode=robots.ResultMode.RECORD)}
+            expected = {robot_id for robot_id in robot_ids if sharded_repo.shard_for(robot_id) == shard}
+            assert_that(expected).is_not_empty()
+            assert_that(stored & set(robot_ids)).is_equal_to(expected)
+
+        requested = list(reversed(robot_ids)) + ["shard-missing"]
+        assert_that(list(sharded_repo.fetch_robot_name(requested))).is_equal_to(list(reversed(robot_ids)))
+
+        fleet = sharded_repo.fetch_robot_states(result_mode=robots.ResultMode.RECORD)
+        assert_that({record.robot_id for record in fleet}).contains(*robot_ids)
+
+    with pytest.raises(ValueError):
+        setup_sharded_robots_repo(logger=structlog.get_logger(), engines=engines, router=object())
+
+    for engine in engines.values():
+        engine.dispose()
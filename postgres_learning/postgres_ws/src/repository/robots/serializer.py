@@ -0,0 +1,318 @@
+import struct
+
+import numpy as np
+
+from collections import namedtuple
+from functools import singledispatch
+from operator import attrgetter
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union
+)
+
+from repository.robots.robots import (
+    LatestRobotState,
+    RobotInfo,
+    RobotState
+)
+from repository.robots.columnar import FleetArrays
+
+'''
+    NOTE:
+    Compact binary frames of fleet payloads, instead of model_dump_json per consumer.
+
+    encode() is a functools.singledispatch registry, like functools-learning/singledispatch.py:
+    LatestRobotState, RobotInfo, RobotState, lists/tuples of them, FleetArrays and
+    numpy arrays have an encoder, other types can be added with @encode.register.
+    Lists are dispatched again on the type of their first element.
+
+    Every frame is a 16 byte header followed by columns:
+
+        header          magic "RF", version, kind, count (uint32), 8 reserved bytes
+        float columns   count * little endian float64 each, 8 byte aligned
+        map_index       count * uint32 into the map_uuid table
+        string columns  uint32 byte size + utf-8 strings joined by NUL
+                        [+ presence bitmap, one bit per string, when the column has None]
+
+    Lists are stored column by column, so decode() reads every number column as a NumPy
+    view of the frame (np.frombuffer, zero-copy) and every string column with one split.
+    Strings must not contain NUL. None (a NULL map_uuid or robot_name) is written as an
+    empty string, the high bit of the size tells that a bitmap of the None positions
+    follows, columns without None are encoded as before.
+'''
+
+_MAGIC = b"RF"
+_VERSION = 1
+
+# magic, version, kind, count, reserved
+_HEADER = struct.Struct("<2sBBI8x")
+_SIZE = struct.Struct("<I")
+
+# high bit of a string column size, a presence bitmap follows the strings
+_HAS_NULLS = 1 << 31
+
+KIND_EMPTY = 0
+KIND_LATEST_ROBOT_STATES = 1
+KIND_ROBOT_STATES = 2
+KIND_ROBOT_INFOS = 3
+KIND_NDARRAY = 4
+
+_FLOAT64 = np.dtype("<f8")
+_UINT32 = np.dtype("<u4")
+
+LatestRobotStateFrame = namedtuple("LatestRobotStateFrame", ["robot_ids",
+                                                             "robot_names",
+                                                             "map_uuids",
+                                                             "map_index",
+                                                             "position_x",
+                                                             "position_y",
+                                                             "position_theta"])
+
+RobotInfoFrame = namedtuple("RobotInfoFrame", ["robot_ids", "robot_names"])
+
+Frame = Union[LatestRobotStateFrame, FleetArrays, RobotInfoFrame, np.ndarray, list]
+
+def _header(kind: int, count: int) -> bytes:
+    return _HEADER.pack(_MAGIC, _VERSION, kind, count)
+
+def _strings(values: Sequence[Optional[str]]) -> bytes:
+
+    if any(value is not None and "\0" in value for value in values):
+        raise ValueError("strings of a frame must not contain NUL")
+
+    nulls = [value is None for value in values]
+    blob = "\0".join("" if value is None else value for value in values).encode()
+    if len(blob) >= _HAS_NULLS:
+        raise ValueError("string column of a frame is larger than 2 GiB")
+    if not any(nulls):
+        return _SIZE.pack(len(blob)) + blob
+
+    return _SIZE.pack(len(blob) | _HAS_NULLS) + blob + np.packbits(nulls, bitorder="little").tobytes()
+
+def _map_table(map_uuids: Sequence[Optional[str]]) -> Tuple[bytes, bytes]:
+    '''
+        map_uuids as uint32 indexes into a table of the distinct values.
+    '''
+    positions: Dict[Optional[str], int] = {}
+    index = [positions.setdefault(map_uuid, len(positions)) for map_uuid in map_uuids]
+    return np.asarray(index, dtype=_UINT32).tobytes(), _strings(list(positions))
+
+def _floats(*columns: Sequence[float]) -> bytes:
+    return b"".join(np.asarray(column, dtype=_FLOAT64).tobytes() for column in columns)
+
+@singledispatch
+def encode(value) -> bytes:
+    raise TypeError(f"no frame encoder registered for {type(value).__name__}")
+
+@singledispatch
+def _encode_sequence(first, values: Sequence) -> bytes:
+    raise TypeError(f"no frame encoder registered for lists of {type(first).__name__}")
+
+@encode.register(list)
+@encode.register(tuple)
+def _sequence(values: Sequence) -> bytes:
+
+    if not values:
+        return _header(KIND_EMPTY, 0)
+    return _encode_sequence(values[0], values)
+
+@encode.register
+def _latest_robot_state(value: LatestRobotState) -> bytes:
+    return _encode_sequence(value, [value])
+
+@encode.register
+def _robot_info(value: RobotInfo) -> bytes:
+    return _encode_sequence(value, [value])
+
+@encode.register
+def _robot_state(value: RobotState) -> bytes:
+    return _encode_sequence(value, [value])
+
+def _column(values: Sequence, name: str) -> list:
+    # one pass per field, no per-row tuple
+    return list(map(attrgetter(name), values))
+
+@_encode_sequence.register
+def _latest_robot_states(first: LatestRobotState, values: Sequence[LatestRobotState]) -> bytes:
+
+    map_index, map_table = _map_table(_column(values, "map_uuid"))
+
+    return b"".join((_header(KIND_LATEST_ROBOT_STATES, len(values)),
+                     _floats(*(_column(values, name) for name in ("position_x", "position_y", "position_theta"))),
+                     map_index,
+                     map_table,
+                     _strings(_column(values, "robot_id")),
+                     _strings(_column(values, "robot_name"))))
+
+@_encode_sequence.register
+def _robot_states(first: RobotState, values: Sequence[RobotState]) -> bytes:
+
+    map_index, map_table = _map_table(_column(values, "map_uuid"))
+
+    return b"".join((_header(KIND_ROBOT_STATES, len(values)),
+                     _floats(*(_column(values, name) for name in ("position_x", "position_y", "position_theta"))),
+                     map_index,
+                     map_table,
+                     _strings(_column(values, "robot_id"))))
+
+@_encode_sequence.register
+def _robot_infos(first: RobotInfo, values: Sequence[RobotInfo]) -> bytes:
+
+    return b"".join((_header(KIND_ROBOT_INFOS, len(values)),
+                     _strings(_column(values, "robot_id")),
+                     _strings(_column(values, "robot_name"))))
+
+@encode.register
+def _fleet_arrays(value: FleetArrays) -> bytes:
+
+    # already columnar, no per-row work but the robot ids
+    return b"".join((_header(KIND_ROBOT_STATES, len(value.robot_ids)),
+                     _floats(value.position_x, value.position_y, value.position_theta),
+                     np.asarray(value.map_index, dtype=_UINT32).tobytes(),
+                     _strings(value.map_uuids),
+                     _strings(value.robot_ids)))
+
+@encode.register
+def _ndarray(value: np.ndarray) -> bytes:
+
+    value = np.ascontiguousarray(value)
+    if value.dtype.hasobject:
+        raise TypeError("object arrays cannot be framed")
+
+    dtype = value.dtype.str.encode()
+    shape = struct.pack("<B{}Q".format(value.ndim), value.ndim, *value.shape)
+
+    # pad the description, the data after header, size and description starts 8 byte aligned
+    description = _SIZE.pack(len(dtype)) + dtype + shape
+    description += b"\0" * (-(_SIZE.size + len(description)) % 8)
+
+    return b"".join((_header(KIND_NDARRAY, value.size), _SIZE.pack(len(description)), description, value.tobytes()))
+
+class _Reader():
+
+    def __init__(self, buffer: memoryview, offset: int):
+        self.buffer = buffer
+        self.offset = offset
+
+    def array(self, dtype: np.dtype, count: int) -> np.ndarray:
+
+        array = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.offset)
+        self.offset += count * dtype.itemsize
+        return array
+
+    def strings(self, count: int) -> List[Optional[str]]:
+        '''
+            count only tells an empty column from a column of one empty string.
+        '''
+
+        (size,) = _SIZE.unpack_from(self.buffer, self.offset)
+        self.offset += _SIZE.size
+        has_nulls, size = size & _HAS_NULLS, size & ~_HAS_NULLS
+        text = str(self.buffer[self.offset:self.offset + size], "utf-8")
+        self.offset += size
+        values = text.split("\0") if count else []
+
+        if has_nulls:
+            bitmap = self.array(np.dtype(np.uint8), (len(values) + 7) // 8)
+            nulls = np.unpackbits(bitmap, count=len(values), bitorder="little").tolist()
+            values = [None if null else value for value, null in zip(values, nulls)]
+        return values
+
+def _decode_latest_robot_states(reader: _Reader, count: int) -> LatestRobotStateFrame:
+
+    position_x, position_y, position_theta = (reader.array(_FLOAT64, count) for _ in range(3))
+    map_index = reader.array(_UINT32, count)
+    map_uuids = reader.strings(1 if count else 0)
+
+    return LatestRobotStateFrame(robot_ids=reader.strings(count),
+                                 robot_names=reader.strings(count),
+                                 map_uuids=map_uuids,
+                                 map_index=map_index,
+                                 position_x=position_x,
+                                 position_y=position_y,
+                                 position_theta=position_theta)
+
+def _decode_robot_states(reader: _Reader, count: int) -> FleetArrays:
+
+    position_x, position_y, position_theta = (reader.array(_FLOAT64, count) for _ in range(3))
+    map_index = reader.array(_UINT32, count)
+    map_uuids = reader.strings(1 if count else 0)
+
+    return FleetArrays(robot_ids=reader.strings(count),
+                       map_uuids=map_uuids,
+                       map_index=map_index,
+                       position_x=position_x,
+                       position_y=position_y,
+                       position_theta=position_theta)
+
+def _decode_robot_infos(reader: _Reader, count: int) -> RobotInfoFrame:
+    return RobotInfoFrame(robot_ids=reader.strings(count), robot_names=reader.strings(count))
+
+def _decode_ndarray(reader: _Reader, count: int) -> np.ndarray:
+
+    (description_size,) = _SIZE.unpack_from(reader.buffer, reader.offset)
+    offset = reader.offset + _SIZE.size
+
+    (dtype_size,) = _SIZE.unpack_from(reader.buffer, offset)
+    dtype = np.dtype(str(reader.buffer[offset + _SIZE.size:offset + _SIZE.size + dtype_size], "ascii"))
+    offset += _SIZE.size + dtype_size
+
+    (ndim,) = struct.unpack_from("<B", reader.buffer, offset)
+    shape = struct.unpack_from("<{}Q".format(ndim), reader.buffer, offset + 1)
+
+    reader.offset += _SIZE.size + description_size
+    return reader.array(dtype, count).reshape(shape)
+
+_DECODERS: Dict[int, Callable[[_Reader, int], Frame]] = {
+    KIND_EMPTY: lambda reader, count: [],
+    KIND_LATEST_ROBOT_STATES: _decode_latest_robot_states,
+    KIND_ROBOT_STATES: _decode_robot_states,
+    KIND_ROBOT_INFOS: _decode_robot_infos,
+    KIND_NDARRAY: _decode_ndarray,
+}
+
+def decode(frame: Union[bytes, bytearray, memoryview]) -> Frame:
+    '''
+        columns of an encoded frame, number columns are read-only views of frame.
+    '''
+    buffer = memoryview(frame)
+    magic, version, kind, count = _HEADER.unpack_from(buffer, 0)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("not a fleet frame")
+
+    decoder = _DECODERS.get(kind)
+    if decoder is None:
+        raise ValueError(f"unknown frame kind {kind}")
+
+    return decoder(_Reader(buffer, _HEADER.size), count)
+
+def decode_latest_robot_states(frame: Union[bytes, bytearray, memoryview]) -> List[LatestRobotState]:
+    '''
+        decode() of a LatestRobotState frame back into models, for consumers which want objects.
+    '''
+    columns = decode(frame)
+    if isinstance(columns, list):
+        return columns
+    if not isinstance(columns, LatestRobotStateFrame):
+        raise ValueError("not a LatestRobotState frame")
+
+    # no validation, like FleetSnapshot: NULL names and map_uuids of database rows are valid frames
+    map_uuids = [columns.map_uuids[index] for index in columns.map_index.tolist()]
+    return [LatestRobotState.model_construct(robot_id=robot_id,
+                                             robot_name=robot_name,
+                                             map_uuid=map_uuid,
+                                             position_x=x,
+                                             position_y=y,
+                                             position_theta=theta)
+            for robot_id, robot_name, map_uuid, x, y, theta in zip(columns.robot_ids,
+                                                                    columns.robot_names,
+                                                                    map_uuids,
+                                                                    columns.position_x.tolist(),
+                                                                    columns.position_y.tolist(),
+                                                                    columns.position_theta.tolist())]
@@ -0,0 +1,55 @@
+import pytest
+import numpy as np
+from assertpy import assert_that
+
+from repository.robots import (
+    robots,
+    serializer
+)
+from repository.robots.columnar import FleetArrays
+
+def test_serializer_round_trips_fleet_payloads():
+
+    robot_states = [robots.LatestRobotState(robot_id=f"ser-smr{i:02d}",
+                                            robot_name=f"ser{i:02d}",
+                                            map_uuid=f"ser-map-{i % 2}",
+                                            position_x=float(i),
+                                            position_y=-float(i),
+                                            position_theta=0.25) for i in range(3)]
+
+    frame = serializer.encode(robot_states)
+    assert_that(serializer.decode_latest_robot_states(frame)).is_equal_to(robot_states)
+
+    columns = serializer.decode(frame)
+    assert_that(columns.map_uuids).is_equal_to(["ser-map-0", "ser-map-1"])
+    assert_that(np.shares_memory(columns.position_x, np.frombuffer(frame, dtype=np.uint8))).is_true()
+
+    positions = np.arange(6, dtype=np.float32).reshape(2, 3)
+    assert_that(serializer.decode(serializer.encode(positions)).tolist()).is_equal_to(positions.tolist())
+
+    with pytest.raises(TypeError):
+        serializer.encode({"robot_id": "ser-smr00"})
+
+def test_serializer_encodes_none_and_rejects_nul():
+
+    robot_infos = [robots.RobotInfo(robot_id="ser-smr10", robot_name=None),
+                   robots.RobotInfo(robot_id="ser-smr11", robot_name="")]
+    columns = serializer.decode(serializer.encode(robot_infos))
+    assert_that(columns.robot_names).is_equal_to([None, ""])
+
+    fleet = FleetArrays(["ser-smr12", "ser-smr13"], [None, "ser-map-0"], np.array([0, 1]),
+                        np.zeros(2), np.zeros(2), np.zeros(2))
+    columns = serializer.decode(serializer.encode(fleet))
+    assert_that((columns.robot_ids, columns.map_uuids)).is_equal_to((["ser-smr12", "ser-smr13"], [None, "ser-map-0"]))
+
+    robot_states = [robots.LatestRobotState.model_construct(robot_id="ser-smr15",
+                                                            robot_name=None,
+                                                            map_uuid=None,
+                                                            position_x=1.0,
+                                                            position_y=2.0,
+                                                            position_theta=0.0)]
+    assert_that(serializer.decode_latest_robot_states(serializer.encode(robot_states))).is_equal_to(robot_states)
+
+    # also a column of a single string
+    with pytest.raises(ValueError):
+        serializer.encode([robots.RobotInfo(robot_id="ser\0smr14", robot_name="ser14")])
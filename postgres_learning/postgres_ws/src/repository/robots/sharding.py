@@ -0,0 +1,219 @@
+import bisect
+import hashlib
+import structlog
+
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar
+)
+
+from sqlalchemy import Engine
+
+from repository.robots.robots import (
+    UnexpectedError,
+    RobotsRepo,
+    RobotInfo,
+    RobotState,
+    LatestRobotState,
+    ResultMode,
+    DEFAULT_FETCH_BATCH_SIZE,
+    setup_robots_repo
+)
+
+'''
+    NOTE:
+    ShardedRobotsRepo spreads the fleet over several PostgreSQL databases by robot_id.
+
+    1. Routing: a consistent hash ring with virtual nodes maps robot_id to a shard name.
+       Adding a shard only moves about 1/N of the robots, and robot_infos/robot_states of
+       one robot always live on the same shard, so the per-shard join still works.
+    2. Batch calls (register/upsert_robot_states/fetch_robot_name) are split per shard and
+       the shard batches run concurrently on a thread pool.
+    3. fetch_robot_states scatters to every shard and concatenates the results.
+
+    Writes are not atomic across shards: a batch which fails on one shard is still
+    committed on the others, the raised UnexpectedError lists the failed shards.
+
+    Shard names are part of the hash, keep them stable (e.g. "shard-0"), not host names.
+'''
+
+T = TypeVar("T")
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing():
+
+    def __init__(self, shards: Sequence[str], vnodes: int = 128):
+
+        if not shards:
+            raise ValueError("HashRing needs at least one shard")
+
+        points = sorted((_hash(f"{shard}#{vnode}"), shard) for shard in shards for vnode in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> str:
+
+        index = bisect.bisect(self._hashes, _hash(key))
+        return self._shards[index % len(self._shards)]
+
+class ShardedRobotsRepo():
+
+    def __init__(self,
+                 logger: structlog.stdlib.BoundLogger,
+                 shards: Dict[str, RobotsRepo],
+                 vnodes: int = 128,
+                 max_workers: Optional[int] = None):
+
+        self.logger = logger
+
+        # shard name => repo of that shard
+        self.shards = shards
+        self.ring = HashRing(list(shards), vnodes=vnodes)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or len(shards),
+                                            thread_name_prefix="robots-shard")
+
+    def shard_for(self, robot_id: str) -> str:
+        return self.ring.shard_for(robot_id)
+
+    def _split(self, items: Sequence[T], robot_id: Callable[[T], str]) -> Dict[str, List[T]]:
+
+        groups: Dict[str, List[T]] = {}
+        for item in items:
+            groups.setdefault(self.shard_for(robot_id(item)), []).append(item)
+        return groups
+
+    def _run(self, method: str, calls: Dict[str, Callable[[], T]]) -> Dict[str, T]:
+        '''
+            run one call per shard concurrently, wait for all of them, raise if any failed.
+        '''
+        if len(calls) == 1:
+            ((shard, call),) = calls.items()
+            return {shard: call()}
+
+        # every call runs in a copy of the caller context, ContextVars set by a shard call
+        # (e.g. the read-your-writes pin of ReplicaRouter) do not stay on the pool thread
+        futures = {shard: self._executor.submit(copy_context().run, call) for shard, call in calls.items()}
+
+        results, errors = {}, {}
+        for shard, future in futures.items():
+            try:
+                results[shard] = future.result()
+            except Exception as e:
+                errors[shard] = e
+
+        if errors:
+            self.logger.error(
+                "[ShardedRobotsRepo][{}] shards failed. ERROR: {}".format(method, errors))
+            raise UnexpectedError(f"{method} failed on shards {sorted(errors)}. ERROR: {errors}")
+
+        return results
+
+    def register(self, robot_infos: List[RobotInfo]):
+
+        groups = self._split(robot_infos, lambda robot_info: robot_info.robot_id)
+        self._run("register", {shard: (lambda shard=shard, group=group: self.shards[shard].register(group))
+                               for shard, group in groups.items()})
+
+    def upsert_robot_states(self, robot_states: List[RobotState]):
+
+        groups = self._split(robot_states, lambda robot_state: robot_state.robot_id)
+        self._run("upsert_robot_states",
+                  {shard: (lambda shard=shard, group=group: self.shards[shard].upsert_robot_states(group))
+                   for shard, group in groups.items()})
+
+    def fetch_robot_name(self, robot_ids: List[str]) -> Dict[str, str]:
+
+        groups = self._split(robot_ids, lambda robot_id: robot_id)
+        results = self._run("fetch_robot_name",
+                            {shard: (lambda shard=shard, group=group: self.shards[shard].fetch_robot_name(group))
+                             for shard, group in groups.items()})
+
+        robot_names = {}
+        for names in results.values():
+            robot_names.update(names)
+
+        # same order as the request, like RobotsRepo.fetch_robot_name
+        return {robot_id: robot_names[robot_id] for robot_id in robot_ids if robot_id in robot_names}
+
+    def fetch_robot_state(self, robot_id: str) -> Optional[LatestRobotState]:
+        return self.shards[self.shard_for(robot_id)].fetch_robot_state(robot_id)
+
+    def fetch_robot_states(self,
+                           batch_size: int = DEFAULT_FETCH_BATCH_SIZE,
+                           result_mode: Optional[ResultMode] = None) -> List:
+
+        results = self._run("fetch_robot_states",
+                            {shard: (lambda repo=repo: repo.fetch_robot_states(batch_size=batch_size,
+                                                                               result_mode=result_mode))
+                             for shard, repo in self.shards.items()})
+
+        robot_states = []
+        for shard in self.shards:
+            robot_states.extend(results[shard])
+        return robot_states
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "ShardedRobotsRepo":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def setup_sharded_robots_repo(logger: structlog.stdlib.BoundLogger,
+                              engines: Dict[str, Engine],
+                              create_tables: bool = True,
+                              vnodes: int = 128,
+                              max_workers: Optional[int] = None,
+                              **repo_options) -> ShardedRobotsRepo:
+    '''
+        engines maps a stable shard name to the engine of that shard.
+
+        repo_options (enable_snapshot, pose_epsilon, telemetry, ...) are passed to
+        setup_robots_repo of every shard. history and router belong to one engine, build
+        the shard repos and ShardedRobotsRepo(shards=...) to use them.
+    '''
+    per_engine = sorted({"history", "router"} & set(repo_options))
+    if per_engine:
+        raise ValueError(f"{per_engine} are bound to one engine, pass them to the shard repos instead")
+
+    shards = {shard: setup_robots_repo(logger=logger, engine=engine, create_tables=create_tables, **repo_options)
+              for shard, engine in engines.items()}
+
+    return ShardedRobotsRepo(logger=logger, shards=shards, vnodes=vnodes, max_workers=max_workers)
+
+if __name__ == "__main__":
+
+    from helpers.postgres_helpers import connect_to_postgres
+    from config.settings import settings
+
+    engines = {f"shard-{i}": connect_to_postgres(host=settings.host,
+                                                 port=settings.port,
+                                                 db_name=f"{settings.db_name}_shard{i}",
+                                                 user=settings.user,
+                                                 password=settings.password) for i in range(2)}
+
+    with setup_sharded_robots_repo(logger=structlog.get_logger(), engines=engines) as robots_repo:
+
+        robots_repo.register([RobotInfo(robot_id=f"smr{i:02d}", robot_name=f"{i:02d}") for i in range(10)])
+        robots_repo.upsert_robot_states([RobotState(robot_id=f"smr{i:02d}",
+                                                    map_uuid="xxx",
+                                                    position_x=float(i),
+                                                    position_y=0.0,
+                                                    position_theta=0.0) for i in range(10)])
+
+        structlog.get_logger().info({robot_id: robots_repo.shard_for(robot_id) for robot_id in ["smr00", "smr01", "smr02"]})
+        structlog.get_logger().info(robots_repo.fetch_robot_states())
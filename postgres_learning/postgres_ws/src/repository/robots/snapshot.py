@@ -0,0 +1,134 @@
+import threading
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+    Iterable,
+    Optional
+)
+
+from repository.robots.robots import LatestRobotState
+from repository.robots.spatial import (
+    BBox,
+    SpatialGrid
+)
+
+'''
+    NOTE:
+    FleetSnapshot keeps the joined robot_infos/robot_states view of the whole fleet in memory.
+
+    RobotsRepo writes through it after every committed register/upsert_robot_states, so
+    polling the fleet state does not touch PostgreSQL at all:
+
+    1. get(robot_id) is a dict lookup, O(1) per robot.
+    2. fleet() returns a prebuilt tuple of the whole fleet. The tuple is only rebuilt
+       on the first read after a write, so repeated polls return the same object.
+
+    3. in_box/within_radius/nearest answer spatial queries from a SpatialGrid which is
+       updated together with the robot states.
+
+    The LatestRobotState objects are shared between callers, treat them as read-only.
+
+    The snapshot only sees writes of its own process, call RobotsRepo.refresh_snapshot
+    or feed it from a RobotStateChangeFeed listener if other processes write robot states too.
+'''
+
+class FleetSnapshot():
+
+    def __init__(self, cell_size: float = 5.0):
+
+        self._lock = threading.Lock()
+
+        # robot_id => robot_name / robot_id => robot state row
+        self._names: Dict[str, Optional[str]] = {}
+        self._states: Dict[str, Dict] = {}
+
+        # robot_id => joined state, only robots with both info and state
+        self._robots: Dict[str, LatestRobotState] = {}
+        self._fleet: Optional[Tuple[LatestRobotState, ...]] = None
+
+        # positions of the joined robots
+        self._grid = SpatialGrid(cell_size=cell_size)
+
+    def load(self, robot_infos: Iterable[Dict], robot_states: Iterable[Dict]):
+        '''
+            replace the whole snapshot, rows are dicts shaped like RobotInfo/RobotState columns.
+        '''
+        with self._lock:
+            self._names = {row["robot_id"]: row["robot_name"] for row in robot_infos}
+            self._states = {row["robot_id"]: row for row in robot_states}
+            self._robots = {}
+            self._grid.clear()
+            for robot_id in self._states:
+                self._join(robot_id)
+            self._fleet = None
+
+    def apply_robot_infos(self, rows: List[Dict]):
+
+        with self._lock:
+            for row in rows:
+                self._names[row["robot_id"]] = row["robot_name"]
+                self._join(row["robot_id"])
+            self._fleet = None
+
+    def apply_robot_states(self, rows: List[Dict]):
+
+        with self._lock:
+            for row in rows:
+                self._states[row["robot_id"]] = row
+                self._join(row["robot_id"])
+            self._fleet = None
+
+    def get(self, robot_id: str) -> Optional[LatestRobotState]:
+        return self._robots.get(robot_id)
+
+    def fleet(self) -> Tuple[LatestRobotState, ...]:
+
+        fleet = self._fleet
+        if fleet is None:
+            with self._lock:
+                if self._fleet is None:
+                    self._fleet = tuple(self._robots.values())
+                fleet = self._fleet
+
+        return fleet
+
+    def __len__(self) -> int:
+        return len(self._robots)
+
+    def in_box(self, map_uuid: str, bbox: BBox) -> List[LatestRobotState]:
+
+        with self._lock:
+            return [self._robots[robot_id] for robot_id in self._grid.in_box(map_uuid, bbox)]
+
+    def within_radius(self, map_uuid: str, x: float, y: float, radius: float) -> List[LatestRobotState]:
+
+        with self._lock:
+            return [self._robots[robot_id] for robot_id in self._grid.within_radius(map_uuid, x, y, radius)]
+
+    def nearest(self, map_uuid: str, x: float, y: float, k: int) -> List[LatestRobotState]:
+
+        with self._lock:
+            return [self._robots[robot_id] for robot_id, _ in self._grid.nearest(map_uuid, x, y, k)]
+
+    def _join(self, robot_id: str):
+
+        # robot_name is nullable, a robot registered without name is still joined
+        robot_state = self._states.get(robot_id)
+        if robot_id not in self._names or robot_state is None:
+            return
+        robot_name = self._names[robot_id]
+
+        # rows of committed writes, no validation: a NULL position must not fail after the commit
+        self._robots[robot_id] = LatestRobotState.model_construct(robot_id=robot_id,
+                                                                  robot_name=robot_name,
+                                                                  map_uuid=robot_state["map_uuid"],
+                                                                  position_x=robot_state["position_x"],
+                                                                  position_y=robot_state["position_y"],
+                                                                  position_theta=robot_state["position_theta"])
+
+        if robot_state["position_x"] is None or robot_state["position_y"] is None:
+            self._grid.remove(robot_id)
+        else:
+            self._grid.update(robot_id, robot_state["map_uuid"], robot_state["position_x"], robot_state["position_y"])
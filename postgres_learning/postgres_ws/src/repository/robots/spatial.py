@@ -0,0 +1,232 @@
+import math
+
+from typing import (
+    Dict,
+    List,
+    Set,
+    Tuple,
+    Optional
+)
+
+'''
+    NOTE:
+    SpatialGrid is a uniform grid (spatial hash) over robot positions, one grid per map_uuid.
+
+    Every robot lives in the cell (floor(x / cell_size), floor(y / cell_size)), so
+
+    1. update/remove are O(1).
+    2. a bounding box query only visits the cells overlapping the box.
+    3. a nearest query scans rings of cells around the query point and stops as soon as
+       the k-th candidate is closer than anything in the unscanned rings can be, or every
+       robot of the map has been seen. Rings are bounded by the occupied cells of the map.
+       When there would be more ring cells to visit than occupied cells (a few robots far
+       apart), the occupied cells are sorted by their ring instead of walking empty rings.
+
+    A KD-tree answers nearest queries with fewer visits, but it has to be rebuilt when
+    robots move, a grid is updated in place for every pose.
+
+    A robot whose x or y is not finite (NaN, inf) has no cell, update removes it from
+    the grid like a robot without position.
+
+    BBox is (min_x, min_y, max_x, max_y).
+'''
+
+BBox = Tuple[float, float, float, float]
+Cell = Tuple[int, int]
+
+class SpatialGrid():
+
+    def __init__(self, cell_size: float = 5.0):
+
+        self.cell_size = cell_size
+
+        # robot_id => (map_uuid, x, y, cell)
+        self._positions: Dict[str, Tuple[str, float, float, Cell]] = {}
+
+        # map_uuid => cell => robot_ids
+        self._cells: Dict[str, Dict[Cell, Set[str]]] = {}
+
+        # map_uuid => number of robots
+        self._counts: Dict[str, int] = {}
+
+        # map_uuid => [min_cell_x, min_cell_y, max_cell_x, max_cell_y] of the occupied cells,
+        # bounds nearest search. Dropped when an edge cell empties, recomputed on the next read.
+        self._bounds: Dict[str, List[int]] = {}
+
+    def _cell(self, x: float, y: float) -> Cell:
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def update(self, robot_id: str, map_uuid: str, x: float, y: float):
+
+        # floor() raises on NaN and inf
+        if not (math.isfinite(x) and math.isfinite(y)):
+            self.remove(robot_id)
+            return
+
+        cell = self._cell(x, y)
+
+        previous = self._positions.get(robot_id)
+        if previous is not None and (previous[0], previous[3]) != (map_uuid, cell):
+            self._discard(robot_id, previous[0], previous[3])
+        if previous is None or previous[0] != map_uuid:
+            if previous is not None:
+                self._uncount(previous[0])
+            self._counts[map_uuid] = self._counts.get(map_uuid, 0) + 1
+
+        self._positions[robot_id] = (map_uuid, x, y, cell)
+        self._cells.setdefault(map_uuid, {}).setdefault(cell, set()).add(robot_id)
+
+        bounds = self._bounds.get(map_uuid)
+        if bounds is not None:
+            bounds[0] = min(bounds[0], cell[0])
+            bounds[1] = min(bounds[1], cell[1])
+            bounds[2] = max(bounds[2], cell[0])
+            bounds[3] = max(bounds[3], cell[1])
+
+    def remove(self, robot_id: str):
+
+        previous = self._positions.pop(robot_id, None)
+        if previous is not None:
+            self._discard(robot_id, previous[0], previous[3])
+            self._uncount(previous[0])
+
+    def clear(self):
+        self._positions.clear()
+        self._cells.clear()
+        self._counts.clear()
+        self._bounds.clear()
+
+    def _uncount(self, map_uuid: str):
+
+        self._counts[map_uuid] -= 1
+        if not self._counts[map_uuid]:
+            del self._counts[map_uuid]
+
+    def _discard(self, robot_id: str, map_uuid: str, cell: Cell):
+
+        cells = self._cells[map_uuid]
+        cells[cell].discard(robot_id)
+        if not cells[cell]:
+            del cells[cell]
+            if not cells:
+                del self._cells[map_uuid]
+
+            # the bounds may shrink, recompute them when they are needed
+            bounds = self._bounds.get(map_uuid)
+            if bounds is not None and (cell[0] in (bounds[0], bounds[2]) or cell[1] in (bounds[1], bounds[3])):
+                del self._bounds[map_uuid]
+
+    def _map_bounds(self, map_uuid: str) -> List[int]:
+
+        bounds = self._bounds.get(map_uuid)
+        if bounds is None:
+            cells = self._cells[map_uuid]
+            bounds = self._bounds[map_uuid] = [min(cell[0] for cell in cells),
+                                               min(cell[1] for cell in cells),
+                                               max(cell[0] for cell in cells),
+                                               max(cell[1] for cell in cells)]
+        return bounds
+
+    def in_box(self, map_uuid: str, bbox: BBox) -> List[str]:
+
+        cells = self._cells.get(map_uuid)
+        if not cells:
+            return []
+
+        min_x, min_y, max_x, max_y = bbox
+        min_cell_x, min_cell_y = self._cell(min_x, min_y)
+        max_cell_x, max_cell_y = self._cell(max_x, max_y)
+
+        robot_ids = []
+        # a huge box covers more cells than exist, walk the occupied cells instead
+        if (max_cell_x - min_cell_x + 1) * (max_cell_y - min_cell_y + 1) > len(cells):
+            candidate_cells = [cell for cell in cells
+                               if min_cell_x <= cell[0] <= max_cell_x and min_cell_y <= cell[1] <= max_cell_y]
+        else:
+            candidate_cells = [(cell_x, cell_y)
+                               for cell_x in range(min_cell_x, max_cell_x + 1)
+                               for cell_y in range(min_cell_y, max_cell_y + 1)]
+
+        for cell in candidate_cells:
+            for robot_id in cells.get(cell, ()):
+                _, x, y, _ = self._positions[robot_id]
+                if min_x <= x <= max_x and min_y <= y <= max_y:
+                    robot_ids.append(robot_id)
+
+        return robot_ids
+
+    def within_radius(self, map_uuid: str, x: float, y: float, radius: float) -> List[str]:
+
+        robot_ids = self.in_box(map_uuid, (x - radius, y - radius, x + radius, y + radius))
+        return [robot_id for robot_id in robot_ids if self.distance(robot_id, x, y) <= radius]
+
+    def nearest(self, map_uuid: str, x: float, y: float, k: int) -> List[Tuple[str, float]]:
+        '''
+            return up to k (robot_id, distance) ordered by distance.
+        '''
+        cells = self._cells.get(map_uuid)
+        if not cells or k <= 0:
+            return []
+
+        robots_on_map = self._counts[map_uuid]
+
+        center_x, center_y = self._cell(x, y)
+        min_cell_x, min_cell_y, max_cell_x, max_cell_y = self._map_bounds(map_uuid)
+        max_ring = max(center_x - min_cell_x, max_cell_x - center_x, center_y - min_cell_y, max_cell_y - center_y, 0)
+
+        if (2 * max_ring + 1) ** 2 > len(cells):
+            rings = self._occupied_rings(cells, center_x, center_y)
+        else:
+            rings = ((ring, self._ring(center_x, center_y, ring)) for ring in range(max_ring + 1))
+
+        candidates: List[Tuple[float, str]] = []
+        for ring, ring_cells in rings:
+            for cell in ring_cells:
+                for robot_id in cells.get(cell, ()):
+                    candidates.append((self.distance(robot_id, x, y), robot_id))
+
+            # nothing left to find
+            if len(candidates) == robots_on_map:
+                break
+
+            # cells outside the scanned rings are at least ring * cell_size away
+            if len(candidates) >= k:
+                candidates.sort()
+                if candidates[k - 1][0] <= ring * self.cell_size:
+                    break
+
+        candidates.sort()
+        return [(robot_id, distance) for distance, robot_id in candidates[:k]]
+
+    def distance(self, robot_id: str, x: float, y: float) -> float:
+        _, robot_x, robot_y, _ = self._positions[robot_id]
+        return math.hypot(robot_x - x, robot_y - y)
+
+    def position(self, robot_id: str) -> Optional[Tuple[str, float, float]]:
+        position = self._positions.get(robot_id)
+        return None if position is None else position[:3]
+
+    @staticmethod
+    def _occupied_rings(cells: Dict[Cell, Set[str]], center_x: int, center_y: int) -> List[Tuple[int, List[Cell]]]:
+        '''
+            occupied cells grouped by their ring around the center, nearest ring first.
+        '''
+        rings: Dict[int, List[Cell]] = {}
+        for cell in cells:
+            rings.setdefault(max(abs(cell[0] - center_x), abs(cell[1] - center_y)), []).append(cell)
+        return sorted(rings.items())
+
+    @staticmethod
+    def _ring(center_x: int, center_y: int, ring: int) -> List[Cell]:
+
+        if ring == 0:
+            return [(center_x, center_y)]
+
+        cells = []
+        for offset in range(-ring, ring + 1):
+            cells.append((center_x + offset, center_y - ring))
+            cells.append((center_x + offset, center_y + ring))
+        for offset in range(-ring + 1, ring):
+            cells.append((center_x - ring, center_y + offset))
+            cells.append((center_x + ring, center_y + offset))
+        return cells
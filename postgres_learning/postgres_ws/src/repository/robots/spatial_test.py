@@ -0,0 +1,77 @@
+import math
+
+from assertpy import assert_that
+
+from repository.robots.spatial import SpatialGrid
+
+def _grid() -> SpatialGrid:
+
+    grid = SpatialGrid(cell_size=1.0)
+    for robot_id, (x, y) in {"geo-smr01": (0.0, 0.0), "geo-smr02": (3.0, 4.0), "geo-smr03": (-1.0, 1.0)}.items():
+        grid.update(robot_id, "geo-map", x, y)
+    return grid
+
+def test_box_radius_and_nearest_queries():
+
+    grid = _grid()
+
+    assert_that(sorted(grid.in_box("geo-map", (-2.0, -2.0, 3.0, 4.0)))).is_equal_to(["geo-smr01", "geo-smr02", "geo-smr03"])
+    assert_that(sorted(grid.within_radius("geo-map", 0.0, 0.0, 2.0))).is_equal_to(["geo-smr01", "geo-smr03"])
+    assert_that(grid.nearest("geo-map", 2.0, 3.5, 1)).is_equal_to([("geo-smr02", math.hypot(1.0, 0.5))])
+
+def test_k_above_the_number_of_robots_returns_all_of_them():
+
+    nearest = _grid().nearest("geo-map", 0.0, 0.0, 10)
+    assert_that(nearest).is_equal_to([("geo-smr01", 0.0), ("geo-smr03", math.sqrt(2.0)), ("geo-smr02", 5.0)])
+
+def test_empty_and_unknown_maps():
+
+    grid = _grid()
+    for robot_id in ("geo-smr01", "geo-smr02", "geo-smr03"):
+        grid.remove(robot_id)
+
+    for map_uuid in ("geo-map", "unknown-map"):
+        assert_that(grid.in_box(map_uuid, (-10.0, -10.0, 10.0, 10.0))).is_empty()
+        assert_that(grid.within_radius(map_uuid, 0.0, 0.0, 10.0)).is_empty()
+        assert_that(grid.nearest(map_uuid, 0.0, 0.0, 3)).is_empty()
+    assert_that(_grid().nearest("geo-map", 0.0, 0.0, 0)).is_empty()
+
+def test_non_finite_positions_leave_the_grid():
+
+    grid = _grid()
+    grid.update("geo-smr01", "geo-map", float("nan"), 0.0)
+    grid.update("geo-smr04", "geo-map", float("inf"), float("-inf"))
+
+    assert_that(grid.position("geo-smr01")).is_none()
+    assert_that(grid.position("geo-smr04")).is_none()
+    assert_that([robot_id for robot_id, _ in grid.nearest("geo-map", 0.0, 0.0, 10)]).is_equal_to(["geo-smr03", "geo-smr02"])
+
+    # a finite pose puts it back
+    grid.update("geo-smr01", "geo-map", 0.0, 0.0)
+    assert_that(grid.nearest("geo-map", 0.0, 0.0, 1)).is_equal_to([("geo-smr01", 0.0)])
+
+def test_nearest_does_not_walk_rings_of_a_stale_outlier(monkeypatch):
+
+    walked = []
+    ring = SpatialGrid._ring
+    monkeypatch.setattr(SpatialGrid, "_ring", staticmethod(lambda *args: walked.extend(ring(*args)) or ring(*args)))
+
+    grid = SpatialGrid(cell_size=1.0)
+    for i in range(3):
+        grid.update(f"geo-smr1{i}", "geo-map", float(i), 0.0)
+
+    # one robot reported a far away pose once and moved back
+    grid.update("geo-smr10", "geo-map", 500.0, 500.0)
+    grid.update("geo-smr10", "geo-map", 0.0, 0.0)
+
+    # k above the number of robots stops once all of them are found
+    nearest = grid.nearest("geo-map", 0.0, 0.0, 5)
+    assert_that([robot_id for robot_id, _ in nearest]).is_equal_to(["geo-smr10", "geo-smr11", "geo-smr12"])
+    assert_that(len(walked)).is_less_than(50)
+
+    # a present outlier, the occupied cells are sorted instead of walking empty rings
+    walked.clear()
+    grid.update("geo-smr13", "geo-map", 500.0, 500.0)
+    nearest = grid.nearest("geo-map", 0.0, 0.0, 5)
+    assert_that([robot_id for robot_id, _ in nearest][-1]).is_equal_to("geo-smr13")
+    assert_that(walked).is_empty()
@@ -0,0 +1,191 @@
+import time
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple
+)
+
+'''
+    NOTE:
+    In-process telemetry: the last `window` poses of every robot, for smoothing and
+    anomaly checks without querying PostgreSQL.
+
+    Every robot has a ring buffer with deque(maxlen=window) semantics, append is O(1)
+    and drops the oldest sample once the ring is full. A dict of deque(maxlen=600) of
+    tuples costs one tuple and four float objects per sample (about 880 MB for 10k robots,
+    see benchmarks/telemetry_benchmark.py), so the rings are rows of one preallocated
+    float64 block instead:
+
+        samples[slot, i] = (recorded_at, position_x, position_y, position_theta)
+
+    The block is allocated once for max_robots robots, memory stays fixed
+    (max_robots * window * 32 bytes). A new robot takes a free slot, or the slot of the
+    robot which reported least recently once all slots are used.
+
+    window_of() returns the samples oldest first as an (n, 4) array. It is a view of the
+    block while the requested window does not wrap around the end of the ring, one copy
+    otherwise. Views are overwritten by later appends, copy() them to keep them.
+
+    A robot which changes map starts a new window, poses of two maps cannot be mixed.
+
+    RobotsRepo(telemetry=...) appends every report passed to upsert_robot_states. Behind a
+    RobotStatesWriteBehind only the flushed, latest pose of every robot is sampled.
+'''
+
+RECORDED_AT = 0
+POSITION_X = 1
+POSITION_Y = 2
+POSITION_THETA = 3
+
+class TelemetryStore():
+
+    def __init__(self, window: int = 600, max_robots: int = 10_000):
+
+        if window <= 0 or max_robots <= 0:
+            raise ValueError("window and max_robots must be positive")
+
+        self.window = window
+        self.max_robots = max_robots
+
+        self._samples = np.zeros((max_robots, window, 4), dtype=np.float64)
+
+        # robot_id => slot, least recently appended first
+        self._slots: OrderedDict = OrderedDict()
+        self._free = list(range(max_robots - 1, -1, -1))
+
+        # per slot: next write position, number of samples, map_uuid
+        self._heads = [0] * max_robots
+        self._counts = [0] * max_robots
+        self._maps: List[Optional[str]] = [None] * max_robots
+
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _slot(self, robot_id: str, map_uuid: Optional[str]) -> int:
+
+        slot = self._slots.get(robot_id)
+        if slot is not None:
+            self._slots.move_to_end(robot_id)
+            if self._maps[slot] != map_uuid:
+                self._counts[slot] = 0
+                self._heads[slot] = 0
+                self._maps[slot] = map_uuid
+            return slot
+
+        if self._free:
+            slot = self._free.pop()
+        else:
+            _, slot = self._slots.popitem(last=False)
+            self.evictions += 1
+
+        self._slots[robot_id] = slot
+        self._heads[slot] = 0
+        self._counts[slot] = 0
+        self._maps[slot] = map_uuid
+        return slot
+
+    def append(self,
+               robot_id: str,
+               map_uuid: Optional[str],
+               position_x: float,
+               position_y: float,
+               position_theta: float,
+               recorded_at: Optional[float] = None):
+
+        recorded_at = time.time() if recorded_at is None else recorded_at
+
+        with self._lock:
+            slot = self._slot(robot_id, map_uuid)
+            head = self._heads[slot]
+            self._samples[slot, head] = (recorded_at, position_x, position_y, position_theta)
+            self._heads[slot] = (head + 1) % self.window
+            if self._counts[slot] < self.window:
+                self._counts[slot] += 1
+
+    def append_rows(self, rows: Iterable[Dict], recorded_at: Optional[float] = None):
+        '''
+            rows shaped like RobotState columns, as passed to RobotsRepo.upsert_robot_states.
+        '''
+        recorded_at = time.time() if recorded_at is None else recorded_at
+        rows = list(rows)
+        if not rows:
+            return
+
+        with self._lock:
+            slots = []
+            heads = []
+            for row in rows:
+                slot = self._slot(row["robot_id"], row["map_uuid"])
+                head = self._heads[slot]
+                slots.append(slot)
+                heads.append(head)
+                self._heads[slot] = (head + 1) % self.window
+                if self._counts[slot] < self.window:
+                    self._counts[slot] += 1
+
+            # one scatter into the block instead of a NumPy assignment per row
+            samples = np.empty((len(rows), 4), dtype=np.float64)
+            samples[:, RECORDED_AT] = recorded_at
+            samples[:, POSITION_X] = [row["position_x"] for row in rows]
+            samples[:, POSITION_Y] = [row["position_y"] for row in rows]
+            samples[:, POSITION_THETA] = [row["position_theta"] for row in rows]
+            self._samples[slots, heads] = samples
+
+    def window_of(self, robot_id: str, size: Optional[int] = None) -> np.ndarray:
+        '''
+            the last size samples of robot_id (all of them by default), oldest first, an
+            empty (0, 4) array for an unknown robot.
+        '''
+        with self._lock:
+            slot = self._slots.get(robot_id)
+            if slot is None:
+                return np.empty((0, 4), dtype=np.float64)
+
+            count = self._counts[slot]
+            size = count if size is None else min(size, count)
+            start = (self._heads[slot] - size) % self.window
+
+            ring = self._samples[slot]
+            if start + size <= self.window:
+                return ring[start:start + size]
+            return np.concatenate((ring[start:], ring[:start + size - self.window]))
+
+    def latest(self, robot_id: str) -> Optional[Tuple[float, float, float, float]]:
+
+        with self._lock:
+            slot = self._slots.get(robot_id)
+            if slot is None or self._counts[slot] == 0:
+                return None
+            return tuple(self._samples[slot, (self._heads[slot] - 1) % self.window].tolist())
+
+    def map_uuid(self, robot_id: str) -> Optional[str]:
+
+        slot = self._slots.get(robot_id)
+        return None if slot is None else self._maps[slot]
+
+    def remove(self, robot_id: str):
+
+        with self._lock:
+            slot = self._slots.pop(robot_id, None)
+            if slot is not None:
+                self._counts[slot] = 0
+                self._maps[slot] = None
+                self._free.append(slot)
+
+    def __contains__(self, robot_id: str) -> bool:
+        return robot_id in self._slots
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    @property
+    def nbytes(self) -> int:
+        return self._samples.nbytes
@@ -0,0 +1,34 @@
+import numpy as np
+from assertpy import assert_that
+
+from repository.robots.telemetry import TelemetryStore
+
+def test_telemetry_rings_keep_the_last_window():
+
+    telemetry = TelemetryStore(window=4, max_robots=2)
+    for i in range(3):
+        telemetry.append("tel-smr01", "tel-map", float(i), 0.0, 0.0, recorded_at=float(i))
+
+    # not wrapped yet, a view of the block
+    window = telemetry.window_of("tel-smr01")
+    assert_that(window[:, 1].tolist()).is_equal_to([0.0, 1.0, 2.0])
+    assert_that(np.shares_memory(window, telemetry._samples)).is_true()
+
+    for i in range(3, 6):
+        telemetry.append("tel-smr01", "tel-map", float(i), 0.0, 0.0, recorded_at=float(i))
+    assert_that(telemetry.window_of("tel-smr01")[:, 1].tolist()).is_equal_to([2.0, 3.0, 4.0, 5.0])
+    assert_that(telemetry.window_of("tel-smr01", 2)[:, 1].tolist()).is_equal_to([4.0, 5.0])
+    assert_that(telemetry.latest("tel-smr01")).is_equal_to((5.0, 5.0, 0.0, 0.0))
+
+    # a new map starts a new window
+    telemetry.append("tel-smr01", "tel-map-b", 9.0, 0.0, 0.0)
+    assert_that(telemetry.window_of("tel-smr01")[:, 1].tolist()).is_equal_to([9.0])
+
+    # a third robot takes the slot of the least recently reporting one
+    telemetry.append("tel-smr02", "tel-map", 1.0, 0.0, 0.0)
+    telemetry.append("tel-smr01", "tel-map-b", 10.0, 0.0, 0.0)
+    telemetry.append("tel-smr03", "tel-map", 1.0, 0.0, 0.0)
+    assert_that("tel-smr02" in telemetry).is_false()
+    assert_that(telemetry.evictions).is_equal_to(1)
+    assert_that(telemetry.window_of("tel-smr02").shape).is_equal_to((0, 4))
+    assert_that(telemetry.window_of("tel-smr03")[:, 1].tolist()).is_equal_to([1.0])
@@ -0,0 +1,190 @@
+import time
+import threading
+
+from typing import (
+    List,
+    Dict,
+    Optional
+)
+
+from repository.robots.robots import (
+    RobotsRepo,
+    RobotState,
+    UnexpectedError,
+    _robot_state_row
+)
+
+'''
+    NOTE:
+    Write-behind (write-back) buffering.
+
+    Instead of opening one transaction per incoming pose update, the buffer keeps
+    the latest pose of every robot in memory and writes all of them with a single
+    multi-row upsert when either
+
+    1. the number of buffered robots reaches max_batch_size, or
+    2. flush_interval seconds have passed since the last flush.
+
+    A flush sends at most max_batch_size rows per upsert, more buffered robots (a flusher
+    which fell behind) are written in several upserts. When one of them fails, only the
+    rows not written yet go back to the buffer.
+
+    Since robot_states only keeps the latest pose, older updates of the same robot_id
+    can be dropped (coalesced) before they ever reach the database. So the number of
+    commits per second depends on flush_interval, not on the number of robots.
+
+    When max_pending robots are waiting to be written, put() blocks until a flush
+    frees the buffer (backpressure) and raises BufferFullError after put_timeout.
+'''
+
+class BufferFullError(Exception):
+    pass
+
+class RobotStatesWriteBehind():
+
+    def __init__(self,
+                 robots_repo: RobotsRepo,
+                 max_batch_size: int = 500,
+                 flush_interval: float = 0.1,
+                 max_pending: int = 10000,
+                 put_timeout: Optional[float] = None):
+
+        if max_pending < max_batch_size:
+            raise ValueError("max_pending should not be smaller than max_batch_size")
+
+        self.robots_repo = robots_repo
+        self.logger = robots_repo.logger
+
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+
+        # latest pose per robot_id, waiting to be written
+        self._pending: Dict[str, Dict] = {}
+        self._cond = threading.Condition()
+
+        # serialize flushes, otherwise an older batch may commit after a newer one
+        self._flush_lock = threading.Lock()
+
+        # statistics
+        self.received = 0
+        self.coalesced = 0
+        self.flushed_batches = 0
+        self.flushed_rows = 0
+
+        self._closed = False
+        self._flusher = threading.Thread(target=self._run,
+                                         name="robot-states-write-behind",
+                                         daemon=True)
+        self._flusher.start()
+
+    def put(self, robot_states: List[RobotState]):
+
+        deadline = None if self.put_timeout is None else time.monotonic() + self.put_timeout
+
+        with self._cond:
+            for robot_state in robot_states:
+                if self._closed:
+                    raise UnexpectedError("write-behind buffer is closed")
+
+                row = _robot_state_row(robot_state)
+
+                # a new robot_id grows the buffer, wait until flusher frees some space
+                while row["robot_id"] not in self._pending and len(self._pending) >= self.max_pending:
+                    self._cond.notify_all()
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise BufferFullError(f"{len(self._pending)} robot states are waiting to be flushed")
+                    self._cond.wait(timeout=remaining)
+
+                if row["robot_id"] in self._pending:
+                    self.coalesced += 1
+                self._pending[row["robot_id"]] = row
+                self.received += 1
+
+            if len(self._pending) >= self.max_batch_size:
+                self._cond.notify_all()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self):
+        '''
+            write all buffered robot states now, raise UnexpectedError if the upsert failed.
+        '''
+        self._flush(raise_error=True)
+
+    def close(self):
+
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+
+        self._flusher.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _flush(self, raise_error: bool) -> bool:
+
+        with self._flush_lock:
+            with self._cond:
+                rows, self._pending = self._pending, {}
+
+            if not rows:
+                return True
+
+            # a flusher which fell behind may hold up to max_pending rows, one statement per max_batch_size
+            rows = list(rows.values())
+            try:
+                for start in range(0, len(rows), self.max_batch_size):
+                    batch = rows[start:start + self.max_batch_size]
+                    try:
+                        self.robots_repo.upsert_robot_state_rows(batch)
+                    except UnexpectedError as e:
+                        with self._cond:
+                            # put the unwritten batches back without overwriting newer poses received meanwhile
+                            for row in rows[start:]:
+                                self._pending.setdefault(row["robot_id"], row)
+
+                        if raise_error:
+                            raise e
+                        self.logger.error(
+                            "[RobotStatesWriteBehind][flush] flush robot states failed. ERROR: {}".format(e))
+                        return False
+
+                    self.flushed_batches += 1
+                    self.flushed_rows += len(batch)
+            finally:
+                with self._cond:
+                    self._cond.notify_all()
+
+            return True
+
+    def _run(self):
+
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(timeout=remaining)
+
+                if self._closed:
+                    return
+
+            if not self._flush(raise_error=False):
+                # back off instead of hammering a failing database
+                with self._cond:
+                    if not self._closed:
+                        self._cond.wait(timeout=self.flush_interval)
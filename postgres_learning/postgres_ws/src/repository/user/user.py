@@ -1,25 +1,52 @@
 import structlog
 
-from typing import List
+from itertools import islice
+from collections import namedtuple
+
+from typing import (
+    TYPE_CHECKING,
+    List,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Callable,
+    TypeVar,
+    Tuple,
+    Union
+)
 
 from sqlalchemy import (
     Engine,
+    Connection,
     Column,
     Integer,
     String,
     Boolean,
-    ForeignKey
+    Table,
+    ForeignKey,
+    select
 )
 
 from sqlalchemy.orm import (
     registry,
+    Session,
     sessionmaker,
     relationship
 )
 
 from sqlalchemy.orm.query import Query
 
-from sqlalchemy.dialects.postgresql import insert as pg_upsert
+from helpers.instrumentation import repository_method
+from helpers.postgres_helpers import (
+    upsert_unnest_stmt,
+    unnest_params
+)
+
+if TYPE_CHECKING:
+    from helpers.replica_router import ReplicaRouter
+
+T = TypeVar("T")
 
 _USER_REPO_BASE = registry().generate_base()
 
@@ -59,14 +86,91 @@ class Address(_USER_REPO_BASE):
     address = Column(String, nullable=False)
 
     # Forigen Key => link address table and user table
-    user_id = Column(Integer, ForeignKey("users.id"))
+    # PostgreSQL does not index foreign keys, fetch_addresses_for_users filters on it
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+
+
+'''
+    NOTE:
+    statements are built once at module level,
+    so that UserRepo and AsyncUserRepo always send the same SQL.
+
+    The upserts bind every column as one array (see upsert_unnest_stmt), the statement
+    does not depend on the number of rows and is served from the compiled cache.
+'''
+
+_REGISTER_STMT = upsert_unnest_stmt(User.__table__)
+_UPSERT_ADDRESS_STMT = upsert_unnest_stmt(Address.__table__)
+
+_UPSERT_STMTS = {User.__tablename__: _REGISTER_STMT,
+                 Address.__tablename__: _UPSERT_ADDRESS_STMT}
+
+'''
+    NOTE:
+    Bulk variants (register_many/upsert_addresses) execute the same statements with one
+    chunk of rows at a time, every chunk in its own transaction. A failing chunk is rolled back and reported in
+    BulkResult.failures, the remaining chunks are still written.
+
+    ON CONFLICT cannot update the same row twice in one statement, so duplicated ids in a
+    chunk are collapsed, the last one wins. BulkResult.written counts the collapsed rows,
+    ChunkFailure.offset/size count input rows: inputs[offset:offset + size] is the failed chunk.
+'''
+
+DEFAULT_BULK_CHUNK_SIZE = 1000
+
+ChunkFailure = namedtuple("ChunkFailure", ["chunk_index", "offset", "size", "error"])
+BulkResult = namedtuple("BulkResult", ["written", "failures"])
+
+def _user_row(user: User) -> Dict:
+    return {"id": user.id, "name": user.name, "username": user.username}
+
+def _address_row(address: Address) -> Dict:
+    return {"id": address.id, "address": address.address, "user_id": address.user_id}
+
+def _chunks(rows: Iterable[Dict], chunk_size: int) -> Iterator[Tuple[int, List[Dict]]]:
+    '''
+        (number of input rows, rows with duplicated ids collapsed) per chunk.
+    '''
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
+
+    return _collapsed_chunks(iter(rows), chunk_size)
+
+def _collapsed_chunks(iterator: Iterator[Dict], chunk_size: int) -> Iterator[Tuple[int, List[Dict]]]:
+
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        # last row per id wins inside a chunk
+        yield len(chunk), list({row["id"]: row for row in chunk}.values())
+
+def _addresses_for_users_select(ids: Iterable[int]):
+
+    '''
+        NOTE:
+        select only the needed columns of user_address, instead of loading every User and
+        then lazy loading user.addresses (one extra SELECT per user, N+1 queries).
+    '''
+    return select(Address.user_id, Address.address) \
+        .where(Address.user_id.in_(ids)) \
+        .order_by(Address.user_id, Address.id)
+
+def _group_addresses(ids: Iterable[int], rows) -> Dict[int, List[str]]:
+
+    # every requested id is returned, users without address map to []
+    user_addresses = {id: [] for id in ids}
+    for row in rows:
+        user_addresses[row.user_id].append(row.address)
+    return user_addresses
 
 
 class UserRepo():
 
     def __init__(self,
                  logger: structlog.stdlib.BoundLogger,
-                 engine: Engine):
+                 engine: Engine,
+                 router: Optional["ReplicaRouter"] = None):
 
         self.logger = logger
 
@@ -76,69 +180,132 @@ class UserRepo():
                                           autoflush=False,
                                           bind=engine)
 
+        # optional read replicas of engine, reads go to the primary without it
+        self.router = router
+
+    def _read(self, read: Callable[[Session], T]) -> T:
+
+        if self.router is None:
+            with self.session_maker() as session:
+                return read(session)
+
+        return self.router.run_read(read)
+
+    def _mark_write(self):
+
+        if self.router is not None:
+            self.router.mark_write()
+
+    @repository_method("UserRepo.register")
     def register(self, user: User):
 
         with self.session_maker() as session:
             try:
-                # do insert statement
-                insert_stmt = pg_upsert(User).values({"id": user.id,
-                                                      "name": user.name,
-                                                      "username": user.username})
-
-                # check conflict
-                do_update_stmt = insert_stmt.on_conflict_do_update(
-                    index_elements=[User.id],
-                    set_={"name": user.name,
-                          "username": user.username})
-
-                session.execute(do_update_stmt)
+                session.execute(_REGISTER_STMT, unnest_params(User.__table__, [_user_row(user)]))
                 session.commit()
+                self._mark_write()
             except Exception as e:
                 session.rollback()
                 self.logger.error(
                     "[UserRepo][register] register user failed. ERROR: {}".format(e))
 
+    @repository_method("UserRepo.upsert_address")
     def upsert_address(self, address: Address):
 
         with self.session_maker() as session:
             try:
-                # do insert statement
-                insert_stmt = pg_upsert(Address).values({"id": address.id,
-                                                         "address": address.address,
-                                                         "user_id": address.user_id})
-
-                # check conflict
-                do_update_stmt = insert_stmt.on_conflict_do_update(
-                    index_elements=[Address.id],
-                    set_={"address": address.address,
-                          "user_id": address.user_id})
-
-                session.execute(do_update_stmt)
+                session.execute(_UPSERT_ADDRESS_STMT, unnest_params(Address.__table__, [_address_row(address)]))
                 session.commit()
+                self._mark_write()
             except Exception as e:
                 session.rollback()
                 self.logger.error(
                     "[UserRepo][register] register user failed. ERROR: {}".format(e))
 
+    @repository_method("UserRepo.register_many")
+    def register_many(self, users: Iterable[User], chunk_size: int = DEFAULT_BULK_CHUNK_SIZE) -> BulkResult:
+
+        return self._bulk_upsert("register_many",
+                                 User.__table__,
+                                 (_user_row(user) for user in users),
+                                 chunk_size)
+
+    @repository_method("UserRepo.upsert_addresses")
+    def upsert_addresses(self, addresses: Iterable[Address], chunk_size: int = DEFAULT_BULK_CHUNK_SIZE) -> BulkResult:
+
+        return self._bulk_upsert("upsert_addresses",
+                                 Address.__table__,
+                                 (_address_row(address) for address in addresses),
+                                 chunk_size)
+
+    def _bulk_upsert(self, method: str, table: Table, rows: Iterable[Dict], chunk_size: int) -> BulkResult:
+
+        written = 0
+        failures = []
+        offset = 0
+
+        for chunk_index, (size, chunk) in enumerate(_chunks(rows, chunk_size)):
+            with self.session_maker() as session:
+                try:
+                    session.execute(_UPSERT_STMTS[table.name], unnest_params(table, chunk))
+                    session.commit()
+                    self._mark_write()
+                    written += len(chunk)
+                except Exception as e:
+                    session.rollback()
+                    failures.append(ChunkFailure(chunk_index, offset, size, str(e)))
+                    self.logger.error(
+                        "[UserRepo][{}] chunk {} failed. ERROR: {}".format(method, chunk_index, e))
+            offset += size
+
+        return BulkResult(written, failures)
+
+    @repository_method("UserRepo.fetch_user_address")
     def fetch_user_address(self, id: int) -> List[str]:
 
         user_address = []
 
-        with self.session_maker() as session:
-            try:
-                user: User = session.query(User).filter(User.id == id).first()
-                for address in user.addresses:
-                    user_address.append(address.address)
-            except Exception as e:
-                session.rollback()
-                self.logger.error(
-                    "[UserRepo][fetch_user_address] fetch user address failed. ERROR: {}".format(e))
+        try:
+            user_address = self._read(
+                lambda session: _group_addresses([id], session.execute(_addresses_for_users_select([id]))))[id]
+        except Exception as e:
+            self.logger.error(
+                "[UserRepo][fetch_user_address] fetch user address failed. ERROR: {}".format(e))
         return user_address
 
-def setup_user_repo(logger: structlog.stdlib.BoundLogger, engine: Engine) -> UserRepo:
+    @repository_method("UserRepo.fetch_addresses_for_users")
+    def fetch_addresses_for_users(self, ids: List[int]) -> Dict[int, List[str]]:
+
+        user_addresses = {}
+
+        try:
+            user_addresses = self._read(
+                lambda session: _group_addresses(ids, session.execute(_addresses_for_users_select(ids))))
+        except Exception as e:
+            self.logger.error(
+                "[UserRepo][fetch_addresses_for_users] fetch addresses for users failed. ERROR: {}".format(e))
+        return user_addresses
 
-    _USER_REPO_BASE.metadata.create_all(engine)
-    user_repo = UserRepo(logger=logger, engine=engine)
+def create_user_schema(bind: Union[Engine, Connection]):
+    '''
+        tables and indexes of the user repo, shared by the sync and the async setup.
+    '''
+    _USER_REPO_BASE.metadata.create_all(bind)
+
+    # create_all skips indexes of tables which already exist
+    for index in Address.__table__.indexes:
+        index.create(bind, checkfirst=True)
+
+def setup_user_repo(logger: structlog.stdlib.BoundLogger,
+                    engine: Engine,
+                    create_tables: bool = True,
+                    router: Optional["ReplicaRouter"] = None) -> UserRepo:
+
+    # create_tables=False for runtime processes, the schema is created by bootstrap.py
+    if create_tables:
+        create_user_schema(engine)
+
+    user_repo = UserRepo(logger=logger, engine=engine, router=router)
     return user_repo
 
 
@@ -166,5 +333,13 @@ if __name__ == "__main__":
     user_repo.upsert_address(address=Address(id=1, address="Taichung city", user_id=0))
     user_repo.upsert_address(address=Address(id=2, address="New Taipei city", user_id=1))
     
+    # register many users in chunks
+    result = user_repo.register_many(users=[User(id=i, name="name{}".format(i), username="user{}".format(i))
+                                            for i in range(2, 1002)],
+                                     chunk_size=500)
+
     # fetch user address by id
-    addresses = user_repo.fetch_user_address(id=0)
\ No newline at end of file
+    addresses = user_repo.fetch_user_address(id=0)
+
+    # fetch addresses of a page of users in one query
+    user_addresses = user_repo.fetch_addresses_for_users(ids=[0, 1])
\ No newline at end of file
@@ -0,0 +1,190 @@
+import structlog
+
+from typing import (
+    List,
+    Dict,
+    Iterable
+)
+
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    async_sessionmaker
+)
+
+from sqlalchemy import Table
+
+from helpers.instrumentation import repository_method
+from helpers.postgres_helpers import unnest_params
+from repository.user.user import (
+    create_user_schema,
+    User,
+    Address,
+    _REGISTER_STMT,
+    _UPSERT_ADDRESS_STMT,
+    _UPSERT_STMTS,
+    _addresses_for_users_select,
+    _group_addresses,
+    _user_row,
+    _address_row,
+    _chunks,
+    DEFAULT_BULK_CHUNK_SIZE,
+    ChunkFailure,
+    BulkResult
+)
+
+'''
+    NOTE:
+    AsyncUserRepo has the same methods as UserRepo, but as coroutines.
+
+    Lazy loading does not work with AsyncSession (the relationship would have to do
+    blocking I/O when user.addresses is touched), addresses are selected directly with
+    the same statement as UserRepo.
+'''
+
+class AsyncUserRepo():
+
+    def __init__(self,
+                 logger: structlog.stdlib.BoundLogger,
+                 engine: AsyncEngine):
+
+        self.logger = logger
+
+        # register engine/session_maker
+        self.engine = engine
+        self.session_maker = async_sessionmaker(autoflush=False,
+                                                expire_on_commit=False,
+                                                bind=engine)
+
+    @repository_method("AsyncUserRepo.register")
+    async def register(self, user: User):
+
+        async with self.session_maker() as session:
+            try:
+                await session.execute(_REGISTER_STMT, unnest_params(User.__table__, [_user_row(user)]))
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                self.logger.error(
+                    "[AsyncUserRepo][register] register user failed. ERROR: {}".format(e))
+
+    @repository_method("AsyncUserRepo.upsert_address")
+    async def upsert_address(self, address: Address):
+
+        async with self.session_maker() as session:
+            try:
+                await session.execute(_UPSERT_ADDRESS_STMT, unnest_params(Address.__table__, [_address_row(address)]))
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                self.logger.error(
+                    "[AsyncUserRepo][upsert_address] upsert address failed. ERROR: {}".format(e))
+
+    @repository_method("AsyncUserRepo.register_many")
+    async def register_many(self, users: Iterable[User], chunk_size: int = DEFAULT_BULK_CHUNK_SIZE) -> BulkResult:
+
+        return await self._bulk_upsert("register_many",
+                                       User.__table__,
+                                       (_user_row(user) for user in users),
+                                       chunk_size)
+
+    @repository_method("AsyncUserRepo.upsert_addresses")
+    async def upsert_addresses(self, addresses: Iterable[Address], chunk_size: int = DEFAULT_BULK_CHUNK_SIZE) -> BulkResult:
+
+        return await self._bulk_upsert("upsert_addresses",
+                                       Address.__table__,
+                                       (_address_row(address) for address in addresses),
+                                       chunk_size)
+
+    async def _bulk_upsert(self, method: str, table: Table, rows: Iterable[Dict], chunk_size: int) -> BulkResult:
+
+        written = 0
+        failures = []
+        offset = 0
+
+        for chunk_index, (size, chunk) in enumerate(_chunks(rows, chunk_size)):
+            async with self.session_maker() as session:
+                try:
+                    await session.execute(_UPSERT_STMTS[table.name], unnest_params(table, chunk))
+                    await session.commit()
+                    written += len(chunk)
+                except Exception as e:
+                    await session.rollback()
+                    failures.append(ChunkFailure(chunk_index, offset, size, str(e)))
+                    self.logger.error(
+                        "[AsyncUserRepo][{}] chunk {} failed. ERROR: {}".format(method, chunk_index, e))
+            offset += size
+
+        return BulkResult(written, failures)
+
+    @repository_method("AsyncUserRepo.fetch_user_address")
+    async def fetch_user_address(self, id: int) -> List[str]:
+
+        user_address = []
+
+        async with self.session_maker() as session:
+            try:
+                rows = await session.execute(_addresses_for_users_select([id]))
+                user_address = _group_addresses([id], rows)[id]
+            except Exception as e:
+                await session.rollback()
+                self.logger.error(
+                    "[AsyncUserRepo][fetch_user_address] fetch user address failed. ERROR: {}".format(e))
+        return user_address
+
+    @repository_method("AsyncUserRepo.fetch_addresses_for_users")
+    async def fetch_addresses_for_users(self, ids: List[int]) -> Dict[int, List[str]]:
+
+        user_addresses = {}
+
+        async with self.session_maker() as session:
+            try:
+                rows = await session.execute(_addresses_for_users_select(ids))
+                user_addresses = _group_addresses(ids, rows)
+            except Exception as e:
+                await session.rollback()
+                self.logger.error(
+                    "[AsyncUserRepo][fetch_addresses_for_users] fetch addresses for users failed. ERROR: {}".format(e))
+        return user_addresses
+
+async def setup_async_user_repo(logger: structlog.stdlib.BoundLogger,
+                                engine: AsyncEngine,
+                                create_tables: bool = True) -> AsyncUserRepo:
+
+    if create_tables:
+        async with engine.begin() as conn:
+            await conn.run_sync(create_user_schema)
+
+    user_repo = AsyncUserRepo(logger=logger, engine=engine)
+    return user_repo
+
+
+if __name__ == "__main__":
+
+    import asyncio
+
+    from helpers.postgres_helpers import connect_to_postgres_async
+    from config.settings import settings
+
+    async def main():
+
+        pg_engine = await connect_to_postgres_async(
+            host=settings.host,
+            port=settings.port,
+            db_name=settings.db_name,
+            user=settings.user,
+            password=settings.password
+        )
+
+        user_repo = await setup_async_user_repo(
+            logger=structlog.get_logger(), engine=pg_engine)
+
+        await user_repo.register(user=User(id=0, name="Chunwei", username="Andy"))
+        await user_repo.upsert_address(address=Address(id=0, address="New Taipei city", user_id=0))
+
+        # fetch user address by id
+        addresses = await user_repo.fetch_user_address(id=0)
+        structlog.get_logger().info(addresses)
+
+        await pg_engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+import asyncio
+
+from contextlib import contextmanager
+
+import pytest
+import structlog
+from assertpy import assert_that
+
+from sqlalchemy import (
+    Engine,
+    event,
+    text
+)
+
+from config.settings import settings
+from helpers import postgres_helpers
+from repository.user import user
+from repository.user.user_async import setup_async_user_repo
+
+@pytest.fixture(scope="module")
+def user_repo() -> user.UserRepo:
+
+    pg_engine = postgres_helpers.connect_to_postgres(
+        host=settings.host,
+        port=settings.port,
+        db_name=settings.db_name,
+        user=settings.user,
+        password=settings.password,
+    )
+
+    return user.setup_user_repo(logger=structlog.get_logger(), engine=pg_engine)
+
+@contextmanager
+def _count_queries(engine: Engine):
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def test_fetch_addresses_without_n_plus_one(user_repo: user.UserRepo):
+
+    user_ids = list(range(100, 120))
+    for user_id in user_ids:
+        user_repo.register(user=user.User(id=user_id, name="name", username="username"))
+        user_repo.upsert_address(address=user.Address(id=user_id * 10, address="a{}".format(user_id), user_id=user_id))
+        user_repo.upsert_address(address=user.Address(id=user_id * 10 + 1, address="b{}".format(user_id), user_id=user_id))
+
+    with _count_queries(user_repo.engine) as statements:
+        user_addresses = user_repo.fetch_addresses_for_users(ids=user_ids + [-1])
+
+    assert_that(statements).is_length(1)
+    assert_that(user_addresses[100]).is_equal_to(["a100", "b100"])
+    assert_that(user_addresses[-1]).is_empty()
+    assert_that(user_addresses).is_length(len(user_ids) + 1)
+
+    with _count_queries(user_repo.engine) as statements:
+        addresses = user_repo.fetch_user_address(id=101)
+
+    assert_that(statements).is_length(1)
+    assert_that(addresses).is_equal_to(["a101", "b101"])
+
+def test_bulk_upserts_report_failed_chunks(user_repo: user.UserRepo):
+
+    users = [user.User(id=user_id, name="bulk", username="bulk{}".format(user_id)) for user_id in range(200, 250)]
+    users.append(user.User(id=200, name="bulk", username="last-wins"))
+
+    result = user_repo.register_many(users, chunk_size=60)
+    assert_that(result).is_equal_to(user.BulkResult(written=50, failures=[]))
+
+    # the second chunk points to a missing user, only that chunk is rolled back
+    addresses = [user.Address(id=2000 + i, address="bulk", user_id=200 + i) for i in range(10)]
+    addresses.append(user.Address(id=2010, address="bulk", user_id=-1))
+    result = user_repo.upsert_addresses(addresses, chunk_size=10)
+
+    assert_that(result.written).is_equal_to(10)
+    assert_that(result.failures).is_length(1)
+    assert_that(result.failures[0][:3]).is_equal_to((1, 10, 1))
+
+    assert_that(user_repo.fetch_addresses_for_users(ids=[200, -1])).is_equal_to({200: ["bulk"], -1: []})
+
+    # offset and size count input rows, also when duplicated ids were collapsed
+    addresses = [user.Address(id=2020, address="bulk", user_id=201),
+                 user.Address(id=2020, address="bulk", user_id=201),
+                 user.Address(id=2021, address="bulk", user_id=201),
+                 user.Address(id=2022, address="bulk", user_id=201),
+                 user.Address(id=2022, address="bulk", user_id=201),
+                 user.Address(id=2023, address="bulk", user_id=-1)]
+    result = user_repo.upsert_addresses(addresses, chunk_size=3)
+    assert_that(result.written).is_equal_to(2)
+    assert_that(result.failures[0][:3]).is_equal_to((1, 3, 3))
+
+    for chunk_size in (0, -1):
+        with pytest.raises(ValueError):
+            user_repo.register_many(users, chunk_size=chunk_size)
+
+def test_async_setup_creates_indexes_on_existing_tables(user_repo: user.UserRepo):
+
+    def user_id_index_exists() -> bool:
+        with user_repo.engine.connect() as conn:
+            return conn.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_user_address_user_id'")).first() is not None
+
+    with user_repo.engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_user_address_user_id"))
+    assert_that(user_id_index_exists()).is_false()
+
+    async def setup():
+
+        pg_engine = await postgres_helpers.connect_to_postgres_async(
+            host=settings.host,
+            port=settings.port,
+            db_name=settings.db_name,
+            user=settings.user,
+            password=settings.password,
+        )
+
+        try:
+            await setup_async_user_repo(logger=structlog.get_logger(), engine=pg_engine)
+        finally:
+            await pg_engine.dispose()
+
+    asyncio.run(setup())
+    assert_that(user_id_index_exists()).is_true()
@@ -0,0 +1,123 @@
+import math
+
+import numpy as np
+
+from dataclasses import dataclass
+
+from typing import (
+    Tuple,
+    Union
+)
+
+from main import (
+    Vector,
+    scale
+)
+
+'''
+    NOTE:
+    scale() in main.py multiplies a Vector one element at a time in a list comprehension.
+    Converting robot poses between map frames is the same kind of math on every pose:
+
+        x' = s * (cos(r) * x - sin(r) * y) + tx
+        y' = s * (sin(r) * x + cos(r) * y) + ty
+        theta' = normalize(theta + r)
+
+    Transform2D applies it to whole NumPy arrays of x, y and theta at once, the loop runs
+    in C instead of once per pose in Python. Every function still takes a plain Vector
+    (list[float]), it is converted with np.asarray once per call.
+
+    normalize_theta keeps angles in [-pi, pi).
+'''
+
+ArrayLike = Union[Vector, np.ndarray]
+
+# (x, y, theta)
+Pose = Tuple[float, float, float]
+
+def scale_array(scalar: float, vector: ArrayLike) -> np.ndarray:
+    '''
+        vectorized scale(), same result as np.array(scale(scalar, vector)).
+    '''
+    return scalar * np.asarray(vector, dtype=np.float64)
+
+def normalize_theta(theta: ArrayLike) -> np.ndarray:
+    return np.mod(np.asarray(theta, dtype=np.float64) + math.pi, 2 * math.pi) - math.pi
+
+@dataclass(frozen=True)
+class Transform2D:
+    scale: float = 1.0
+    rotation: float = 0.0
+    tx: float = 0.0
+    ty: float = 0.0
+
+    def apply(self, x: ArrayLike, y: ArrayLike, theta: ArrayLike) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        # scale folded into the rotation, two multiply-adds per coordinate
+        a = self.scale * math.cos(self.rotation)
+        b = self.scale * math.sin(self.rotation)
+
+        return (a * x - b * y + self.tx,
+                b * x + a * y + self.ty,
+                normalize_theta(np.asarray(theta, dtype=np.float64) + self.rotation))
+
+    def apply_pose(self, pose: Pose) -> Pose:
+        '''
+            one pose in plain Python, the per-element path the arrays replace.
+        '''
+        x, y, theta = pose
+        a = self.scale * math.cos(self.rotation)
+        b = self.scale * math.sin(self.rotation)
+        return (a * x - b * y + self.tx,
+                b * x + a * y + self.ty,
+                (theta + self.rotation + math.pi) % (2 * math.pi) - math.pi)
+
+    def then(self, other: "Transform2D") -> "Transform2D":
+        '''
+            self followed by other, as one transform.
+        '''
+        cos, sin = math.cos(other.rotation), math.sin(other.rotation)
+        return Transform2D(scale=self.scale * other.scale,
+                           rotation=self.rotation + other.rotation,
+                           tx=other.scale * (cos * self.tx - sin * self.ty) + other.tx,
+                           ty=other.scale * (sin * self.tx + cos * self.ty) + other.ty)
+
+    def inverse(self) -> "Transform2D":
+
+        cos, sin = math.cos(-self.rotation), math.sin(-self.rotation)
+        return Transform2D(scale=1.0 / self.scale,
+                           rotation=-self.rotation,
+                           tx=-(cos * self.tx - sin * self.ty) / self.scale,
+                           ty=-(sin * self.tx + cos * self.ty) / self.scale)
+
+def transform_poses(transform: Transform2D, poses: np.ndarray) -> np.ndarray:
+    '''
+        poses is an (n, 3) array of x, y, theta, a new (n, 3) array is returned.
+    '''
+    poses = np.asarray(poses, dtype=np.float64)
+    return np.column_stack(transform.apply(poses[:, 0], poses[:, 1], poses[:, 2]))
+
+def transform_poses_python(transform: Transform2D, poses: list[Pose]) -> list[Pose]:
+    return [transform.apply_pose(pose) for pose in poses]
+
+if __name__ == "__main__":
+
+    # same values as main.py
+    print(scale(2.0, [1.0, -4.2, 5.4]))
+    print(scale_array(2.0, [1.0, -4.2, 5.4]))
+
+    '''
+        NOTE
+        map frame of a robot site: the site map is scaled 0.05 m/pixel, rotated by 90 degrees
+        and shifted, then converted back with the inverse transform.
+    '''
+
+    map_to_site = Transform2D(scale=0.05, rotation=math.pi / 2, tx=10.0, ty=-3.0)
+
+    x, y, theta = map_to_site.apply([0.0, 100.0, 200.0], [0.0, 0.0, 50.0], [0.0, math.pi / 2, math.pi])
+    print(x, y, theta)
+
+    print(map_to_site.inverse().apply(x, y, theta))
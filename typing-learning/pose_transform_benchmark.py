@@ -0,0 +1,74 @@
+import math
+import time
+import random
+import argparse
+
+import numpy as np
+
+from typing import Callable
+
+from pose_transform import (
+    Transform2D,
+    scale,
+    scale_array,
+    transform_poses,
+    transform_poses_python
+)
+
+'''
+    NOTE:
+    list comprehension vs NumPy for scale() and for a full pose transform at 1k to 1M poses.
+
+        scale            main.scale on a Vector   vs scale_array on an ndarray
+        transform        Transform2D.apply_pose   vs transform_poses on an (n, 3) ndarray
+        transform+list   Transform2D.apply_pose   vs transform_poses including the list => ndarray conversion
+
+    The last row is what a caller holding plain lists pays, the conversion is part of it.
+
+    usage:
+        python pose_transform_benchmark.py --sizes 1000 10000 100000 1000000
+'''
+
+def best_of(func: Callable[[], object], repeat: int) -> float:
+
+    best = math.inf
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    transform = Transform2D(scale=0.05, rotation=math.pi / 3, tx=12.5, ty=-4.0)
+
+    print("{:<16} {:>10} {:>12} {:>12} {:>9}".format("case", "poses", "python ms", "numpy ms", "speedup"))
+
+    for size in args.sizes:
+
+        vector = [rng.uniform(-100.0, 100.0) for _ in range(size)]
+        poses = [(rng.uniform(-100.0, 100.0), rng.uniform(-100.0, 100.0), rng.uniform(-math.pi, math.pi))
+                 for _ in range(size)]
+        vector_array = np.array(vector)
+        poses_array = np.array(poses)
+
+        cases = {
+            "scale": (lambda: scale(2.0, vector), lambda: scale_array(2.0, vector_array)),
+            "transform": (lambda: transform_poses_python(transform, poses),
+                          lambda: transform_poses(transform, poses_array)),
+            "transform+list": (lambda: transform_poses_python(transform, poses),
+                               lambda: transform_poses(transform, poses)),
+        }
+
+        for name, (python_path, numpy_path) in cases.items():
+            python_seconds = best_of(python_path, args.repeat)
+            numpy_seconds = best_of(numpy_path, args.repeat)
+
+            print("{:<16} {:>10} {:>12.3f} {:>12.3f} {:>8.1f}x".format(
+                name, size, python_seconds * 1000, numpy_seconds * 1000, python_seconds / numpy_seconds))